@@ -317,6 +317,7 @@ public class UIFlowController : MonoBehaviour
     private int setupMemoryRoutineToken;
     private Coroutine setupMemoryCheckRoutine;
     private UnityWebRequest setupMemoryRequest;
+    private string setupMemoryIngestJobId;
     private bool setupMemoryInputFocused;
     private bool setupMemoryNoteJustDismissed;
     private bool setupMemoryOperationInProgress;
@@ -803,6 +804,8 @@ public class UIFlowController : MonoBehaviour
             setupMemoryRequest.Dispose();
             setupMemoryRequest = null;
         }
+
+        CancelRunningIngestJob();
     }
 
     private void ResolveMainModeTextBackgroundReferences()
@@ -6305,24 +6308,47 @@ public class UIFlowController : MonoBehaviour
                     yield break;
                 }
 
-                UpdateSetupMemoryLog("Embedding in corso...");
-                UpdateDebugText("Ingest file: Embedding in corso...");
-                var response = JsonUtility.FromJson<IngestResponse>(request.downloadHandler.text);
-                if (response != null && response.ok)
-                {
-                    UpdateSetupMemoryLog($"Ingest OK: {response.filename} (chunks {response.chunks_added})");
-                    UpdateDebugText($"Ingest file: OK - {response.chunks_added} chunks aggiunti");
-                    yield return StartCoroutine(HideRingsAfterOperation());
-                    yield return new WaitForSeconds(0.5f);
-                    GoToMainMode();
-                }
-                else
+                var queued = JsonUtility.FromJson<IngestJobResponse>(request.downloadHandler.text);
+                if (queued == null || string.IsNullOrEmpty(queued.job_id))
                 {
                     UpdateSetupMemoryLog("Ingest completato con risposta inattesa.");
                     UpdateDebugText("Ingest file: risposta inattesa.");
                     PlayErrorClip();
                     yield return StartCoroutine(HideRingsAfterOperation());
+                    yield break;
                 }
+
+                setupMemoryIngestJobId = queued.job_id;
+            }
+
+            // Il server risponde subito con un job: estrazione ed embedding proseguono in background.
+            IngestJobResponse job = null;
+            yield return StartCoroutine(PollIngestJobRoutine(setupMemoryIngestJobId, result => job = result));
+            setupMemoryIngestJobId = null;
+
+            if (job != null && string.Equals(job.status, "done", StringComparison.Ordinal) && job.dedup)
+            {
+                UpdateSetupMemoryLog($"Ingest OK: {job.filename} gia' in memoria");
+                UpdateDebugText("Ingest file: OK - file gia' presente, nessun chunk aggiunto");
+                yield return StartCoroutine(HideRingsAfterOperation());
+                yield return new WaitForSeconds(0.5f);
+                GoToMainMode();
+            }
+            else if (job != null && string.Equals(job.status, "done", StringComparison.Ordinal))
+            {
+                UpdateSetupMemoryLog($"Ingest OK: {job.filename} (chunks {job.chunks_added})");
+                UpdateDebugText($"Ingest file: OK - {job.chunks_added} chunks aggiunti");
+                yield return StartCoroutine(HideRingsAfterOperation());
+                yield return new WaitForSeconds(0.5f);
+                GoToMainMode();
+            }
+            else
+            {
+                string error = job != null && !string.IsNullOrEmpty(job.error) ? job.error : "risposta inattesa";
+                UpdateSetupMemoryLog($"Errore ingest: {error}");
+                UpdateDebugText($"Ingest file: {error}");
+                PlayErrorClip();
+                yield return StartCoroutine(HideRingsAfterOperation());
             }
         }
         finally
@@ -6335,6 +6361,96 @@ public class UIFlowController : MonoBehaviour
         }
     }
 
+    private IEnumerator PollIngestJobRoutine(string jobId, Action<IngestJobResponse> onComplete)
+    {
+        string url = BuildServiceUrl(servicesConfig.ragBaseUrl, $"ingest_jobs/{UnityWebRequest.EscapeURL(jobId)}");
+        int failures = 0;
+        while (true)
+        {
+            yield return new WaitForSeconds(1f);
+            using (var request = UnityWebRequest.Get(url))
+            {
+                setupMemoryRequest = request;
+                request.timeout = GetRequestTimeoutSeconds();
+                yield return request.SendWebRequest();
+                setupMemoryRequest = null;
+
+                if (request.result != UnityWebRequest.Result.Success)
+                {
+                    failures++;
+                    if (failures >= 5)
+                    {
+                        ReportServiceError("RAG", request.error ?? "Network error");
+                        onComplete?.Invoke(null);
+                        yield break;
+                    }
+                    continue;
+                }
+
+                failures = 0;
+                IngestJobResponse job = null;
+                try
+                {
+                    job = JsonUtility.FromJson<IngestJobResponse>(request.downloadHandler.text);
+                }
+                catch (Exception)
+                {
+                    job = null;
+                }
+
+                if (job == null)
+                {
+                    continue;
+                }
+
+                string progress = DescribeIngestJobProgress(job);
+                UpdateSetupMemoryLog(progress);
+                UpdateDebugText($"Ingest file: {progress}");
+                if (job.status == "done" || job.status == "error" || job.status == "cancelled")
+                {
+                    onComplete?.Invoke(job);
+                    yield break;
+                }
+            }
+        }
+    }
+
+    private static string DescribeIngestJobProgress(IngestJobResponse job)
+    {
+        switch (job.stage)
+        {
+            case "queued":
+                return "In coda...";
+            case "extracting":
+                return job.pages_total > 0 ? $"OCR in corso... pagina {job.pages_done}/{job.pages_total}" : "OCR in corso...";
+            case "deduplicating":
+                return "Controllo duplicati...";
+            case "embedding":
+                return $"Embedding in corso... {job.chunks_embedded}/{job.chunks_total}";
+            case "inserting":
+                return "Salvataggio in memoria...";
+            default:
+                return "Ingest in corso...";
+        }
+    }
+
+    private void CancelRunningIngestJob()
+    {
+        if (string.IsNullOrEmpty(setupMemoryIngestJobId) || servicesConfig == null)
+        {
+            return;
+        }
+
+        string url = BuildServiceUrl(servicesConfig.ragBaseUrl, $"ingest_jobs/{UnityWebRequest.EscapeURL(setupMemoryIngestJobId)}/cancel");
+        setupMemoryIngestJobId = null;
+        var request = new UnityWebRequest(url, UnityWebRequest.kHttpVerbPOST)
+        {
+            downloadHandler = new DownloadHandlerBuffer()
+        };
+        request.timeout = GetRequestTimeoutSeconds();
+        request.SendWebRequest().completed += _ => request.Dispose();
+    }
+
     private IEnumerator DescribeImageRoutine(int routineToken)
     {
         try
@@ -6558,6 +6674,8 @@ public class UIFlowController : MonoBehaviour
             setupMemoryRequest.Dispose();
             setupMemoryRequest = null;
         }
+
+        CancelRunningIngestJob();
     }
 
     private void ResetMainModeConversationSession()
@@ -12364,11 +12482,20 @@ public class UIFlowController : MonoBehaviour
     }
 
     [System.Serializable]
-    private class IngestResponse
+    private class IngestJobResponse
     {
         public bool ok;
+        public string job_id;
         public string filename;
+        public string status;
+        public string stage;
+        public int pages_total;
+        public int pages_done;
+        public int chunks_total;
+        public int chunks_embedded;
         public int chunks_added;
+        public bool dedup;
+        public string error;
     }
 
     [System.Serializable]
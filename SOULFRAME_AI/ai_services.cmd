@@ -41,6 +41,7 @@ set "WHISPER_PORT=8001"
 set "RAG_PORT=8002"
 set "TTS_PORT=8004"
 set "AVATAR_ASSET_PORT=8003"
+set "VOICE_GATEWAY_PORT=8005"
 set "OLLAMA_PORT=11434"
 set "BUILD_PORT=8000"
 
@@ -245,6 +246,7 @@ call :START_WHISPER_HIDDEN
 call :START_RAG_HIDDEN
 call :START_TTS_HIDDEN
 call :START_AVATAR_HIDDEN
+call :START_VOICE_GATEWAY_HIDDEN
 call :START_FRONTEND_HIDDEN
 call :PRINT_FULL_URLS
 exit /b 0
@@ -266,6 +268,7 @@ call :START_WHISPER_WINDOW
 call :START_RAG_WINDOW
 call :START_TTS_WINDOW
 call :START_AVATAR_WINDOW
+call :START_VOICE_GATEWAY_WINDOW
 call :START_FRONTEND_WINDOW
 call :PRINT_FULL_URLS
 call :OPEN_WEB_PAGE_DELAYED
@@ -294,6 +297,7 @@ echo    Whisper: http://127.0.0.1:%WHISPER_PORT%/docs
 echo    RAG:      http://127.0.0.1:%RAG_PORT%/docs
 echo    TTS:      http://127.0.0.1:%TTS_PORT%/docs    (health: /health)
 echo    Avatar:   http://127.0.0.1:%AVATAR_ASSET_PORT%/docs
+echo    Voice:    http://127.0.0.1:%VOICE_GATEWAY_PORT%/docs
 if /I "%FRONTEND_MODE%"=="WEBGL" (
   echo    Frontend: WebGL su http://127.0.0.1:%BUILD_PORT%
 ) else (
@@ -309,6 +313,7 @@ call :SHOW_PORT_STATUS "Whisper" %WHISPER_PORT%
 call :SHOW_PORT_STATUS "RAG" %RAG_PORT%
 call :SHOW_PORT_STATUS "Avatar" %AVATAR_ASSET_PORT%
 call :SHOW_PORT_STATUS "TTS" %TTS_PORT%
+call :SHOW_PORT_STATUS "Voice" %VOICE_GATEWAY_PORT%
 call :SHOW_PORT_STATUS "Ollama" %OLLAMA_PORT%
 exit /b 0
 
@@ -375,7 +380,7 @@ exit /b 0
 title SOULFRAME AI Services - Stop
 echo.
 echo Stop servizi...
-for %%P in (%WHISPER_PORT% %RAG_PORT% %TTS_PORT% %AVATAR_ASSET_PORT% %BUILD_PORT%) do (
+for %%P in (%WHISPER_PORT% %RAG_PORT% %TTS_PORT% %AVATAR_ASSET_PORT% %VOICE_GATEWAY_PORT% %BUILD_PORT%) do (
   for /f "tokens=5" %%p in ('netstat -ano ^| findstr /R /C:":%%P .*LISTENING" /C:":%%P .*IN ASCOLTO"') do (
     set "STOP_PID=%%p"
     set "STOP_PN="
@@ -395,6 +400,7 @@ taskkill /FI "WINDOWTITLE eq SOULFRAME_WHISPER*" /F /T >nul 2>&1
 taskkill /FI "WINDOWTITLE eq SOULFRAME_RAG*" /F /T >nul 2>&1
 taskkill /FI "WINDOWTITLE eq SOULFRAME_TTS*" /F /T >nul 2>&1
 taskkill /FI "WINDOWTITLE eq SOULFRAME_AVATAR_ASSET*" /F /T >nul 2>&1
+taskkill /FI "WINDOWTITLE eq SOULFRAME_VOICE_GATEWAY*" /F /T >nul 2>&1
 taskkill /FI "WINDOWTITLE eq SOULFRAME_OLLAMA*" /F /T >nul 2>&1
 
 for /f "tokens=5" %%p in ('netstat -ano ^| findstr /R /C:":%OLLAMA_PORT% .*LISTENING" /C:":%OLLAMA_PORT% .*IN ASCOLTO"') do (
@@ -436,6 +442,7 @@ if defined HOME_SUMMARY_PENDING (
   if defined HOME_MSG_RAG echo !HOME_MSG_RAG!
   if defined HOME_MSG_TTS echo !HOME_MSG_TTS!
   if defined HOME_MSG_AVATAR echo !HOME_MSG_AVATAR!
+  if defined HOME_MSG_VOICE echo !HOME_MSG_VOICE!
   if defined HOME_MSG_BUILD_1 echo.
   if defined HOME_MSG_BUILD_1 echo !HOME_MSG_BUILD_1!
   if defined HOME_MSG_BUILD_2 echo !HOME_MSG_BUILD_2!
@@ -445,6 +452,7 @@ if defined HOME_SUMMARY_PENDING (
     echo    RAG:      http://127.0.0.1:%RAG_PORT%/docs
     echo    TTS:      http://127.0.0.1:%TTS_PORT%/docs    ^(health: /health^)
     echo    Avatar:   http://127.0.0.1:%AVATAR_ASSET_PORT%/docs
+    echo    Voice:    http://127.0.0.1:%VOICE_GATEWAY_PORT%/docs
   )
   echo ------------------------------------------------------------
   call :RESET_HOME_SUMMARY
@@ -476,6 +484,7 @@ set "HOME_MSG_WHISPER="
 set "HOME_MSG_RAG="
 set "HOME_MSG_TTS="
 set "HOME_MSG_AVATAR="
+set "HOME_MSG_VOICE="
 set "HOME_MSG_BUILD_1="
 set "HOME_MSG_BUILD_2="
 set "HOME_SERVICES_URLS="
@@ -628,6 +637,28 @@ if "!LISTENING!"=="1" (
 )
 exit /b 0
 
+:START_VOICE_GATEWAY_HIDDEN
+call :PORT_IS_LISTENING %VOICE_GATEWAY_PORT%
+if "!LISTENING!"=="1" (
+  echo    Voice Gateway gia' attivo su %VOICE_GATEWAY_PORT%
+  set "HOME_MSG_VOICE=   Voice Gateway gia' attivo su %VOICE_GATEWAY_PORT%"
+) else (
+  echo    Avvio Voice Gateway...
+  set "HOME_MSG_VOICE=   Avvio Voice Gateway..."
+  call :START_HIDDEN_PROCESS "%BACKEND%" "%PY%" "-m uvicorn voice_gateway_server:app --host 127.0.0.1 --port %VOICE_GATEWAY_PORT% --log-level info --no-use-colors"
+)
+exit /b 0
+
+:START_VOICE_GATEWAY_WINDOW
+if /I not "%SERVICE_MODE%"=="BACKGROUND" exit /b 0
+call :PORT_IS_LISTENING %VOICE_GATEWAY_PORT%
+if "!LISTENING!"=="1" (
+  echo    Voice Gateway gia' attivo su %VOICE_GATEWAY_PORT%
+) else (
+  call :START_WINDOW_PROCESS "SOULFRAME_VOICE_GATEWAY" "%BACKEND%" "%PY%" "-m uvicorn voice_gateway_server:app --host 127.0.0.1 --port %VOICE_GATEWAY_PORT% --log-level info --no-use-colors"
+)
+exit /b 0
+
 :START_BUILD_HIDDEN
 echo.
 echo Avvio Build Server...
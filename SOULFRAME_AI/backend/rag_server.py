@@ -3,7 +3,7 @@ SOULFRAME - RAG Server (FastAPI)
 
 Cosa fa:
 - Memoria per avatar con ChromaDB (persistente, per-avatar DB)
-- Embedding via Ollama (/api/embed)
+- Embedding via Ollama (/api/embed) con cache persistente (LRU in memoria + SQLite su disco)
 - Chat via Ollama (/api/chat) con RAG retrieval e deduplicazione
 - Log conversazioni per avatar/sessione MainMode su file .log persistenti
 - Ingest di file: PDF (con OCR sempre attivo), immagini (OCR), testo
@@ -11,7 +11,7 @@ Cosa fa:
 - Pulizia testo intelligente e rimozione garbage
 - Gestione lock/handle Windows con stop system Chroma
 - Endpoint di salute e clear avatar (soft/hard)
-- Ricerca ibrida: BM25 keyword matching + vector similarity (60/40)
+- Ricerca ibrida: BM25 keyword matching + vector similarity (60/40), BM25 su indice lessicale persistente per avatar
 - Linearizzazione testo tabelle per semantic similarity migliore
 - Debug endpoint per test OCR su singole pagine PDF
 
@@ -20,8 +20,10 @@ Endpoints principali:
 - POST /remember: salva un testo con embedding
 - POST /recall: ritrova documenti (ricerca ibrida BM25+semantic)
 - POST /chat: chat con context RAG e hybrid search
+- POST /chat_stream: come /chat ma con token in streaming (NDJSON o SSE) e risposta finale riparata
 - POST /chat_session/start: apre una sessione conversazione e crea il file log
-- POST /ingest_file: importa PDF/immagini/testo con deduplicazione
+- POST /ingest_file: accoda l'import di PDF/immagini/testo (con deduplicazione) e restituisce un job_id
+- GET /ingest_jobs/{id}: avanzamento del job (pagine, chunk, errori); POST /ingest_jobs/{id}/cancel lo annulla
 - POST /describe_image: descrizione con Gemini Vision
 - POST /clear_avatar: cancella memoria di un avatar (soft/hard)
 - POST /clear_avatar_logs: cancella solo la cartella log di un avatar
@@ -30,7 +32,7 @@ Endpoints principali:
 Note pratiche:
 - PDF: usa sempre OCR (400 DPI di default) - testo embedded spesso corrotto
 - Tabelle OCR: linearizzate per miglior embedding semantico
-- Deduplicazione: rimuove chunk duplicati (similarity > 92%) durante ingest e recall
+- Deduplicazione: rimuove chunk duplicati (similarity > 92%, shingle di parole + MinHash/LSH sul corpus) durante ingest e recall
 - Garbage filtering: scarta solo testo REALMENTE vuoto/inutile, lascia decision all'LLM
 - Ricerca ibrida: 60% BM25 (keyword), 40% vector (semantic) - piu' match su parole chiave
 - Windows: gestisce lock file Chroma tramite stop system e rmtree robusto
@@ -44,24 +46,40 @@ import os
 import re
 import io
 import json
+import math
 import difflib
+import hashlib
+import sqlite3
 import uuid
+import zlib
 import time
+from array import array
 from functools import lru_cache
-from collections import deque
-from dataclasses import dataclass
+from collections import OrderedDict, deque
+from dataclasses import dataclass, replace as dataclass_replace
 from datetime import datetime
 import gc
 import stat
 import shutil
 import threading
 import traceback
-from typing import Any, Optional, List, Tuple, Sequence, TYPE_CHECKING, cast
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Any, Callable, Iterator, Optional, List, Tuple, Sequence, TYPE_CHECKING, Union, cast
 
 import requests
 import chromadb
+import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from rank_bm25 import BM25Okapi
 from pydantic import BaseModel
 
@@ -90,6 +108,10 @@ try:
     import pytesseract
 except Exception:
     pytesseract = None  # type: ignore
+try:
+    import tesserocr  # opzionale: API Tesseract in-process, niente subprocess per pagina
+except Exception:
+    tesserocr = None  # type: ignore
 
 # PyMuPDF4LLM: pymupdf-layout ha un bug ONNX noto (int32 vs int64) che causa crash
 # su PDF reali -> NON importare pymupdf.layout; pymupdf4llm funziona in legacy mode.
@@ -165,19 +187,164 @@ FACTUAL_MAX_CONTEXT_CHARS = int(os.getenv("RAG_FACTUAL_MAX_CONTEXT_CHARS", "3600
 RAG_FACTUAL_SCORE_MIN = float(os.getenv("RAG_FACTUAL_SCORE_MIN", "0.52"))
 RAG_FACTUAL_SCORE_GAP_MIN = float(os.getenv("RAG_FACTUAL_SCORE_GAP_MIN", "0.14"))
 RAG_SESSION_TURNS = int(os.getenv("RAG_SESSION_TURNS", "8"))
+# Riassunto incrementale della sessione: i turni fuori dalla finestra raw (ultimi RAG_SESSION_RAW_TURNS)
+# vengono condensati in background in un riassunto per sessione, a blocchi di RAG_SESSION_RAW_TURNS turni;
+# i prompt ricevono riassunto + turni non ancora riassunti. Su CPU conviene un modello piccolo per lo stage
+# (RAG_STAGE_SESSION_SUMMARY_MODEL), altrimenti il riassunto usa CHAT_MODEL.
+RAG_SESSION_SUMMARY = _env_bool("RAG_SESSION_SUMMARY", True)
+RAG_SESSION_RAW_TURNS = max(1, int(os.getenv("RAG_SESSION_RAW_TURNS", "3")))
+RAG_SESSION_SUMMARY_MAX_CHARS = max(200, int(os.getenv("RAG_SESSION_SUMMARY_MAX_CHARS", "900")))
 RAG_CHAT_TOP_K_CAP = int(os.getenv("RAG_CHAT_TOP_K_CAP", "8"))
+# Budget di latenza per /chat (ms, 0 = illimitato; sovrascrivibile con latency_budget_ms nella richiesta).
+# Gli stage LLM opzionali (router, rewrite, retry, repair, coverage) vengono saltati se la loro
+# media mobile non sta nel tempo residuo; i timeout HTTP sono limitati al residuo.
+RAG_CHAT_LATENCY_BUDGET_MS = max(0, int(os.getenv("RAG_CHAT_LATENCY_BUDGET_MS", "0")))
+# Layout del prompt con prefisso stabile: il system contiene solo persona e regole fisse (uguale a ogni
+# turno dello stesso avatar), mentre modalita', hint e contesti recuperati vanno in coda nel messaggio
+# utente. Ollama puo' cosi' riusare la KV cache del prefisso tra un turno e l'altro.
+RAG_PROMPT_STABLE_PREFIX = _env_bool("RAG_PROMPT_STABLE_PREFIX", True)
+# keep_alive delle chiamate chat quando il profilo dello stage non lo imposta (vuoto = default Ollama).
+RAG_PROMPT_KEEP_ALIVE = os.getenv("RAG_PROMPT_KEEP_ALIVE", "30m").strip()
+# Budget in token del prompt di generazione: num_ctx viene diviso tra system, storico, memoria factual
+# e riserva per la risposta (num_predict). Sostituisce i limiti in caratteri del contesto factual.
+RAG_TOKEN_BUDGET = _env_bool("RAG_TOKEN_BUDGET", True)
+# num_ctx inviato alle chiamate chat senza num_ctx nel profilo (stesso valore per tutti gli stage:
+# un num_ctx diverso sullo stesso modello costringe Ollama a ricaricarlo).
+RAG_CHAT_NUM_CTX = max(512, int(os.getenv("RAG_CHAT_NUM_CTX", "4096")))
+# Quota massima dello spazio libero riservata allo storico; il resto (e l'avanzo) va alla memoria factual.
+RAG_CTX_HISTORY_SHARE = max(0.0, min(0.9, float(os.getenv("RAG_CTX_HISTORY_SHARE", "0.25"))))
+# Indice lessicale BM25 persistente per avatar (file SQLite accanto al DB Chroma).
+RAG_LEXICAL_INDEX = _env_bool("RAG_LEXICAL_INDEX", True)
+# Scarta in /ingest_file e /remember i chunk quasi identici a memorie gia' presenti (MinHash + verifica).
+RAG_INGEST_DEDUPE = _env_bool("RAG_INGEST_DEDUPE", True)
+# /ingest_file: stesso sha256 gia' presente -> job chiuso subito (dedup); stesso nome file con
+# contenuto diverso -> si sostituiscono solo i chunk cambiati.
+RAG_INGEST_FILE_DEDUPE = _env_bool("RAG_INGEST_FILE_DEDUPE", True)
+# Ingest in background: upload salvato nello spool, estrazione/embedding/insert su worker dedicati.
+RAG_INGEST_WORKERS = max(1, int(os.getenv("RAG_INGEST_WORKERS", "1")))
+RAG_INGEST_SPOOL_DIR = os.path.abspath(os.getenv("RAG_INGEST_SPOOL_DIR", os.path.join(PERSIST_ROOT, "_ingest_spool")))
+RAG_INGEST_JOBS_KEEP = max(1, int(os.getenv("RAG_INGEST_JOBS_KEEP", "200")))
+# Pipeline embedding -> insert: fino a N batch in volo per job, il batch pronto va in Chroma mentre
+# gli altri sono ancora in embedding. Dimensione batch adattata per stare vicino a TARGET_MS.
+RAG_INGEST_EMBED_CONCURRENCY = max(1, int(os.getenv("RAG_INGEST_EMBED_CONCURRENCY", "2")))
+RAG_INGEST_EMBED_BATCH_MIN = max(1, int(os.getenv("RAG_INGEST_EMBED_BATCH_MIN", "8")))
+RAG_INGEST_EMBED_BATCH_MAX = max(RAG_INGEST_EMBED_BATCH_MIN, int(os.getenv("RAG_INGEST_EMBED_BATCH_MAX", "64")))
+RAG_INGEST_EMBED_TARGET_MS = max(100.0, float(os.getenv("RAG_INGEST_EMBED_TARGET_MS", "1500")))
+# Upload copiati su disco a blocchi (mai interi in RAM); oltre il limite -> 413, gia' dal Content-Length.
+RAG_UPLOAD_MAX_BYTES = max(1, int(float(os.getenv("RAG_UPLOAD_MAX_MB", "100")) * 1024 * 1024))
+RAG_UPLOAD_CHUNK_BYTES = 1024 * 1024
+# Candidati vettoriali caricati una volta per embedding e riusati dalle probe filtrate (0 = disattivo).
+RAG_CANDIDATE_POOL_SIZE = max(0, int(os.getenv("RAG_CANDIDATE_POOL_SIZE", "64")))
+# Probe di retrieval indipendenti (stesso embedding) in parallelo su un pool limitato; 0 = in serie.
+RAG_PARALLEL_PROBES = _env_bool("RAG_PARALLEL_PROBES", True)
+RAG_PROBE_WORKERS = max(1, int(os.getenv("RAG_PROBE_WORKERS", "4")))
 RAG_INTENT_ROUTER_NUM_PREDICT = int(os.getenv("RAG_INTENT_ROUTER_NUM_PREDICT", "32"))
 RAG_INTENT_CONFIDENCE_MIN = float(os.getenv("RAG_INTENT_CONFIDENCE_MIN", "0.58"))
+RAG_INTENT_CLASSIFIER = _env_bool("RAG_INTENT_CLASSIFIER", True)
+RAG_INTENT_CLASSIFIER_TEMPERATURE = max(0.005, float(os.getenv("RAG_INTENT_CLASSIFIER_TEMPERATURE", "0.05")))
+# File di log (separati da os.pathsep) con righe [CHAT_QUALITY] usati come esempi extra per il classificatore.
+RAG_INTENT_TRAIN_LOGS = [p for p in os.getenv("RAG_INTENT_TRAIN_LOGS", "").split(os.pathsep) if p.strip()]
+RAG_INTENT_TRAIN_LOG_MAX_PER_INTENT = max(0, int(os.getenv("RAG_INTENT_TRAIN_LOG_MAX_PER_INTENT", "200")))
 RAG_QUERY_REWRITE_MAX_TOKENS = int(os.getenv("RAG_QUERY_REWRITE_MAX_TOKENS", "7"))
 RAG_ENABLE_QUERY_REWRITE = _env_bool("RAG_ENABLE_QUERY_REWRITE", True)
 RAG_GROUNDING_SCORE_MIN = float(os.getenv("RAG_GROUNDING_SCORE_MIN", "0.48"))
 RAG_ENFORCE_GROUNDED = _env_bool("RAG_ENFORCE_GROUNDED", True)
 
+# Cache embedding (LRU in memoria + SQLite su disco, chiave = modello + hash testo normalizzato)
+RAG_EMBED_CACHE_ENABLED = _env_bool("RAG_EMBED_CACHE_ENABLED", True)
+RAG_EMBED_CACHE_MEM_ITEMS = int(os.getenv("RAG_EMBED_CACHE_MEM_ITEMS", "4096"))
+RAG_EMBED_CACHE_PATH = os.getenv("RAG_EMBED_CACHE_PATH", os.path.join(PERSIST_ROOT, "_embed_cache.sqlite3"))
+RAG_EMBED_CACHE_PATH = os.path.abspath(os.path.normpath(RAG_EMBED_CACHE_PATH.strip().strip('"')))
+# Righe massime del tier su disco (0 = nessun limite); oltre si tolgono le meno recenti.
+RAG_EMBED_CACHE_MAX_ROWS = max(0, int(os.getenv("RAG_EMBED_CACHE_MAX_ROWS", "20000")))
+# Micro-batching degli embedding tra richieste concorrenti: le richieste piccole arrivate entro
+# RAG_EMBED_BATCH_WINDOW_MS vanno in un'unica /api/embed (0 = disattivo).
+RAG_EMBED_BATCH_WINDOW_MS = max(0.0, float(os.getenv("RAG_EMBED_BATCH_WINDOW_MS", "4")))
+RAG_EMBED_BATCH_MAX_INPUTS = max(1, int(os.getenv("RAG_EMBED_BATCH_MAX_INPUTS", "32")))
+RAG_EMBED_BATCH_DEADLINE_S = max(1.0, float(os.getenv("RAG_EMBED_BATCH_DEADLINE_S", "190")))
+
+# Client HTTP condiviso verso Ollama (pool keep-alive + timeout per stage)
+RAG_OLLAMA_POOL_SIZE = int(os.getenv("RAG_OLLAMA_POOL_SIZE", "16"))
+RAG_OLLAMA_POOL_BLOCK = _env_bool("RAG_OLLAMA_POOL_BLOCK", False)
+RAG_OLLAMA_KEEPALIVE = _env_bool("RAG_OLLAMA_KEEPALIVE", True)
+RAG_OLLAMA_CONNECT_TIMEOUT = float(os.getenv("RAG_OLLAMA_CONNECT_TIMEOUT", "5"))
+RAG_OLLAMA_CONNECT_RETRIES = int(os.getenv("RAG_OLLAMA_CONNECT_RETRIES", "1"))
+_OLLAMA_STAGES = (
+    "router", "query_rewrite", "generate", "identity_retry", "guardrail_rewrite",
+    "coverage_retry", "definition", "session_summary", "embed", "warmup",
+)
+# Override opzionale del read timeout per stage: RAG_OLLAMA_TIMEOUT_<STAGE> (secondi)
+_OLLAMA_STAGE_TIMEOUTS: dict[str, float] = {
+    stage: float(os.environ[f"RAG_OLLAMA_TIMEOUT_{stage.upper()}"])
+    for stage in _OLLAMA_STAGES
+    if os.getenv(f"RAG_OLLAMA_TIMEOUT_{stage.upper()}", "").strip()
+}
+# Profili per stage (modello, num_ctx, num_predict, temperature, keep_alive) per le chiamate /api/chat.
+# Sorgenti in ordine di priorita': RAG_STAGE_<STAGE>_<CAMPO> > file JSON RAG_STAGE_PROFILES_FILE
+# ({"router": {"model": "llama3.2:1b", "num_ctx": 2048}, ...}) > default globali CHAT_*.
+# num_predict del profilo e' un tetto: i num_predict_override dei chiamanti restano validi se piu' bassi.
+RAG_STAGE_PROFILES_FILE = os.getenv("RAG_STAGE_PROFILES_FILE", "").strip().strip('"')
+_STAGE_PROFILE_FIELDS: dict[str, Callable[[Any], Any]] = {
+    "model": lambda v: str(v).strip(),
+    "num_ctx": int,
+    "num_predict": int,
+    "temperature": float,
+    "keep_alive": lambda v: str(v).strip(),
+}
+
+def _load_stage_profiles() -> dict[str, dict[str, Any]]:
+    raw: dict[str, Any] = {}
+    if RAG_STAGE_PROFILES_FILE:
+        try:
+            with open(RAG_STAGE_PROFILES_FILE, "r", encoding="utf-8") as fh:
+                loaded = json.load(fh)
+            if isinstance(loaded, dict):
+                raw = loaded
+            else:
+                print(f"[WARN] RAG_STAGE_PROFILES_FILE ignorato: atteso un oggetto JSON ({RAG_STAGE_PROFILES_FILE})", flush=True)
+        except Exception as exc:
+            print(f"[WARN] RAG_STAGE_PROFILES_FILE non leggibile ({RAG_STAGE_PROFILES_FILE}): {exc}", flush=True)
+    profiles: dict[str, dict[str, Any]] = {}
+    for stage in _OLLAMA_STAGES:
+        if stage == "embed":
+            continue
+        merged = dict(raw.get(stage) or {}) if isinstance(raw.get(stage), dict) else {}
+        for field in _STAGE_PROFILE_FIELDS:
+            env_value = os.getenv(f"RAG_STAGE_{stage.upper()}_{field.upper()}", "").strip()
+            if env_value:
+                merged[field] = env_value
+        profile: dict[str, Any] = {}
+        for field, cast in _STAGE_PROFILE_FIELDS.items():
+            if merged.get(field) in (None, ""):
+                continue
+            try:
+                profile[field] = cast(merged[field])
+            except (TypeError, ValueError):
+                print(f"[WARN] Profilo stage {stage}: valore non valido per {field}: {merged[field]!r}", flush=True)
+        if profile:
+            profiles[stage] = profile
+    return profiles
+
+_STAGE_PROFILES = _load_stage_profiles()
+
 # OCR / Tesseract
 RAG_OCR_LANG = os.getenv("RAG_OCR_LANG", "ita+eng").strip()          # es: "ita" oppure "ita+eng"
 TESSERACT_CMD = os.getenv("TESSERACT_CMD", "").strip().strip('"')
 DEFAULT_TESSERACT_CMD = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 OCR_DPI = int(os.getenv("RAG_OCR_DPI", "400"))  # DPI OCR predefinito per PDF/immagini
+# Disponibilita' di tesseract verificata una volta e ricontrollata dopo questo intervallo.
+RAG_OCR_RECHECK_SECONDS = max(1.0, float(os.getenv("RAG_OCR_RECHECK_SECONDS", "300")))
+# Istanze tesserocr persistenti per processo (usate solo se tesserocr e' installato).
+RAG_OCR_WORKERS = max(1, int(os.getenv("RAG_OCR_WORKERS", "2")))
+# DPI adattivo: render di prova a bassa risoluzione, stima altezza righe, DPI minimo che porta
+# le righe a ~RAG_OCR_TARGET_LINE_PX pixel (tra RAG_OCR_DPI_MIN e RAG_OCR_DPI).
+RAG_OCR_ADAPTIVE_DPI = _env_bool("RAG_OCR_ADAPTIVE_DPI", True)
+RAG_OCR_DPI_MIN = max(72, min(OCR_DPI, int(os.getenv("RAG_OCR_DPI_MIN", "200"))))
+RAG_OCR_PROBE_DPI = max(36, int(os.getenv("RAG_OCR_PROBE_DPI", "100")))
+RAG_OCR_TARGET_LINE_PX = max(12.0, float(os.getenv("RAG_OCR_TARGET_LINE_PX", "40")))
+# Estrazione PDF a range di pagine su un pool di processi (1 = tutto nel processo del server).
+RAG_PDF_WORKERS = max(1, int(os.getenv("RAG_PDF_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) - 1))))))
+RAG_PDF_PAGES_PER_TASK = max(1, int(os.getenv("RAG_PDF_PAGES_PER_TASK", "4")))
 
 # TESSDATA_PREFIX: pymupdf4llm (layout mode) richiede questa env per trovare i dati Tesseract.
 # Se non impostata, la settiamo al percorso standard (Windows).
@@ -645,6 +812,31 @@ def _token_set(text: str) -> set[str]:
             tokens.append(tok)
     return {t for t in tokens if len(t) >= 3 and not t.isdigit()}
 
+# Feature lessicali per chunk salvate nei metadata all'ingest (chiavi "_lex_*", escluse da rag_used).
+# Bump della versione = ricalcolo con `python rag_server.py backfill_lexical`.
+_LEXICAL_FEATURES_VERSION = 1
+
+def _has_lexical_features(doc: str, meta: Optional[dict]) -> bool:
+    """True se meta porta feature calcolate su questo stesso testo (non su una sua frase)."""
+    m = meta or {}
+    return m.get("_lex_v") == _LEXICAL_FEATURES_VERSION and m.get("_lex_chars") == len(doc or "")
+
+def _doc_token_set(doc: str, meta: Optional[dict] = None) -> frozenset[str]:
+    if _has_lexical_features(doc, meta):
+        stored = (meta or {}).get("_lex_tokens")
+        if isinstance(stored, str):
+            return frozenset(stored.split())
+    return frozenset(_token_set(doc))
+
+@lru_cache(maxsize=512)
+def _query_token_set(query: str) -> frozenset[str]:
+    return frozenset(_token_set(query))
+
+@lru_cache(maxsize=4096)
+def _filename_token_set(raw_filename: str) -> frozenset[str]:
+    filename = clean_text(raw_filename or "").lower()
+    return frozenset(_token_set(filename)) if filename else frozenset()
+
 _ALLOWED_CHAT_INTENTS = {"chitchat", "session_recap", "memory_recap", "memory_qna", "creative_open"}
 
 @dataclass(frozen=True)
@@ -673,6 +865,7 @@ class QueryPlan:
     source_preference: str = "any"
     wants_multi_source_coverage: bool = False
     topical_terms: tuple[str, ...] = ()
+    intent_source: str = "plan"  # plan | classifier | router | fallback
 
 @lru_cache(maxsize=4096)
 
@@ -888,7 +1081,7 @@ def _filename_overlap_boost(query: str, meta: dict) -> float:
     filename = clean_text(str((meta or {}).get("source_filename") or "")).lower()
     if not filename:
         return 0.0
-    q_tokens = _token_set(query)
+    q_tokens = _query_token_set(query)
     if not q_tokens:
         return 0.0
     hit = sum(1 for tok in q_tokens if len(tok) >= 4 and tok in filename)
@@ -896,21 +1089,19 @@ def _filename_overlap_boost(query: str, meta: dict) -> float:
         return 0.0
     return min(0.18, 0.06 * hit)
 
-def _reference_content_tokens(query: str) -> set[str]:
-    return {
-        tok for tok in _token_set(query)
+@lru_cache(maxsize=512)
+def _reference_content_tokens(query: str) -> frozenset[str]:
+    return frozenset(
+        tok for tok in _query_token_set(query)
         if len(tok) >= 4 and tok not in _REFERENCE_QUERY_STOPWORDS
-    }
+    )
 
 def _reference_overlap_ratio(query: str, doc: str, meta: Optional[dict] = None) -> float:
     q_tokens = _reference_content_tokens(query)
     if not q_tokens:
         return 0.0
 
-    support_tokens = _token_set(doc)
-    filename = clean_text(str((meta or {}).get("source_filename") or "")).lower()
-    if filename:
-        support_tokens |= _token_set(filename)
+    support_tokens = _doc_token_set(doc, meta) | _filename_token_set(str((meta or {}).get("source_filename") or ""))
     if not support_tokens:
         return 0.0
 
@@ -932,7 +1123,7 @@ def _has_reference_evidence(
     if filename_boost >= 0.06:
         return True
 
-    if allow_lexical_only and _lexical_overlap_ratio(query, doc) >= 0.18:
+    if allow_lexical_only and _lexical_overlap_ratio(query, doc, meta) >= 0.18:
         return True
 
     return False
@@ -941,6 +1132,8 @@ def _external_chunk_noise_penalty(doc: str, meta: Optional[dict]) -> float:
     source_type = _src_type(meta)
     if source_type not in _EXTERNAL_MEMORY_SOURCE_TYPES:
         return 0.0
+    if _has_lexical_features(doc, meta) and isinstance((meta or {}).get("_lex_noise"), (int, float)):
+        return float((meta or {})["_lex_noise"])
 
     txt = clean_text(doc or "").lower()
     if not txt:
@@ -963,6 +1156,23 @@ def _external_chunk_noise_penalty(doc: str, meta: Optional[dict]) -> float:
 
     return min(0.16, penalty)
 
+def _lexical_features(doc: str, meta: Optional[dict]) -> dict:
+    """Feature da salvare nei metadata del chunk; memory_subject/memory_role solo se mancanti."""
+    safe_meta = dict(meta or {})
+    text = doc if isinstance(doc, str) else ""
+    noise_meta = dict(safe_meta, _lex_v=None)
+    features: dict[str, Any] = {
+        "_lex_v": _LEXICAL_FEATURES_VERSION,
+        "_lex_chars": len(text),
+        "_lex_tokens": " ".join(sorted(_token_set(text))),
+        "_lex_noise": round(float(_external_chunk_noise_penalty(text, noise_meta)), 6),
+    }
+    if not _normalize_memory_subject(safe_meta.get("memory_subject")):
+        features["memory_subject"] = _effective_memory_subject(text, safe_meta)
+    if not safe_meta.get("memory_role"):
+        features["memory_role"] = _memory_role_for_text(text)
+    return features
+
 def _rank_external_probe_hits(
     col: Any,
     query: str,
@@ -982,7 +1192,7 @@ def _rank_external_probe_hits(
 
     boosted: list[tuple[float, str, dict]] = []
     for score, doc, meta in ranked:
-        lexical = _lexical_overlap_ratio(query, doc)
+        lexical = _lexical_overlap_ratio(query, doc, meta)
         filename_boost = _filename_overlap_boost(query, meta or {})
         content_overlap = _reference_overlap_ratio(query, doc, meta)
         penalty = _external_chunk_noise_penalty(doc, meta)
@@ -1046,12 +1256,19 @@ def _rank_source_probe_hits(
 
     if _reference_content_tokens(query) and not plan.visual_query:
         try:
-            raw_files = col.get(
-                where={"source_type": "file"},
-                include=["documents", "metadatas"],
-                limit=max(512, top_k * 256),
-                offset=0,
-            )
+            file_limit = max(512, top_k * 256)
+            index = _lexical_index_for(col)
+            if index is not None:
+                # Solo i chunk dei file il cui nome supera la soglia di boost sotto, invece di una scan.
+                file_ids = index.ids_for_matching_filenames(query, "file", min_boost=0.06, limit=file_limit)
+                raw_files = col.get(ids=file_ids, include=["documents", "metadatas"]) if file_ids else {}
+            else:
+                raw_files = col.get(
+                    where={"source_type": "file"},
+                    include=["documents", "metadatas"],
+                    limit=file_limit,
+                    offset=0,
+                )
             file_docs = raw_files.get("documents") or []
             file_metas = raw_files.get("metadatas") or []
             for doc, meta in zip(file_docs, file_metas):
@@ -1065,7 +1282,7 @@ def _rank_source_probe_hits(
                 if key in seen_keys:
                     continue
                 seen_keys.add(key)
-                lexical = _lexical_overlap_ratio(query, doc)
+                lexical = _lexical_overlap_ratio(query, doc, safe_meta)
                 ref_overlap = _reference_overlap_ratio(query, doc, safe_meta)
                 boosted_score = min(
                     1.0,
@@ -1099,7 +1316,7 @@ def _rerank_reference_hits(
     for score, doc, meta in ranked_hits:
         safe_meta = dict(meta or {})
         source_type = _src_type(safe_meta)
-        lexical = _lexical_overlap_ratio(query, doc)
+        lexical = _lexical_overlap_ratio(query, doc, safe_meta)
         ref_overlap = _reference_overlap_ratio(query, doc, safe_meta)
         filename_boost = _filename_overlap_boost(query, safe_meta)
         filename_signal = min(1.0, filename_boost / 0.18) if filename_boost > 0.0 else 0.0
@@ -1245,7 +1462,7 @@ def _boost_profile_memory_hits(
         subject = _effective_memory_subject(doc, meta)
         if not _profile_subject_matches_target(subject, target):
             continue
-        lexical = _lexical_overlap_ratio(query, doc)
+        lexical = _lexical_overlap_ratio(query, doc, meta)
         boosted = min(1.0, max(score, 0.30) + 0.22 + min(0.08, lexical))
         safe_meta = _annotate_memory_subject(meta, doc)
         safe_meta["_hybrid_score"] = round(float(boosted), 6)
@@ -1289,7 +1506,7 @@ def _boost_definition_profile_hits(
             continue
 
         ref_overlap = _reference_overlap_ratio(query, doc, safe_meta)
-        lexical = _lexical_overlap_ratio(query, doc)
+        lexical = _lexical_overlap_ratio(query, doc, safe_meta)
         if ref_overlap <= 0.0 and lexical < 0.12:
             continue
 
@@ -1522,6 +1739,7 @@ def _rewrite_query_for_memory_retrieval(query: str, recent_conversation: str) ->
             ],
             timeout=18,
             num_predict_override=64,
+            stage="query_rewrite",
         ).strip()
         obj = _extract_first_json_object(raw)
         if obj:
@@ -1585,16 +1803,48 @@ def _build_chat_quality_metrics(
         "contradiction_detected": contradiction,
     }
 
-def _lexical_overlap_ratio(query: str, doc: str) -> float:
-    q_tokens = _token_set(query)
+def _lexical_overlap_ratio(query: str, doc: str, meta: Optional[dict] = None) -> float:
+    q_tokens = _query_token_set(query)
     if not q_tokens:
         return 0.0
-    d_tokens = _token_set(doc)
+    d_tokens = _doc_token_set(doc, meta)
     if not d_tokens:
         return 0.0
     overlap = len(q_tokens & d_tokens)
     return float(overlap) / float(len(q_tokens))
 
+_TOKEN_PIECE_RE = re.compile(r"[^\W\d_]+|\d+|[^\w\s]|\n")
+
+def _estimate_tokens(text: str) -> int:
+    """
+    Stima veloce dei token BPE del modello chat (famiglia llama3) senza tokenizer:
+    parole ~4 caratteri per token, numeri a gruppi di 3 cifre, punteggiatura e a capo 1 token.
+    """
+    total = 0
+    for piece in _TOKEN_PIECE_RE.findall(text or ""):
+        if piece.isdigit():
+            total += (len(piece) + 2) // 3
+        elif piece[0].isalpha():
+            total += (len(piece) + 3) // 4
+        else:
+            total += 1
+    return total
+
+def _fit_text_to_tokens(text: str, max_tokens: int) -> str:
+    """Tronca il testo (con '...') finche' la stima dei token sta in max_tokens."""
+    estimated = _estimate_tokens(text)
+    if estimated <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    cut = int(len(text) * max_tokens / max(1, estimated))
+    while cut > 0:
+        candidate = text[:cut].rstrip() + "..."
+        if _estimate_tokens(candidate) <= max_tokens:
+            return candidate
+        cut = int(cut * 0.9)
+    return ""
+
 def _truncate_for_prompt(text: str, max_chars: int = 1800) -> str:
     cleaned = clean_text(text or "")
     if len(cleaned) <= max_chars:
@@ -1715,26 +1965,31 @@ def _answer_definition_query(
     if not factual_context:
         return None
 
-    raw_answer = ollama_chat(
-        [
-            {
-                "role": "system",
-                "content": (
-                    "Rispondi a una domanda definitoria usando solo la MEMORIA_FACTUAL. "
-                    "Sii estrattivo e rigoroso. "
-                    "Non aggiungere inferenze, esempi o dettagli non presenti. "
-                    "Non usare formule meta come 'secondo la memoria' o 'dal contesto'. "
-                    "Rispondi in massimo 2 frasi brevi."
-                ),
-            },
-            {
-                "role": "user",
-                "content": f"DOMANDA:\n{query}\n\nMEMORIA_FACTUAL:\n{factual_context}",
-            },
-        ],
-        timeout=45,
-        num_predict_override=90,
-    ).strip()
+    try:
+        raw_answer = ollama_chat(
+            [
+                {
+                    "role": "system",
+                    "content": (
+                        "Rispondi a una domanda definitoria usando solo la MEMORIA_FACTUAL. "
+                        "Sii estrattivo e rigoroso. "
+                        "Non aggiungere inferenze, esempi o dettagli non presenti. "
+                        "Non usare formule meta come 'secondo la memoria' o 'dal contesto'. "
+                        "Rispondi in massimo 2 frasi brevi."
+                    ),
+                },
+                {
+                    "role": "user",
+                    "content": f"DOMANDA:\n{query}\n\nMEMORIA_FACTUAL:\n{factual_context}",
+                },
+            ],
+            timeout=45,
+            num_predict_override=90,
+            stage="definition",
+        ).strip()
+    except _StageSkipped:
+        # Senza tempo per la definizione si passa alla generazione normale.
+        return None
     answer = _finalize_chat_answer(raw_answer) or ""
     if not answer:
         return None
@@ -1754,7 +2009,12 @@ def _answer_definition_query(
         return None
     return final_answer or None
 
+def _public_metadata(meta: Any) -> dict:
+    """Metadata senza le chiavi interne "_lex_*" (feature lessicali salvate all'ingest)."""
+    return {k: v for k, v in (meta or {}).items() if not str(k).startswith("_lex_")}
+
 def _build_recall_response(docs: List[str], metas: List[dict]) -> dict:
+    metas = [_public_metadata(m) for m in metas]
     return {
         "documents": [docs],
         "metadatas": [metas],
@@ -1883,6 +2143,7 @@ def _rewrite_answer_with_guardrails(
             ],
             timeout=timeout,
             num_predict_override=num_predict,
+            stage="guardrail_rewrite",
         ).strip()
         return _finalize_chat_answer(rewritten) or None
     except Exception:
@@ -1916,16 +2177,151 @@ def _extract_first_json_object(raw: str) -> Optional[dict]:
     except Exception:
         return None
 
-def _route_chat_intent(query: str, recent_conversation: str, has_memory: bool) -> QueryPlan:
-    plan = _build_query_plan(query)
-    if not plan.cleaned_query:
-        return plan
-    if plan.explicit_recap or _RECAP_QUERY_RE.search(plan.cleaned_query):
-        return plan
-    # Segnali forti dal plan: non rischiare che il router LLM li degradi a chitchat
-    if plan.profile_query or plan.document_query or plan.definition_query:
-        return plan
+# Esempi etichettati per il classificatore locale (nearest-centroid sugli embedding).
+_INTENT_EXEMPLARS: dict[str, tuple[str, ...]] = {
+    "chitchat": (
+        "ciao", "ciao come stai?", "buongiorno", "ehi, tutto bene?", "grazie mille",
+        "che bella giornata oggi", "come va?", "piacere di conoscerti", "buonanotte",
+        "ahah che simpatico", "ok perfetto", "sei di buon umore oggi?",
+    ),
+    "session_recap": (
+        "di cosa abbiamo parlato prima?", "cosa ci siamo detti l'ultima volta?",
+        "riassumi la nostra conversazione", "ripetimi cosa ti ho detto poco fa",
+        "cosa ti avevo chiesto prima?", "fammi un riepilogo di questa chat",
+        "di che cosa stavamo parlando?", "cosa mi hai risposto prima?",
+    ),
+    "memory_recap": (
+        "cosa ricordi di me?", "cosa hai memorizzato?", "dimmi tutto quello che sai",
+        "cosa c'e' nella tua memoria?", "elenca i ricordi che hai salvato",
+        "quali documenti hai letto?", "riassumi cosa sai di me", "che informazioni hai su di me?",
+    ),
+    "memory_qna": (
+        "dove vivo?", "come si chiama il mio cane?", "qual e' il mio lavoro?",
+        "quando e' il mio compleanno?", "cosa diceva il documento sul progetto?",
+        "qual e' il tuo colore preferito?", "chi e' mia sorella?", "in che anno mi sono laureato?",
+        "cosa c'era scritto nel pdf sulla garanzia?",
+    ),
+    "creative_open": (
+        "scrivimi una poesia sul mare", "inventa una storia breve", "raccontami una favola",
+        "dammi qualche idea per il weekend", "immagina di essere un pirata",
+        "scrivi una canzone sull'estate", "proponimi un nome per il mio gatto",
+        "descrivi un mondo fantastico",
+    ),
+}
+# Sorgenti affidabili come etichette: non riaddestrare sulle decisioni del classificatore stesso.
+_INTENT_TRAIN_LOG_SOURCES = {"router", "plan"}
+_CHAT_QUALITY_LOG_RE = re.compile(r"\[CHAT_QUALITY\]\s*(\{.*\})\s*$")
+
+_INTENT_CLASSIFIER_LOCK = threading.Lock()
+_INTENT_CENTROIDS: dict[str, Any] = {}
+_INTENT_CLASSIFIER_STATS: dict[str, int] = {"classified": 0, "router_fallbacks": 0, "no_memory_deferrals": 0, "errors": 0}
+_INTENT_CLASSIFIER_STATS_LOCK = threading.Lock()
+
+def _bump_intent_stat(name: str) -> None:
+    with _INTENT_CLASSIFIER_STATS_LOCK:
+        _INTENT_CLASSIFIER_STATS[name] += 1
+
+def _load_intent_log_samples(paths: Sequence[str]) -> dict[str, list[str]]:
+    """Coppie (intent, query) dalle righe [CHAT_QUALITY] dei log del server."""
+    samples: dict[str, list[str]] = {intent: [] for intent in _ALLOWED_CHAT_INTENTS}
+    seen: set[tuple[str, str]] = set()
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    m = _CHAT_QUALITY_LOG_RE.search(line)
+                    if not m:
+                        continue
+                    try:
+                        obj = json.loads(m.group(1))
+                    except Exception:
+                        continue
+                    intent = str(obj.get("intent", "")).strip().lower()
+                    query = clean_text(str(obj.get("query", "") or ""))
+                    if intent not in _ALLOWED_CHAT_INTENTS or not query:
+                        continue
+                    if str(obj.get("intent_source", "router")) not in _INTENT_TRAIN_LOG_SOURCES:
+                        continue
+                    if (intent, query) in seen:
+                        continue
+                    seen.add((intent, query))
+                    samples[intent].append(query)
+        except OSError as e:
+            print(f"[WARN] Log intent non leggibile {path}: {e}", flush=True)
+    return samples
+
+def _normalize_vector(vec: Sequence[float]) -> list[float]:
+    norm = sum(v * v for v in vec) ** 0.5
+    if norm <= 0.0:
+        return [0.0 for _ in vec]
+    return [v / norm for v in vec]
+
+def _intent_centroids() -> Optional[dict[str, list[float]]]:
+    """Centroidi per intent (embedding medi normalizzati); calcolati una volta per EMBED_MODEL."""
+    cached = _INTENT_CENTROIDS.get("centroids")
+    if cached is not None and _INTENT_CENTROIDS.get("model") == EMBED_MODEL:
+        return cached
+    with _INTENT_CLASSIFIER_LOCK:
+        cached = _INTENT_CENTROIDS.get("centroids")
+        if cached is not None and _INTENT_CENTROIDS.get("model") == EMBED_MODEL:
+            return cached
+
+        samples = {intent: list(texts) for intent, texts in _INTENT_EXEMPLARS.items()}
+        if RAG_INTENT_TRAIN_LOGS and RAG_INTENT_TRAIN_LOG_MAX_PER_INTENT > 0:
+            for intent, texts in _load_intent_log_samples(RAG_INTENT_TRAIN_LOGS).items():
+                samples[intent].extend(texts[-RAG_INTENT_TRAIN_LOG_MAX_PER_INTENT:])
+
+        labels: list[str] = []
+        texts: list[str] = []
+        for intent, intent_texts in samples.items():
+            for text in intent_texts:
+                labels.append(intent)
+                texts.append(text)
+        embs: list[List[float]] = []
+        for i in range(0, len(texts), 64):
+            embs.extend(ollama_embed_many(texts[i:i + 64]))
+
+        sums: dict[str, list[float]] = {}
+        for intent, emb in zip(labels, embs):
+            vec = _normalize_vector(emb)
+            acc = sums.setdefault(intent, [0.0] * len(vec))
+            for j, v in enumerate(vec):
+                acc[j] += v
+        centroids = {intent: _normalize_vector(acc) for intent, acc in sums.items()}
+        _INTENT_CENTROIDS.update({
+            "model": EMBED_MODEL,
+            "centroids": centroids,
+            "samples": {intent: len(intent_texts) for intent, intent_texts in samples.items()},
+            "train_texts": frozenset(clean_text(text).lower() for text in texts),
+        })
+        return centroids
+
+def _classify_intent_local(query: str) -> tuple[Optional[str], float]:
+    """Intent piu' vicino e confidenza (softmax delle cosine sui centroidi)."""
+    centroids = _intent_centroids()
+    if not centroids:
+        return None, 0.0
+    q_vec = _normalize_vector(_planned_embedding(query))
+    sims = {intent: sum(a * b for a, b in zip(q_vec, centroid)) for intent, centroid in centroids.items()}
+    best_sim = max(sims.values())
+    weights = {intent: math.exp((sim - best_sim) / RAG_INTENT_CLASSIFIER_TEMPERATURE) for intent, sim in sims.items()}
+    total = sum(weights.values()) or 1.0
+    best_intent = max(weights, key=weights.__getitem__)
+    return best_intent, weights[best_intent] / total
+
+def _intent_classifier_health() -> dict[str, Any]:
+    with _INTENT_CLASSIFIER_STATS_LOCK:
+        stats = dict(_INTENT_CLASSIFIER_STATS)
+    return {
+        "enabled": RAG_INTENT_CLASSIFIER,
+        "ready": _INTENT_CENTROIDS.get("model") == EMBED_MODEL,
+        "temperature": RAG_INTENT_CLASSIFIER_TEMPERATURE,
+        "train_logs": list(RAG_INTENT_TRAIN_LOGS),
+        "samples": dict(_INTENT_CENTROIDS.get("samples") or {}),
+        **stats,
+    }
 
+def _llm_route_intent(cleaned_query: str, recent_conversation: str, has_memory: bool) -> tuple[Optional[str], float]:
     router_system = (
         "Classifica l'intento del messaggio utente in UNA sola etichetta tra: "
         "chitchat, session_recap, memory_recap, memory_qna, creative_open. "
@@ -1935,7 +2331,7 @@ def _route_chat_intent(query: str, recent_conversation: str, has_memory: bool) -
     router_user = (
         f"HAS_MEMORY: {str(bool(has_memory)).lower()}\n"
         f"RECENT_CONVERSATION:\n{_truncate_for_prompt(recent_conversation, 1200)}\n\n"
-        f"USER_MESSAGE:\n{_truncate_for_prompt(plan.cleaned_query, 600)}\n\n"
+        f"USER_MESSAGE:\n{_truncate_for_prompt(cleaned_query, 600)}\n\n"
         "Criteri: "
         "session_recap=chiede cosa ci siamo detti prima/ultima volta; "
         "memory_recap=chiede cosa hai memorizzato/ricordi in generale; "
@@ -1952,6 +2348,7 @@ def _route_chat_intent(query: str, recent_conversation: str, has_memory: bool) -
             ],
             timeout=30,
             num_predict_override=max(8, RAG_INTENT_ROUTER_NUM_PREDICT),
+            stage="router",
         ).strip()
         obj = _extract_first_json_object(raw)
         if obj:
@@ -1961,31 +2358,559 @@ def _route_chat_intent(query: str, recent_conversation: str, has_memory: bool) -
                 confidence = float(obj.get("confidence", 0.0))
             except Exception:
                 confidence = 0.0
-            if intent in _ALLOWED_CHAT_INTENTS and confidence >= max(0.0, min(1.0, RAG_INTENT_CONFIDENCE_MIN)):
-                return _build_query_plan(plan.cleaned_query, intent)
+            if intent in _ALLOWED_CHAT_INTENTS:
+                return intent, confidence
     except Exception:
         pass
+    return None, 0.0
+
+def _route_chat_intent(query: str, recent_conversation: str, has_memory: bool) -> QueryPlan:
+    plan = _build_query_plan(query)
+    if not plan.cleaned_query:
+        return plan
+    if plan.explicit_recap or _RECAP_QUERY_RE.search(plan.cleaned_query):
+        return plan
+    # Segnali forti dal plan: non rischiare che il router LLM li degradi a chitchat
+    if plan.profile_query or plan.document_query or plan.definition_query:
+        return plan
+
+    confidence_min = max(0.0, min(1.0, RAG_INTENT_CONFIDENCE_MIN))
+    if RAG_INTENT_CLASSIFIER:
+        try:
+            intent, confidence = _classify_intent_local(plan.cleaned_query)
+            if intent in {"memory_qna", "memory_recap"} and not has_memory:
+                # Il classificatore non vede HAS_MEMORY: senza memoria decide il router LLM,
+                # invece di finire sulla risposta "non ricordo" con alta confidenza.
+                _bump_intent_stat("no_memory_deferrals")
+            elif intent and confidence >= confidence_min:
+                _bump_intent_stat("classified")
+                return dataclass_replace(_build_query_plan(plan.cleaned_query, intent), intent_source="classifier")
+            else:
+                _bump_intent_stat("router_fallbacks")
+        except Exception as e:
+            _bump_intent_stat("errors")
+            print(f"[WARN] Classificatore intent non disponibile, uso router LLM: {e}", flush=True)
 
+    intent, confidence = _llm_route_intent(plan.cleaned_query, recent_conversation, has_memory)
+    if intent and confidence >= confidence_min:
+        return dataclass_replace(_build_query_plan(plan.cleaned_query, intent), intent_source="router")
     return plan
 
-def _post_json(url: str, payload: dict, timeout: int):
+def _evaluate_intent_router(queries: Sequence[str]) -> dict[str, Any]:
+    """
+    Confronto offline classificatore locale vs router LLM sulle stesse query. Le query usate per
+    costruire i centroidi (esempi e campioni dai log di training) vengono escluse: l'accordo
+    misurato su di esse sarebbe gonfiato.
+    """
+    confidence_min = max(0.0, min(1.0, RAG_INTENT_CONFIDENCE_MIN))
+    _intent_centroids()
+    train_texts = _INTENT_CENTROIDS.get("train_texts") or frozenset()
+    rows: list[dict[str, Any]] = []
+    skipped_training = 0
+    for raw_query in queries:
+        query = clean_text(raw_query)
+        if not query:
+            continue
+        if query.lower() in train_texts:
+            skipped_training += 1
+            continue
+        started = time.perf_counter()
+        local_intent, local_conf = _classify_intent_local(query)
+        local_ms = (time.perf_counter() - started) * 1000.0
+        started = time.perf_counter()
+        llm_intent, llm_conf = _llm_route_intent(query, "", has_memory=True)
+        llm_ms = (time.perf_counter() - started) * 1000.0
+        rows.append({
+            "query": query,
+            "classifier": local_intent,
+            "classifier_confidence": round(local_conf, 4),
+            "confident": local_conf >= confidence_min,
+            "router": llm_intent if llm_conf >= confidence_min else None,
+            "classifier_ms": round(local_ms, 2),
+            "router_ms": round(llm_ms, 2),
+        })
+
+    total = len(rows)
+    labeled = [r for r in rows if r["router"]]
+    confident = [r for r in labeled if r["confident"]]
+    agree = sum(1 for r in labeled if r["classifier"] == r["router"])
+    agree_confident = sum(1 for r in confident if r["classifier"] == r["router"])
+    avg_classifier_ms = sum(r["classifier_ms"] for r in rows) / total if total else 0.0
+    avg_router_ms = sum(r["router_ms"] for r in rows) / total if total else 0.0
+    coverage = sum(1 for r in rows if r["confident"]) / total if total else 0.0
+    return {
+        "queries": total,
+        "skipped_training_queries": skipped_training,
+        "router_labeled": len(labeled),
+        "agreement": round(agree / len(labeled), 4) if labeled else 0.0,
+        "agreement_when_confident": round(agree_confident / len(confident), 4) if confident else 0.0,
+        "classifier_coverage": round(coverage, 4),
+        "confidence_min": confidence_min,
+        "avg_classifier_ms": round(avg_classifier_ms, 2),
+        "avg_router_ms": round(avg_router_ms, 2),
+        # Il router si salta solo sulle query sopra soglia; il classificatore gira sempre.
+        "avg_saved_ms_per_turn": round(coverage * avg_router_ms - avg_classifier_ms, 2),
+        "disagreements": [r for r in labeled if r["classifier"] != r["router"]][:50],
+    }
+
+# _EMBED_CACHE_LOCK protegge LRU e contatori; la connessione SQLite ha un lock suo, cosi' chi trova
+# il vettore in memoria non aspetta l'I/O su disco degli altri chiamanti.
+_EMBED_CACHE_LOCK = threading.Lock()
+_EMBED_CACHE_DB_LOCK = threading.Lock()
+# Vettori float32 in array("f"): ~3 KB per 768 dimensioni invece dei ~25 KB di una List[float].
+_EMBED_CACHE_MEM: OrderedDict[tuple[str, str], array] = OrderedDict()
+_EMBED_CACHE_DB: Optional[sqlite3.Connection] = None
+_EMBED_CACHE_DB_FAILED = False
+_EMBED_CACHE_DB_WRITES_SINCE_PRUNE = 0
+_EMBED_CACHE_PRUNE_EVERY = 256
+_EMBED_CACHE_STATS: dict[str, int] = {
+    "mem_hits": 0,
+    "disk_hits": 0,
+    "misses": 0,
+    "writes": 0,
+    "errors": 0,
+    "invalidated": 0,
+    "pruned": 0,
+}
+
+def _embed_cache_key(text: str) -> tuple[str, str]:
+    normalized = clean_text(text or "")
+    return EMBED_MODEL, hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def _embed_cache_bump(name: str, n: int = 1) -> None:
+    with _EMBED_CACHE_LOCK:
+        _EMBED_CACHE_STATS[name] += n
+
+def _embed_cache_db() -> Optional[sqlite3.Connection]:
+    """Apre (lazy) il tier su disco; scarta i vettori di modelli diversi da EMBED_MODEL. Chiamare con _EMBED_CACHE_DB_LOCK."""
+    global _EMBED_CACHE_DB, _EMBED_CACHE_DB_FAILED
+    if _EMBED_CACHE_DB is not None or _EMBED_CACHE_DB_FAILED:
+        return _EMBED_CACHE_DB
+    try:
+        os.makedirs(os.path.dirname(RAG_EMBED_CACHE_PATH), exist_ok=True)
+        conn = sqlite3.connect(RAG_EMBED_CACHE_PATH, check_same_thread=False, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, dim INTEGER NOT NULL, vec BLOB NOT NULL, "
+            "ts INTEGER NOT NULL, PRIMARY KEY (model, text_hash))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS embeddings_ts ON embeddings (ts)")
+        cur = conn.execute("DELETE FROM embeddings WHERE model != ?", (EMBED_MODEL,))
+        _embed_cache_bump("invalidated", max(0, int(cur.rowcount or 0)))
+        conn.commit()
+        _EMBED_CACHE_DB = conn
+    except Exception as exc:
+        print(f"[WARN] Embed cache su disco non disponibile ({RAG_EMBED_CACHE_PATH}): {exc}", flush=True)
+        _EMBED_CACHE_DB_FAILED = True
+        _EMBED_CACHE_DB = None
+        return None
+    try:
+        _embed_cache_prune(_EMBED_CACHE_DB)
+    except Exception:
+        _embed_cache_bump("errors")
+    return _EMBED_CACHE_DB
+
+def _embed_cache_prune(db: sqlite3.Connection) -> None:
+    """Tiene al massimo RAG_EMBED_CACHE_MAX_ROWS righe su disco, togliendo le meno recenti (ts). Chiamare con _EMBED_CACHE_DB_LOCK."""
+    global _EMBED_CACHE_DB_WRITES_SINCE_PRUNE
+    _EMBED_CACHE_DB_WRITES_SINCE_PRUNE = 0
+    if RAG_EMBED_CACHE_MAX_ROWS <= 0:
+        return
+    rows = int(db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0])
+    excess = rows - RAG_EMBED_CACHE_MAX_ROWS
+    if excess <= 0:
+        return
+    db.execute(
+        "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY ts ASC LIMIT ?)",
+        (excess,),
+    )
+    db.commit()
+    _embed_cache_bump("pruned", excess)
+
+def _embed_cache_remember_mem(key: tuple[str, str], vec: array) -> None:
+    """Chiamare con _EMBED_CACHE_LOCK."""
+    _EMBED_CACHE_MEM[key] = vec
+    _EMBED_CACHE_MEM.move_to_end(key)
+    while len(_EMBED_CACHE_MEM) > max(1, RAG_EMBED_CACHE_MEM_ITEMS):
+        _EMBED_CACHE_MEM.popitem(last=False)
+
+def _embed_cache_get_many(keys: List[tuple[str, str]]) -> dict[tuple[str, str], List[float]]:
+    found: dict[tuple[str, str], List[float]] = {}
+    disk_keys: list[tuple[str, str]] = []
+    with _EMBED_CACHE_LOCK:
+        for key in keys:
+            vec = _EMBED_CACHE_MEM.get(key)
+            if vec is not None:
+                _EMBED_CACHE_MEM.move_to_end(key)
+                found[key] = vec.tolist()
+                _EMBED_CACHE_STATS["mem_hits"] += 1
+            elif key not in disk_keys:
+                disk_keys.append(key)
+    if not disk_keys:
+        return found
+
+    rows: dict[tuple[str, str], Any] = {}
+    errors = 0
+    with _EMBED_CACHE_DB_LOCK:
+        db = _embed_cache_db()
+        if db is not None:
+            for key in disk_keys:
+                try:
+                    row = db.execute(
+                        "SELECT dim, vec FROM embeddings WHERE model = ? AND text_hash = ?",
+                        key,
+                    ).fetchone()
+                except Exception:
+                    errors += 1
+                    continue
+                if row is not None:
+                    rows[key] = row
+
+    with _EMBED_CACHE_LOCK:
+        _EMBED_CACHE_STATS["errors"] += errors
+        for key in disk_keys:
+            row = rows.get(key)
+            if row is None:
+                _EMBED_CACHE_STATS["misses"] += 1
+                continue
+            vec = array("f")
+            vec.frombytes(row[1])
+            if len(vec) != int(row[0]):
+                _EMBED_CACHE_STATS["misses"] += 1
+                continue
+            _embed_cache_remember_mem(key, vec)
+            found[key] = vec.tolist()
+            _EMBED_CACHE_STATS["disk_hits"] += 1
+    return found
+
+def _embed_cache_put_many(items: List[tuple[tuple[str, str], List[float]]]) -> None:
+    global _EMBED_CACHE_DB_WRITES_SINCE_PRUNE
+    if not items:
+        return
+    now = int(time.time())
+    vecs = [(key, array("f", emb)) for key, emb in items]
+    with _EMBED_CACHE_LOCK:
+        for key, vec in vecs:
+            _embed_cache_remember_mem(key, vec)
+    with _EMBED_CACHE_DB_LOCK:
+        db = _embed_cache_db()
+        if db is None:
+            return
+        try:
+            db.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, dim, vec, ts) VALUES (?, ?, ?, ?, ?)",
+                [(key[0], key[1], len(vec), vec.tobytes(), now) for key, vec in vecs],
+            )
+            db.commit()
+            _embed_cache_bump("writes", len(vecs))
+            _EMBED_CACHE_DB_WRITES_SINCE_PRUNE += len(vecs)
+            if _EMBED_CACHE_DB_WRITES_SINCE_PRUNE >= _EMBED_CACHE_PRUNE_EVERY:
+                _embed_cache_prune(db)
+        except Exception:
+            _embed_cache_bump("errors")
+
+def _embed_cache_health() -> dict[str, Any]:
+    with _EMBED_CACHE_LOCK:
+        stats = dict(_EMBED_CACHE_STATS)
+        mem_items = len(_EMBED_CACHE_MEM)
+    lookups = stats["mem_hits"] + stats["disk_hits"] + stats["misses"]
+    hits = stats["mem_hits"] + stats["disk_hits"]
+    return {
+        "enabled": RAG_EMBED_CACHE_ENABLED,
+        "model": EMBED_MODEL,
+        "path": RAG_EMBED_CACHE_PATH,
+        "disk_available": _EMBED_CACHE_DB is not None,
+        "mem_items": mem_items,
+        "mem_capacity": max(1, RAG_EMBED_CACHE_MEM_ITEMS),
+        "hit_rate": round(float(hits) / float(lookups), 4) if lookups else 0.0,
+        **stats,
+    }
+
+_OLLAMA_SESSION_LOCK = threading.Lock()
+_OLLAMA_SESSION: Optional[requests.Session] = None
+_OLLAMA_ADAPTER: Optional[HTTPAdapter] = None
+_OLLAMA_HTTP_STATS_LOCK = threading.Lock()
+_OLLAMA_HTTP_STATS: dict[str, dict[str, float]] = {}
+
+def _ollama_session() -> requests.Session:
+    """Session condivisa con pool keep-alive verso OLLAMA_HOST (creata al primo uso)."""
+    global _OLLAMA_SESSION, _OLLAMA_ADAPTER
+    session = _OLLAMA_SESSION
+    if session is not None:
+        return session
+    with _OLLAMA_SESSION_LOCK:
+        if _OLLAMA_SESSION is None:
+            pool_size = max(1, RAG_OLLAMA_POOL_SIZE)
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=pool_size,
+                pool_block=RAG_OLLAMA_POOL_BLOCK,
+                max_retries=Retry(
+                    total=max(0, RAG_OLLAMA_CONNECT_RETRIES),
+                    connect=max(0, RAG_OLLAMA_CONNECT_RETRIES),
+                    read=0,
+                    status=0,
+                    redirect=0,
+                    backoff_factor=0.1,
+                ),
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            if not RAG_OLLAMA_KEEPALIVE:
+                session.headers["Connection"] = "close"
+            _OLLAMA_ADAPTER = adapter
+            _OLLAMA_SESSION = session
+        return _OLLAMA_SESSION
+
+def _ollama_stage_timeout(stage: str, default: float) -> tuple[float, float]:
+    read_timeout = float(_OLLAMA_STAGE_TIMEOUTS.get(stage, default))
+    budget = _ACTIVE_STAGE_BUDGET.get()
+    if budget is not None:
+        read_timeout = budget.cap_timeout(read_timeout, stage)
+    return max(0.1, RAG_OLLAMA_CONNECT_TIMEOUT), max(1.0, read_timeout)
+
+def _record_ollama_http(stage: str, elapsed_s: float, ok: bool) -> None:
+    elapsed_ms = elapsed_s * 1000.0
+    with _OLLAMA_HTTP_STATS_LOCK:
+        entry = _OLLAMA_HTTP_STATS.setdefault(stage, {"requests": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+        entry["requests"] += 1
+        entry["total_ms"] += elapsed_ms
+        entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+        if not ok:
+            entry["errors"] += 1
+        else:
+            previous = _OLLAMA_STAGE_COST_MS.get(stage)
+            _OLLAMA_STAGE_COST_MS[stage] = elapsed_ms if previous is None else 0.2 * elapsed_ms + 0.8 * previous
+    budget = _ACTIVE_STAGE_BUDGET.get()
+    if budget is not None:
+        budget.record(stage, elapsed_ms, ok)
+
+def _record_prompt_eval(stage: str, data: dict[str, Any]) -> None:
+    """Accumula i contatori di Ollama (prompt_eval_*/eval_*) della risposta finale di una chiamata chat."""
+    if "prompt_eval_count" not in data and "eval_count" not in data:
+        return
+    prompt_tokens = int(data.get("prompt_eval_count") or 0)
+    prompt_ms = float(data.get("prompt_eval_duration") or 0) / 1e6
+    eval_tokens = int(data.get("eval_count") or 0)
+    eval_ms = float(data.get("eval_duration") or 0) / 1e6
+    with _OLLAMA_HTTP_STATS_LOCK:
+        entry = _OLLAMA_HTTP_STATS.setdefault(stage, {"requests": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+        entry["llm_calls"] = entry.get("llm_calls", 0) + 1
+        entry["prompt_eval_tokens"] = entry.get("prompt_eval_tokens", 0) + prompt_tokens
+        entry["prompt_eval_ms"] = entry.get("prompt_eval_ms", 0.0) + prompt_ms
+        entry["eval_tokens"] = entry.get("eval_tokens", 0) + eval_tokens
+        entry["eval_ms"] = entry.get("eval_ms", 0.0) + eval_ms
+    budget = _ACTIVE_STAGE_BUDGET.get()
+    if budget is not None:
+        budget.record_prompt_eval(prompt_tokens, prompt_ms, eval_tokens, eval_ms)
+
+# Media mobile (ms) delle chiamate riuscite per stage: stima del costo usata dal budget di /chat.
+_OLLAMA_STAGE_COST_MS: dict[str, float] = {}
+# Stage saltabili: chi li chiama ha gia' un ripiego (piano euristico, query originale, risposta
+# non riscritta, _memory_unknown_reply). "generate" ed "embed" non vengono mai saltati.
+_OPTIONAL_CHAT_STAGES = frozenset({
+    "router", "query_rewrite", "identity_retry", "guardrail_rewrite", "coverage_retry", "definition",
+})
+# Timeout minimo per gli stage obbligatori anche a budget esaurito (bound sul caso peggiore).
+_STAGE_MIN_TIMEOUT_S = 5.0
+
+class _StageSkipped(Exception):
+    """Stage LLM opzionale saltato perche' non sta nel budget residuo della richiesta."""
+
+class _StageBudgetExceeded(HTTPException):
+    """Chiamata Ollama interrotta dal timeout limitato al budget (502 per chi non la gestisce)."""
+
+class _ChatStageBudget:
+    """
+    Budget di latenza di una richiesta /chat. admit() decide se uno stage opzionale sta nel
+    tempo residuo (stima = media mobile dello stage, piu' la generazione principale se non e'
+    ancora avvenuta); cap_timeout() limita i timeout HTTP al residuo. Registra gli stage eseguiti.
+    """
+
+    def __init__(self, budget_ms: int):
+        self.budget_ms = max(0, int(budget_ms))
+        self.started = time.monotonic()
+        self.deadline = self.started + self.budget_ms / 1000.0 if self.budget_ms > 0 else None
+        self.lock = threading.Lock()
+        self.ran: list[dict[str, Any]] = []
+        self.skipped: list[str] = []
+        self.fallbacks: list[str] = []
+        self.generated = False
+        self.prompt_eval = {"prompt_eval_tokens": 0, "prompt_eval_ms": 0.0, "eval_tokens": 0, "eval_ms": 0.0}
+
+    def remaining_ms(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return (self.deadline - time.monotonic()) * 1000.0
+
+    def expired(self) -> bool:
+        remaining = self.remaining_ms()
+        return remaining is not None and remaining <= 0
+
+    def note_fallback(self, reason: str) -> None:
+        with self.lock:
+            self.fallbacks.append(reason)
+
+    def admit(self, stage: str) -> None:
+        remaining = self.remaining_ms()
+        if remaining is None or stage not in _OPTIONAL_CHAT_STAGES:
+            return
+        with _OLLAMA_HTTP_STATS_LOCK:
+            needed = _OLLAMA_STAGE_COST_MS.get(stage, 0.0)
+            if not self.generated:
+                needed += _OLLAMA_STAGE_COST_MS.get("generate", 0.0)
+        if remaining <= 0 or needed > remaining:
+            with self.lock:
+                self.skipped.append(stage)
+            raise _StageSkipped(stage)
+
+    def cap_timeout(self, read_timeout: float, stage: str = "generate") -> float:
+        remaining = self.remaining_ms()
+        if remaining is None:
+            return read_timeout
+        # Il minimo garantito vale solo per gli stage obbligatori; gli opzionali hanno un ripiego.
+        floor = 1.0 if stage in _OPTIONAL_CHAT_STAGES else _STAGE_MIN_TIMEOUT_S
+        return min(read_timeout, max(floor, remaining / 1000.0))
+
+    def record(self, stage: str, elapsed_ms: float, ok: bool) -> None:
+        with self.lock:
+            self.ran.append({"stage": stage, "ms": round(elapsed_ms, 1), "ok": ok})
+            if stage == "generate" and ok:
+                self.generated = True
+
+    def record_prompt_eval(self, prompt_tokens: int, prompt_ms: float, eval_tokens: int, eval_ms: float) -> None:
+        with self.lock:
+            self.prompt_eval["prompt_eval_tokens"] += prompt_tokens
+            self.prompt_eval["prompt_eval_ms"] += prompt_ms
+            self.prompt_eval["eval_tokens"] += eval_tokens
+            self.prompt_eval["eval_ms"] += eval_ms
+
+    def report(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "budget_ms": self.budget_ms,
+                "elapsed_ms": round((time.monotonic() - self.started) * 1000.0, 1),
+                "ran": list(self.ran),
+                "skipped": list(self.skipped),
+                "fallbacks": list(self.fallbacks),
+                "prompt_eval": {k: round(v, 1) if isinstance(v, float) else v for k, v in self.prompt_eval.items()},
+            }
+
+_ACTIVE_STAGE_BUDGET: ContextVar[Optional[_ChatStageBudget]] = ContextVar("_ACTIVE_STAGE_BUDGET", default=None)
+
+@contextmanager
+def _stage_budget_scope(budget: _ChatStageBudget):
+    """Rende il budget visibile agli stage LLM chiamati nel blocco (senza yield all'interno)."""
+    token = _ACTIVE_STAGE_BUDGET.set(budget)
+    try:
+        yield budget
+    finally:
+        _ACTIVE_STAGE_BUDGET.reset(token)
+
+def _ollama_http_health() -> dict[str, Any]:
+    connections_opened = 0
+    pool_requests = 0
+    adapter = _OLLAMA_ADAPTER
+    if adapter is not None:
+        try:
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                connections_opened += int(getattr(pool, "num_connections", 0))
+                pool_requests += int(getattr(pool, "num_requests", 0))
+        except Exception:
+            pass
+
+    with _OLLAMA_HTTP_STATS_LOCK:
+        stages = {
+            stage: {
+                "requests": int(entry["requests"]),
+                "errors": int(entry["errors"]),
+                "avg_ms": round(entry["total_ms"] / entry["requests"], 1) if entry["requests"] else 0.0,
+                "max_ms": round(entry["max_ms"], 1),
+                **({
+                    "avg_prompt_eval_tokens": round(entry["prompt_eval_tokens"] / entry["llm_calls"], 1),
+                    "avg_prompt_eval_ms": round(entry["prompt_eval_ms"] / entry["llm_calls"], 1),
+                    "avg_eval_tokens": round(entry["eval_tokens"] / entry["llm_calls"], 1),
+                    "avg_eval_ms": round(entry["eval_ms"] / entry["llm_calls"], 1),
+                } if entry.get("llm_calls") else {}),
+            }
+            for stage, entry in sorted(_OLLAMA_HTTP_STATS.items())
+        }
+    return {
+        "pool_size": max(1, RAG_OLLAMA_POOL_SIZE),
+        "pool_block": RAG_OLLAMA_POOL_BLOCK,
+        "keepalive": RAG_OLLAMA_KEEPALIVE,
+        "connect_timeout_s": RAG_OLLAMA_CONNECT_TIMEOUT,
+        "stage_timeout_overrides": dict(_OLLAMA_STAGE_TIMEOUTS),
+        "connections_opened": connections_opened,
+        "pool_requests": pool_requests,
+        "connection_reuse_ratio": round(1.0 - (connections_opened / pool_requests), 4) if pool_requests else 0.0,
+        "stages": stages,
+        "stage_cost_ewma_ms": {stage: round(ms, 1) for stage, ms in sorted(_OLLAMA_STAGE_COST_MS.items())},
+        "chat_latency_budget_ms": RAG_CHAT_LATENCY_BUDGET_MS,
+    }
+
+def _post_json(url: str, payload: dict, timeout: float, stage: str = "generate"):
+    started = time.perf_counter()
+    ok = False
     try:
-        r = requests.post(url, json=payload, timeout=timeout)
+        r = _ollama_session().post(url, json=payload, timeout=_ollama_stage_timeout(stage, timeout))
         r.raise_for_status()
-        return r.json()
+        data = r.json()
+        ok = True
+        return data
     except requests.exceptions.RequestException as e:
+        _raise_if_budget_exceeded(stage, e)
         raise HTTPException(status_code=502, detail=f"Ollama non raggiungibile o errore HTTP: {e}")
+    finally:
+        _record_ollama_http(stage, time.perf_counter() - started, ok)
 
-def ollama_embed_many(texts: List[str]) -> List[List[float]]:
-    """Embeddings di 1 o N testi usando Ollama /api/embed."""
+def _raise_if_budget_exceeded(stage: str, exc: Exception) -> None:
+    budget = _ACTIVE_STAGE_BUDGET.get()
+    if budget is not None and budget.expired():
+        raise _StageBudgetExceeded(status_code=502, detail=f"Budget di latenza esaurito durante {stage}: {exc}")
+
+def ollama_embed_many(texts: List[str], direct: bool = False) -> List[List[float]]:
+    """
+    Embeddings di 1 o N testi usando Ollama /api/embed (passando dalla cache embedding).
+    direct=True (batch di ingest) salta micro-batcher e cache: ogni batch e' una richiesta Ollama
+    a se', cosi' RAG_INGEST_EMBED_CONCURRENCY e il tuner misurano il costo reale dell'embedding.
+    """
     if not texts:
         return []
-
+    if direct or not RAG_EMBED_CACHE_ENABLED:
+        return _EMBED_BATCHER.embed(texts, direct=direct)
+
+    keys = [_embed_cache_key(t) for t in texts]
+    cached = _embed_cache_get_many(keys)
+    missing: dict[tuple[str, str], str] = {}
+    for key, text in zip(keys, texts):
+        if key not in cached and key not in missing:
+            missing[key] = text
+
+    if missing:
+        fresh = _EMBED_BATCHER.embed(list(missing.values()))
+        if len(fresh) != len(missing):
+            raise HTTPException(status_code=500, detail=f"Embed response count mismatch: attesi {len(missing)}, ricevuti {len(fresh)}")
+        new_items = list(zip(missing.keys(), fresh))
+        _embed_cache_put_many(new_items)
+        cached.update(new_items)
+
+    embs = [cached[key] for key in keys]
+    _validate_embeddings(embs)
+    return embs
+
+def _ollama_embed_request(texts: List[str]) -> List[List[float]]:
     payload: dict[str, Any] = {
         "model": EMBED_MODEL,
         "input": texts if len(texts) > 1 else texts[0],
     }
-    data = _post_json(f"{OLLAMA_HOST}/api/embed", payload, timeout=180)
+    data = _post_json(f"{OLLAMA_HOST}/api/embed", payload, timeout=180, stage="embed")
 
     if "embeddings" in data and isinstance(data["embeddings"], list):
         if data["embeddings"] and isinstance(data["embeddings"][0], list):
@@ -2012,38 +2937,330 @@ def _validate_embeddings(embs: List[List[float]]) -> None:
         if len(e) != dim or any(v != v or v in (float('inf'), float('-inf')) for v in e):
             raise HTTPException(status_code=500, detail="Embedding invalido (dim/NaN/Inf).")
 
+class _EmbedBatchRequest:
+    __slots__ = ("texts", "deadline", "done", "result", "error")
+
+    def __init__(self, texts: List[str], deadline: float):
+        self.texts = texts
+        self.deadline = deadline
+        self.done = threading.Event()
+        self.result: Optional[List[List[float]]] = None
+        self.error: Optional[BaseException] = None
+
+class _EmbedMicroBatcher:
+    """
+    Raccoglie le richieste di embedding arrivate entro window_ms da thread diversi (chat/recall
+    concorrenti) e le manda a Ollama come un'unica /api/embed, poi restituisce a ognuno i suoi vettori.
+    Testi identici tra richieste vengono inviati una volta sola. Vanno dirette a Ollama le richieste
+    con direct=True (batch di ingest) e quelle con max_inputs testi o piu'; quelle oltre la deadline
+    escono con 504.
+    """
+
+    def __init__(self, window_ms: float, max_inputs: int, max_parallel: int = 4):
+        self.window_s = window_ms / 1000.0
+        self.max_inputs = max_inputs
+        self.queue: "queue.Queue[_EmbedBatchRequest]" = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="embed-batch")
+        self.stats: dict[str, int] = {
+            "requests": 0,
+            "direct": 0,
+            "batches": 0,
+            "inputs": 0,
+            "deduped_inputs": 0,
+            "expired": 0,
+            "max_batch_requests": 0,
+        }
+
+    def embed(
+        self,
+        texts: List[str],
+        deadline_s: float = RAG_EMBED_BATCH_DEADLINE_S,
+        direct: bool = False,
+    ) -> List[List[float]]:
+        if direct or self.window_s <= 0 or len(texts) >= self.max_inputs:
+            with self.lock:
+                self.stats["direct"] += 1
+            return _ollama_embed_request(texts)
+        req = _EmbedBatchRequest(list(texts), time.monotonic() + deadline_s)
+        self._ensure_thread()
+        with self.lock:
+            self.stats["requests"] += 1
+        self.queue.put(req)
+        if not req.done.wait(deadline_s):
+            raise HTTPException(status_code=504, detail="Embedding scaduto in attesa del micro-batch.")
+        if req.error is not None:
+            raise req.error
+        assert req.result is not None
+        return req.result
+
+    def _ensure_thread(self) -> None:
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, name="embed-batcher", daemon=True)
+                self.thread.start()
+
+    def _loop(self) -> None:
+        carry: Optional[_EmbedBatchRequest] = None
+        while True:
+            first = carry if carry is not None else self.queue.get()
+            carry = None
+            batch = [first]
+            n_inputs = len(first.texts)
+            window_end = time.monotonic() + self.window_s
+            while n_inputs < self.max_inputs:
+                remaining = window_end - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    req = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if n_inputs + len(req.texts) > self.max_inputs:
+                    carry = req
+                    break
+                batch.append(req)
+                n_inputs += len(req.texts)
+            # Il dispatch gira sul pool: la finestra successiva si apre subito.
+            self.executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch: List[_EmbedBatchRequest]) -> None:
+        now = time.monotonic()
+        live: List[_EmbedBatchRequest] = []
+        for req in batch:
+            if req.deadline <= now:
+                req.error = HTTPException(status_code=504, detail="Embedding scaduto in attesa del micro-batch.")
+                req.done.set()
+                with self.lock:
+                    self.stats["expired"] += 1
+            else:
+                live.append(req)
+        if not live:
+            return
+        all_texts = [t for req in live for t in req.texts]
+        unique = list(dict.fromkeys(all_texts))
+        try:
+            embs = _ollama_embed_request(unique)
+            if len(embs) != len(unique):
+                raise HTTPException(status_code=500, detail=f"Embed response count mismatch: attesi {len(unique)}, ricevuti {len(embs)}")
+            by_text = dict(zip(unique, embs))
+            for req in live:
+                req.result = [by_text[t] for t in req.texts]
+        except BaseException as e:
+            for req in live:
+                req.error = e
+        finally:
+            for req in live:
+                req.done.set()
+            with self.lock:
+                self.stats["batches"] += 1
+                self.stats["inputs"] += len(unique)
+                self.stats["deduped_inputs"] += len(all_texts) - len(unique)
+                self.stats["max_batch_requests"] = max(self.stats["max_batch_requests"], len(live))
+
+    def health(self) -> dict[str, Any]:
+        with self.lock:
+            stats = dict(self.stats)
+        return {
+            "window_ms": self.window_s * 1000.0,
+            "max_inputs": self.max_inputs,
+            "avg_requests_per_batch": round(
+                (stats["requests"] - stats["expired"]) / stats["batches"], 3
+            ) if stats["batches"] else 0.0,
+            **stats,
+        }
+
+_EMBED_BATCHER = _EmbedMicroBatcher(RAG_EMBED_BATCH_WINDOW_MS, RAG_EMBED_BATCH_MAX_INPUTS)
+
 def ollama_chat(
     messages: list[dict[str, str]],
     timeout: int = 600,
     num_predict_override: Optional[int] = None,
+    stage: str = "generate",
 ) -> str:
+    budget = _ACTIVE_STAGE_BUDGET.get()
+    if budget is not None:
+        budget.admit(stage)
+    data = _post_json(
+        f"{OLLAMA_HOST}/api/chat",
+        _ollama_chat_payload(messages, num_predict_override, stream=False, stage=stage),
+        timeout=timeout,
+        stage=stage,
+    )
+    _record_prompt_eval(stage, data)
+    return (data.get("message") or {}).get("content", "") or ""
+
+def _stage_model(stage: str) -> str:
+    return _STAGE_PROFILES.get(stage, {}).get("model") or CHAT_MODEL
+
+def _stage_num_predict(stage: str, num_predict_override: Optional[int]) -> int:
+    effective_num_predict = CHAT_NUM_PREDICT if num_predict_override is None else int(num_predict_override)
+    profile_num_predict = int(_STAGE_PROFILES.get(stage, {}).get("num_predict", 0))
+    if profile_num_predict > 0:
+        effective_num_predict = min(effective_num_predict, profile_num_predict) if effective_num_predict > 0 else profile_num_predict
+    return effective_num_predict
+
+def _stage_num_ctx(stage: str) -> int:
+    """num_ctx effettivo dello stage (0 = default di Ollama)."""
+    profile_num_ctx = int(_STAGE_PROFILES.get(stage, {}).get("num_ctx", 0))
+    if profile_num_ctx > 0:
+        return profile_num_ctx
+    return RAG_CHAT_NUM_CTX if RAG_TOKEN_BUDGET else 0
+
+def _ollama_chat_payload(
+    messages: list[dict[str, str]],
+    num_predict_override: Optional[int],
+    stream: bool,
+    stage: str = "generate",
+) -> dict[str, Any]:
+    profile = _STAGE_PROFILES.get(stage, {})
     options: dict[str, Any] = {
-        "temperature": CHAT_TEMPERATURE,
+        "temperature": profile.get("temperature", CHAT_TEMPERATURE),
         "top_p": CHAT_TOP_P,
         "repeat_penalty": CHAT_REPEAT_PENALTY,
     }
-    effective_num_predict = CHAT_NUM_PREDICT if num_predict_override is None else int(num_predict_override)
+    effective_num_predict = _stage_num_predict(stage, num_predict_override)
     if effective_num_predict > 0:
         options["num_predict"] = effective_num_predict
+    num_ctx = _stage_num_ctx(stage)
+    if num_ctx > 0:
+        options["num_ctx"] = num_ctx
+    payload: dict[str, Any] = {
+        "model": profile.get("model") or CHAT_MODEL,
+        "messages": messages,
+        "stream": stream,
+        "options": options,
+    }
+    keep_alive = profile.get("keep_alive") or (RAG_PROMPT_KEEP_ALIVE if RAG_PROMPT_STABLE_PREFIX else "")
+    if keep_alive:
+        payload["keep_alive"] = int(keep_alive) if keep_alive.lstrip("-").isdigit() else keep_alive
+    return payload
 
-    data = _post_json(
-        f"{OLLAMA_HOST}/api/chat",
-        {
-            "model": CHAT_MODEL,
-            "messages": messages,
-            "stream": False,
-            "options": options,
-        },
-        timeout=timeout,
-    )
-    return (data.get("message") or {}).get("content", "") or ""
+def _stage_profiles_health() -> dict[str, Any]:
+    return {
+        stage: {"model": _stage_model(stage), **{k: v for k, v in _STAGE_PROFILES.get(stage, {}).items() if k != "model"}}
+        for stage in _OLLAMA_STAGES
+        if stage != "embed"
+    }
+
+def ollama_chat_stream(
+    messages: list[dict[str, str]],
+    timeout: int = 600,
+    num_predict_override: Optional[int] = None,
+    stage: str = "generate",
+) -> Iterator[str]:
+    """Come ollama_chat ma con stream=True: restituisce i pezzi di testo appena Ollama li produce."""
+    started = time.perf_counter()
+    ok = False
+    try:
+        with _ollama_session().post(
+            f"{OLLAMA_HOST}/api/chat",
+            json=_ollama_chat_payload(messages, num_predict_override, stream=True, stage=stage),
+            timeout=_ollama_stage_timeout(stage, timeout),
+            stream=True,
+        ) as r:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                if data.get("error"):
+                    raise HTTPException(status_code=502, detail=f"Errore Ollama in streaming: {data['error']}")
+                piece = (data.get("message") or {}).get("content", "") or ""
+                if piece:
+                    yield piece
+                if data.get("done"):
+                    _record_prompt_eval(stage, data)
+                    break
+        ok = True
+    except requests.exceptions.RequestException as e:
+        _raise_if_budget_exceeded(stage, e)
+        raise HTTPException(status_code=502, detail=f"Ollama non raggiungibile o errore HTTP: {e}")
+    finally:
+        _record_ollama_http(stage, time.perf_counter() - started, ok)
 
 def _embed_one_or_http_500(text: str) -> List[float]:
     try:
-        return ollama_embed_many([text])[0]
+        return _planned_embedding(text)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore embedding: {e}")
 
+# Probe costanti del memory_recap (embeddate insieme alla query quando il turno puo' servirle).
+_RECAP_PROFILE_PROBE = "memorie personali identita nome dove vivi preferenze ricordi salvati"
+_RECAP_MEMORY_PROBE = "memorie personali fatti importanti identita preferenze eventi conversazioni passate"
+
+class _EmbeddingPlan:
+    """
+    Vettori di un turno /chat o /recall: i testi che il turno usera' (query, contenuto da
+    ricordare, probe del recap) vengono embeddati in un'unica chiamata all'inizio e condivisi
+    da classificatore, auto-remember e retrieval. Un testo non previsto (es. query riscritta
+    dall'LLM) costa una chiamata in piu' e viene contato come late_miss.
+    """
+
+    def __init__(self) -> None:
+        self.vectors: dict[str, List[float]] = {}
+
+    def prefetch(self, texts: Sequence[str]) -> None:
+        missing = list(dict.fromkeys(t for t in texts if t and t not in self.vectors))
+        if not missing:
+            return
+        self.vectors.update(zip(missing, ollama_embed_many(missing)))
+        with _EMBEDDING_PLAN_LOCK:
+            _EMBEDDING_PLAN_STATS["embed_calls"] += 1
+            _EMBEDDING_PLAN_STATS["texts"] += len(missing)
+
+    def get(self, text: str) -> List[float]:
+        vec = self.vectors.get(text)
+        if vec is None:
+            with _EMBEDDING_PLAN_LOCK:
+                _EMBEDDING_PLAN_STATS["late_misses"] += 1
+            self.prefetch([text])
+            vec = self.vectors[text]
+        else:
+            with _EMBEDDING_PLAN_LOCK:
+                _EMBEDDING_PLAN_STATS["hits"] += 1
+        return vec
+
+_EMBEDDING_PLAN_LOCK = threading.Lock()
+_EMBEDDING_PLAN_STATS: dict[str, int] = {"turns": 0, "embed_calls": 0, "texts": 0, "hits": 0, "late_misses": 0}
+_ACTIVE_EMBEDDING_PLAN: ContextVar[Optional[_EmbeddingPlan]] = ContextVar("_ACTIVE_EMBEDDING_PLAN", default=None)
+
+@contextmanager
+def _embedding_plan_scope(texts: Sequence[str]):
+    """Attiva un piano di embedding per il turno, con i testi previsti gia' embeddati in batch."""
+    if _ACTIVE_EMBEDDING_PLAN.get() is not None:
+        yield
+        return
+    plan = _EmbeddingPlan()
+    token = _ACTIVE_EMBEDDING_PLAN.set(plan)
+    with _EMBEDDING_PLAN_LOCK:
+        _EMBEDDING_PLAN_STATS["turns"] += 1
+    try:
+        try:
+            plan.prefetch(texts)
+        except Exception as e:
+            # Nessun errore anticipato: ogni testo riprova al primo uso e fallisce li' come prima.
+            print(f"[WARN] Prefetch embedding del turno fallito: {e}", flush=True)
+        yield
+    finally:
+        _ACTIVE_EMBEDDING_PLAN.reset(token)
+
+def _planned_embedding(text: str) -> List[float]:
+    """Embedding di un testo dal piano del turno se attivo, altrimenti chiamata diretta."""
+    plan = _ACTIVE_EMBEDDING_PLAN.get()
+    if plan is not None:
+        return plan.get(text)
+    return ollama_embed_many([text])[0]
+
+def _embedding_plan_health() -> dict[str, Any]:
+    with _EMBEDDING_PLAN_LOCK:
+        stats = dict(_EMBEDDING_PLAN_STATS)
+    stats["avg_embed_calls_per_turn"] = round(stats["embed_calls"] / stats["turns"], 3) if stats["turns"] else 0.0
+    return stats
+
 def _run_startup_warmup() -> None:
     warmup_embed_text = "warmup"
     warmup_chat_text = "Ciao."
@@ -2062,6 +3279,7 @@ def _run_startup_warmup() -> None:
             f"{OLLAMA_HOST}/api/embed",
             payload,
             timeout=max(1, warmup_embed_timeout),
+            stage="warmup",
         )
         elapsed = time.perf_counter() - started
         print(
@@ -2078,16 +3296,43 @@ def _run_startup_warmup() -> None:
             messages=[{"role": "user", "content": warmup_chat_text}],
             timeout=max(1, warmup_chat_timeout),
             num_predict_override=warmup_chat_num_predict,
+            stage="warmup",
         )
         elapsed = time.perf_counter() - started
         print(
             f"[INFO] RAG warmup chat complete in {elapsed:.2f}s "
-            f"(model={CHAT_MODEL}).",
+            f"(model={_stage_model('warmup')}).",
             flush=True,
         )
     except Exception as exc:
         print(f"[WARN] RAG warmup chat failed: {exc}", flush=True)
 
+    # Precarica anche i modelli dedicati degli altri stage, cosi' il primo turno non paga il load.
+    warmed_models = {_stage_model("warmup")}
+    for stage in _OLLAMA_STAGES:
+        if stage in ("embed", "warmup") or _stage_model(stage) in warmed_models:
+            continue
+        warmed_models.add(_stage_model(stage))
+        started = time.perf_counter()
+        try:
+            payload = _ollama_chat_payload(
+                [{"role": "user", "content": warmup_chat_text}], warmup_chat_num_predict, stream=False, stage=stage
+            )
+            _ = _post_json(f"{OLLAMA_HOST}/api/chat", payload, timeout=max(1, warmup_chat_timeout), stage="warmup")
+            elapsed = time.perf_counter() - started
+            print(f"[INFO] RAG warmup {stage} model complete in {elapsed:.2f}s (model={payload['model']}).", flush=True)
+        except Exception as exc:
+            print(f"[WARN] RAG warmup {stage} model failed: {exc}", flush=True)
+
+    if RAG_INTENT_CLASSIFIER:
+        started = time.perf_counter()
+        try:
+            _intent_centroids()
+            elapsed = time.perf_counter() - started
+            print(f"[INFO] RAG intent classifier ready in {elapsed:.2f}s.", flush=True)
+        except Exception as exc:
+            print(f"[WARN] RAG intent classifier warmup failed: {exc}", flush=True)
+
     elapsed_total = time.perf_counter() - started_total
     print(f"[INFO] RAG startup warmup finished in {elapsed_total:.2f}s.", flush=True)
 
@@ -2098,6 +3343,19 @@ _ALLOWED_LOG_INPUT_MODES = {"voice", "keyboard"}
 _SESSION_HISTORY_LOCK = threading.Lock()
 _SESSION_HISTORIES: dict[tuple[str, str, str], deque[tuple[str, str]]] = {}
 
+@dataclass
+
+class _SessionSummary:
+    """Riassunto incrementale di una sessione. I contatori sono assoluti (turni dall'inizio della sessione)."""
+    text: str = ""
+    turns_total: int = 0
+    turns_folded: int = 0
+    pending: bool = False
+
+# Stesse chiavi di _SESSION_HISTORIES; protetto da _SESSION_HISTORY_LOCK.
+_SESSION_SUMMARIES: dict[tuple[str, str, str], _SessionSummary] = {}
+_SESSION_SUMMARY_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-summary")
+
 def _safe_avatar_key(avatar_id: str) -> str:
     s = (avatar_id or "default").strip()
     s = re.sub(r"[^a-zA-Z0-9_-]+", "_", s)
@@ -2148,6 +3406,7 @@ def _reset_session_history(avatar_id: str, session_id: Optional[str], empirical_
         return None
     with _SESSION_HISTORY_LOCK:
         _SESSION_HISTORIES[key] = deque(maxlen=_effective_session_turns())
+        _SESSION_SUMMARIES.pop(key, None)
     return key[2]
 
 def _reset_all_session_histories_for_avatar(avatar_id: str, empirical_test_mode: bool = False) -> None:
@@ -2157,6 +3416,7 @@ def _reset_all_session_histories_for_avatar(avatar_id: str, empirical_test_mode:
         keys_to_remove = [key for key in _SESSION_HISTORIES.keys() if key[0] == mode and key[1] == avatar_key]
         for key in keys_to_remove:
             _SESSION_HISTORIES.pop(key, None)
+            _SESSION_SUMMARIES.pop(key, None)
 
 def _append_session_turn(
     avatar_id: str,
@@ -2183,6 +3443,109 @@ def _append_session_turn(
             hist = deque(hist, maxlen=_effective_session_turns())
             _SESSION_HISTORIES[key] = hist
         hist.append((user_turn, assistant_turn))
+        summary = _SESSION_SUMMARIES.setdefault(key, _SessionSummary())
+        summary.turns_total += 1
+        schedule = RAG_SESSION_SUMMARY and not summary.pending and bool(_session_turns_to_fold(summary, hist))
+        if schedule:
+            summary.pending = True
+    if schedule:
+        # Fuori dal percorso critico: la risposta del turno non aspetta il riassunto.
+        _SESSION_SUMMARY_EXECUTOR.submit(_fold_session_summary, key, summary)
+
+def _session_summary_health() -> dict[str, Any]:
+    with _SESSION_HISTORY_LOCK:
+        summaries = list(_SESSION_SUMMARIES.values())
+    return {
+        "enabled": RAG_SESSION_SUMMARY,
+        "raw_turns": _session_raw_turns(),
+        "fold_batch_turns": _session_fold_batch(),
+        "sessions_summarized": sum(1 for summary in summaries if summary.text),
+        "pending": sum(1 for summary in summaries if summary.pending),
+    }
+
+def _session_raw_turns() -> int:
+    return min(RAG_SESSION_RAW_TURNS, _effective_session_turns())
+
+def _session_fold_batch() -> int:
+    """
+    Turni da accumulare fuori dalla finestra raw prima di un riassunto: una chiamata LLM ogni
+    RAG_SESSION_RAW_TURNS turni invece di una per turno, senza superare la history di RAG_SESSION_TURNS.
+    """
+    return max(1, min(RAG_SESSION_RAW_TURNS, _effective_session_turns() - _session_raw_turns()))
+
+def _session_turns_to_fold(summary: _SessionSummary, hist: deque[tuple[str, str]]) -> list[tuple[str, str]]:
+    """
+    Turni usciti dalla finestra raw e non ancora nel riassunto, solo se sono almeno un batch
+    (chiamare con _SESSION_HISTORY_LOCK).
+    """
+    fold_until = summary.turns_total - _session_raw_turns()
+    first_in_hist = summary.turns_total - len(hist)
+    start = max(summary.turns_folded, first_in_hist)
+    if fold_until - start < _session_fold_batch():
+        return []
+    return list(hist)[start - first_in_hist:fold_until - first_in_hist]
+
+def _fold_session_summary(key: tuple[str, str, str], summary: _SessionSummary) -> None:
+    """Condensa nel riassunto i turni usciti dalla finestra raw; si ripianifica se ne arrivano altri."""
+    while True:
+        with _SESSION_HISTORY_LOCK:
+            hist = _SESSION_HISTORIES.get(key)
+            if hist is None or _SESSION_SUMMARIES.get(key) is not summary:
+                summary.pending = False
+                return
+            turns = _session_turns_to_fold(summary, hist)
+            if not turns:
+                summary.pending = False
+                return
+            fold_until = summary.turns_total - _session_raw_turns()
+            previous = summary.text
+
+        lines: list[str] = []
+        for user_turn, assistant_turn in turns:
+            if user_turn:
+                lines.append(f"- Utente: {user_turn}")
+            if assistant_turn:
+                lines.append(f"- Avatar: {assistant_turn}")
+        try:
+            updated = ollama_chat(
+                [
+                    {
+                        "role": "system",
+                        "content": (
+                            "Aggiorna il riassunto di una conversazione tra l'utente e l'avatar. "
+                            "Integra i nuovi turni nel riassunto attuale mantenendo fatti, richieste, decisioni e "
+                            "argomenti ancora aperti; elimina saluti e ripetizioni. "
+                            "Scrivi in italiano, in terza persona (l'utente, l'avatar), senza aggiungere nulla "
+                            f"che non sia stato detto. Massimo {RAG_SESSION_SUMMARY_MAX_CHARS} caratteri, testo semplice."
+                        ),
+                    },
+                    {
+                        "role": "user",
+                        "content": f"RIASSUNTO ATTUALE:\n{previous or '(vuoto)'}\n\nNUOVI TURNI:\n" + "\n".join(lines),
+                    },
+                ],
+                timeout=90,
+                num_predict_override=max(64, RAG_SESSION_SUMMARY_MAX_CHARS // 3),
+                stage="session_summary",
+            )
+        except Exception as exc:
+            # I turni restano nel prompt come testo raw finche' un riassunto successivo non riesce.
+            print(f"[WARN] Riassunto sessione non aggiornato: {exc}", flush=True)
+            with _SESSION_HISTORY_LOCK:
+                summary.pending = False
+            return
+        updated = _truncate_for_prompt(updated, RAG_SESSION_SUMMARY_MAX_CHARS)
+
+        with _SESSION_HISTORY_LOCK:
+            if _SESSION_SUMMARIES.get(key) is not summary:
+                summary.pending = False
+                return
+            if updated:
+                summary.text = updated
+                summary.turns_folded = max(summary.turns_folded, fold_until)
+            else:
+                summary.pending = False
+                return
 
 def _build_recent_conversation_context(avatar_id: str, session_id: Optional[str], empirical_test_mode: bool = False) -> str:
     key = _session_history_key(avatar_id, session_id, empirical_test_mode)
@@ -2191,11 +3554,17 @@ def _build_recent_conversation_context(avatar_id: str, session_id: Optional[str]
 
     with _SESSION_HISTORY_LOCK:
         hist = list(_SESSION_HISTORIES.get(key, []))
-
-    if not hist:
+        summary = _SESSION_SUMMARIES.get(key)
+        summary_text = summary.text if summary is not None and RAG_SESSION_SUMMARY else ""
+        if summary_text:
+            # Riassunto + turni non ancora riassunti (almeno la finestra raw).
+            first_in_hist = summary.turns_total - len(hist)
+            hist = hist[max(0, summary.turns_folded - first_in_hist):]
+
+    if not hist and not summary_text:
         return "- Nessun turno precedente disponibile."
 
-    lines: list[str] = []
+    lines: list[str] = [f"- Riassunto sessione: {summary_text}"] if summary_text else []
     for user_turn, assistant_turn in hist[-_effective_session_turns():]:
         if user_turn:
             lines.append(f"- Utente: {user_turn}")
@@ -2343,6 +3712,7 @@ def _release_avatar_client_handles(avatar_id: str, empirical_test_mode: bool = F
     avatar_key = _safe_avatar_key(avatar_id)
     avatar_dir = _avatar_persist_dir(avatar_id, empirical_test_mode)
     client = _AVATAR_CLIENTS.pop((_mode_key(empirical_test_mode), avatar_key), None)
+    _close_lexical_index(avatar_dir)
     try:
         if client is None and os.path.isdir(avatar_dir):
             client = chromadb.PersistentClient(path=avatar_dir)
@@ -2453,102 +3823,450 @@ def describe_image_with_gemini(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore Gemini Vision: {e}")
 
-def _ensure_ocr_ready() -> bool:
-    """Verifica e configura OCR. Ritorna True se pronto, False altrimenti."""
-    if pytesseract is None or Image is None:
-        return False
+class _OcrEngine:
+    """
+    Tesseract risolto e verificato una volta (ricontrollo ogni RAG_OCR_RECHECK_SECONDS).
+    Con tesserocr tiene un pool di API in-process; altrimenti un subprocess pytesseract per immagine.
+    """
 
-    tcmd = TESSERACT_CMD or DEFAULT_TESSERACT_CMD
-    if tcmd and os.path.exists(tcmd):
-        pytesseract.pytesseract.tesseract_cmd = tcmd
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready_state: Optional[bool] = None
+        self.checked_at = 0.0
+        self.version = ""
+        self.backend = "none"
+        self.apis: "queue.Queue[Any]" = queue.Queue()
+        self.apis_created = 0
+        # Vero dopo un PyTessBaseAPI fallito: i ricontrolli periodici non tornano a tesserocr.
+        self.tesserocr_disabled = False
+        self.api_lang = RAG_OCR_LANG
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.last_ms = 0.0
+
+    def _probe(self) -> bool:
+        if Image is None:
+            return False
+        if tesserocr is not None and not self.tesserocr_disabled:
+            try:
+                self.version = str(tesserocr.tesseract_version()).splitlines()[0]
+                self.backend = "tesserocr"
+                return True
+            except Exception:
+                pass
+        if pytesseract is None:
+            return False
+        tcmd = TESSERACT_CMD or DEFAULT_TESSERACT_CMD
+        if tcmd and os.path.exists(tcmd):
+            pytesseract.pytesseract.tesseract_cmd = tcmd
+        try:
+            self.version = str(pytesseract.get_tesseract_version())
+            self.backend = "pytesseract"
+            return True
+        except Exception:
+            self.backend = "none"
+            return False
 
-    try:
-        pytesseract.get_tesseract_version()
-        return True
-    except Exception:
-        return False
+    def ready(self) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            if self.ready_state is not None and (now - self.checked_at) < RAG_OCR_RECHECK_SECONDS:
+                return self.ready_state
+            self.ready_state = self._probe()
+            self.checked_at = now
+            return self.ready_state
+
+    def _new_api(self) -> Any:
+        assert tesserocr is not None
+        tessdata = os.environ.get("TESSDATA_PREFIX") or ""
+        try:
+            return tesserocr.PyTessBaseAPI(path=tessdata, lang=self.api_lang) if tessdata else tesserocr.PyTessBaseAPI(lang=self.api_lang)
+        except Exception:
+            # Stesso fallback di pytesseract: senza i dati della lingua configurata si usa "eng".
+            self.api_lang = "eng"
+            return tesserocr.PyTessBaseAPI(path=tessdata, lang="eng") if tessdata else tesserocr.PyTessBaseAPI(lang="eng")
 
-def ocr_image_bytes(image_bytes: bytes) -> str:
-    if not _ensure_ocr_ready():
-        raise HTTPException(status_code=500, detail="OCR non disponibile: installa pytesseract/pillow e tesseract")
-    assert Image is not None
-    assert pytesseract is not None
-    img = Image.open(io.BytesIO(image_bytes))
-    try:
-        txt = pytesseract.image_to_string(img, lang=RAG_OCR_LANG)
-    except Exception:
+    def _disable_tesserocr(self) -> bool:
+        """Ripiega su pytesseract quando tesserocr non riesce a creare nessuna API."""
+        if pytesseract is None:
+            return False
+        tcmd = TESSERACT_CMD or DEFAULT_TESSERACT_CMD
+        if tcmd and os.path.exists(tcmd):
+            pytesseract.pytesseract.tesseract_cmd = tcmd
         try:
-            txt = pytesseract.image_to_string(img, lang="eng")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"OCR fallito: {e}")
-    return clean_text(txt)
+            self.version = str(pytesseract.get_tesseract_version())
+        except Exception:
+            return False
+        self.backend = "pytesseract"
+        self.tesserocr_disabled = True
+        return True
 
-def extract_text_from_pdf(pdf_bytes: bytes) -> List[Tuple[str, dict]]:
-    """Estrae testo da PDF tramite pymupdf4llm (Markdown strutturato).
+    def _acquire_api(self) -> Optional[Any]:
+        """API tesserocr dal pool; None se il backend e' passato a pytesseract."""
+        wait = 0.0
+        while True:
+            try:
+                return self.apis.get(timeout=wait) if wait else self.apis.get_nowait()
+            except queue.Empty:
+                pass
+            with self.lock:
+                if self.backend != "tesserocr":
+                    return None
+                create = self.apis_created < RAG_OCR_WORKERS
+                if create:
+                    self.apis_created += 1
+            if not create:
+                # Pool pieno: attesa a tempo, cosi' si ricontrolla se le API in creazione sono fallite.
+                wait = 0.5
+                continue
+            try:
+                return self._new_api()
+            except Exception as e:
+                with self.lock:
+                    self.apis_created -= 1
+                    if self.apis_created > 0:
+                        # Altre API gia' attive: si attende che una torni libera.
+                        continue
+                    if self.backend == "tesserocr" and not self._disable_tesserocr():
+                        raise
+                    print(f"[WARN] tesserocr non disponibile ({e}), uso pytesseract")
+                return None
+
+    def _image_to_string(self, img: Any) -> str:
+        if self.backend == "tesserocr":
+            api = self._acquire_api()
+            if api is not None:
+                try:
+                    api.SetImage(img)
+                    return api.GetUTF8Text()
+                finally:
+                    self.apis.put(api)
+        assert pytesseract is not None
+        try:
+            return pytesseract.image_to_string(img, lang=RAG_OCR_LANG)
+        except Exception:
+            return pytesseract.image_to_string(img, lang="eng")
 
-    - PDF nativi: estrazione diretta via pymupdf4llm
-    - PDF scannerizzati: se pymupdf4llm non estrae testo, fallback OCR via Tesseract
-    """
-    if not _pymupdf4llm_available:
-        raise HTTPException(status_code=500, detail="PDF parsing non disponibile: installa 'pymupdf4llm'.")
-    assert pymupdf is not None and pymupdf4llm is not None
+    def image_to_string(self, img: Any) -> Tuple[str, float]:
+        """Testo OCR e durata in ms."""
+        t0 = time.perf_counter()
+        try:
+            txt = self._image_to_string(img)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            raise
+        elapsed_ms = (time.perf_counter() - t0) * 1000.0
+        with self.lock:
+            self.calls += 1
+            self.total_ms += elapsed_ms
+            self.last_ms = elapsed_ms
+        return txt, elapsed_ms
+
+    def health(self) -> dict:
+        with self.lock:
+            return {
+                "ready": bool(self.ready_state),
+                "backend": self.backend,
+                "version": self.version,
+                "lang": self.api_lang if self.backend == "tesserocr" else RAG_OCR_LANG,
+                "api_pool": self.apis_created,
+                "calls": self.calls,
+                "errors": self.errors,
+                "avg_ms": round(self.total_ms / self.calls, 1) if self.calls else 0.0,
+                "last_ms": round(self.last_ms, 1),
+            }
 
-    ocr_ready = _ensure_ocr_ready()
+_OCR_ENGINE = _OcrEngine()
 
-    # Apri Document da bytes (pymupdf4llm non accetta bytes direttamente)
-    doc = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+def _ensure_ocr_ready() -> bool:
+    """Verifica e configura OCR. Ritorna True se pronto, False altrimenti."""
+    return _OCR_ENGINE.ready()
+
+def _otsu_threshold(gray: np.ndarray) -> int:
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    total = hist.sum()
+    if total <= 0:
+        return 128
+    levels = np.arange(256, dtype=np.float64)
+    w0 = np.cumsum(hist)
+    w1 = total - w0
+    m0 = np.cumsum(hist * levels)
+    mean_total = m0[-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mean_total * w0 - m0 * total) ** 2 / (w0 * w1)
+    between[~np.isfinite(between)] = 0.0
+    return int(np.argmax(between))
+
+def _estimate_text_line_px(gray: np.ndarray) -> Optional[float]:
+    """
+    Altezza mediana delle righe di testo (pixel) dal profilo orizzontale dell'inchiostro.
+    None se le righe non sono separabili (poche righe, pagina storta o rumorosa).
+    """
+    if gray.size == 0:
+        return None
+    ink = gray <= _otsu_threshold(gray)
+    row_has_ink = ink.sum(axis=1) >= max(2, int(gray.shape[1] * 0.002))
+    runs: list[int] = []
+    run = 0
+    for flag in row_has_ink.tolist():
+        if flag:
+            run += 1
+        elif run:
+            runs.append(run)
+            run = 0
+    if run:
+        runs.append(run)
+    runs = [r for r in runs if r >= 2]
+    if len(runs) < 5:
+        return None
+    median = float(np.median(runs))
+    # Righe fuse in blocchi: la stima non e' affidabile.
+    if median > gray.shape[0] * 0.08:
+        return None
+    return median
 
-    # Estrai testo via pymupdf4llm
-    pages: Any = []
+def _binarized_ocr_image(gray: np.ndarray) -> Any:
+    """Buffer L 0/255 (Otsu) passato direttamente a Tesseract, senza encode/decode PNG."""
+    assert Image is not None
+    threshold = _otsu_threshold(gray)
+    return Image.fromarray(np.where(gray <= threshold, 0, 255).astype(np.uint8), mode="L")
+
+def _pixmap_gray_array(pix: Any) -> np.ndarray:
+    arr = np.frombuffer(pix.samples, dtype=np.uint8)
+    return arr.reshape(pix.height, pix.stride)[:, : pix.width * pix.n][:, :: pix.n]
+
+def _choose_ocr_dpi(page: Any) -> Tuple[int, Optional[float]]:
+    if not RAG_OCR_ADAPTIVE_DPI:
+        return OCR_DPI, None
+    assert pymupdf is not None
+    probe = page.get_pixmap(dpi=RAG_OCR_PROBE_DPI, colorspace=pymupdf.csGRAY, alpha=False)
+    line_px = _estimate_text_line_px(_pixmap_gray_array(probe))
+    if line_px is None:
+        return OCR_DPI, None
+    dpi = RAG_OCR_PROBE_DPI * RAG_OCR_TARGET_LINE_PX / line_px
+    dpi = int(round(dpi / 25.0) * 25)
+    return max(RAG_OCR_DPI_MIN, min(OCR_DPI, dpi)), line_px
+
+def _ocr_gray(gray: np.ndarray) -> Tuple[str, float]:
     try:
-        pages = pymupdf4llm.to_markdown(doc, page_chunks=True)
-    except Exception as exc:
-        doc.close()
-        raise HTTPException(status_code=500, detail=f"Errore estrazione PDF: {exc}")
+        txt, elapsed_ms = _OCR_ENGINE.image_to_string(_binarized_ocr_image(gray))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"OCR fallito: {e}")
+    return clean_text(txt), elapsed_ms
 
-    sections: List[Tuple[str, dict]] = []
-    empty_page_indices: list[int] = []
-    total_pages = len(pages)
+def _ocr_usable(text: str) -> bool:
+    return bool(text) and len(text.strip()) >= 5 and not looks_like_garbage(text)
+
+def ocr_pdf_page(page: Any) -> Tuple[str, dict]:
+    """
+    OCR di una pagina PDF in scala di grigi al DPI scelto da _choose_ocr_dpi; se il risultato
+    non e' utilizzabile riprova a OCR_DPI. Ritorna testo e metadati (ocr_dpi, render_ms, ocr_ms).
+    """
+    if not _ensure_ocr_ready():
+        raise HTTPException(status_code=500, detail="OCR non disponibile: installa pytesseract/pillow e tesseract")
+    assert pymupdf is not None
+    t0 = time.perf_counter()
+    dpi, line_px = _choose_ocr_dpi(page)
+    info: dict[str, Any] = {}
+    attempts = [dpi] if dpi >= OCR_DPI else [dpi, OCR_DPI]
+    text = ""
+    for attempt_dpi in attempts:
+        t_render = time.perf_counter()
+        pix = page.get_pixmap(dpi=attempt_dpi, colorspace=pymupdf.csGRAY, alpha=False)
+        gray = _pixmap_gray_array(pix)
+        del pix
+        render_ms = (time.perf_counter() - t_render) * 1000.0
+        text, ocr_ms = _ocr_gray(gray)
+        info = {
+            "ocr_dpi": attempt_dpi,
+            "render_ms": round(render_ms, 1),
+            "ocr_ms": round(ocr_ms, 1),
+        }
+        if _ocr_usable(text):
+            break
+    if line_px is not None:
+        info["ocr_line_px"] = round(line_px, 1)
+    if len(attempts) > 1 and info.get("ocr_dpi") == OCR_DPI:
+        info["ocr_retry"] = True
+    info["ocr_total_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+    return text, info
+
+def ocr_image_timed(image: Union[bytes, str]) -> Tuple[str, dict]:
+    """
+    OCR di un'immagine caricata (bytes o path su disco): scala di grigi, ridimensionata in modo
+    che le righe stiano a ~RAG_OCR_TARGET_LINE_PX pixel (x0.25..x2), binarizzata.
+    Ritorna testo e metadati.
+    """
+    if not _ensure_ocr_ready():
+        raise HTTPException(status_code=500, detail="OCR non disponibile: installa pytesseract/pillow e tesseract")
+    assert Image is not None
+    with Image.open(io.BytesIO(image) if isinstance(image, bytes) else image) as src:
+        img = src.convert("L")
+    info: dict[str, Any] = {"ocr_scale": 1.0}
+    if RAG_OCR_ADAPTIVE_DPI:
+        line_px = _estimate_text_line_px(np.asarray(img))
+        if line_px is not None:
+            scale = max(0.25, min(2.0, RAG_OCR_TARGET_LINE_PX / line_px))
+            # Sotto il 20% di differenza non vale il resample.
+            if abs(scale - 1.0) >= 0.2:
+                img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.LANCZOS)
+                info["ocr_scale"] = round(scale, 3)
+            info["ocr_line_px"] = round(line_px, 1)
+    text, ocr_ms = _ocr_gray(np.asarray(img))
+    info["ocr_ms"] = round(ocr_ms, 1)
+    return text, info
+
+def ocr_image_bytes(image_bytes: bytes) -> str:
+    return ocr_image_timed(image_bytes)[0]
+
+def _extract_pdf_pages(
+    doc: Any,
+    page_indices: List[int],
+    ocr_ready: bool,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> List[Tuple[int, Optional[Tuple[str, dict]]]]:
+    """
+    pymupdf4llm + fallback OCR su un sottoinsieme di pagine di un Document aperto.
+    Ritorna (indice pagina, sezione o None) nello stesso ordine di page_indices.
+    progress(pagine_fatte, pagine_totali) dopo ogni pagina (solo percorso seriale, nel processo principale).
+    """
+    assert pymupdf4llm is not None
+    pages = pymupdf4llm.to_markdown(doc, pages=page_indices, page_chunks=True)
 
-    for i, page_data in enumerate(pages):
+    out: List[Tuple[int, Optional[Tuple[str, dict]]]] = []
+    for j, page_data in enumerate(pages):
+        idx = page_indices[j] if j < len(page_indices) else j
         raw_text = page_data.get("text", "") if isinstance(page_data, dict) else str(page_data)
         text = clean_text(raw_text)
         if text and len(text.strip()) >= 5 and not looks_like_garbage(text):
             meta_info = page_data.get("metadata", {}) if isinstance(page_data, dict) else {}
-            page_num = meta_info.get("page", i + 1) if isinstance(meta_info, dict) else (i + 1)
+            page_num = meta_info.get("page", idx + 1) if isinstance(meta_info, dict) else (idx + 1)
             meta = {
                 "page": page_num,
                 "method": "pymupdf4llm",
                 "ocr": False,
                 "text_length": len(text),
             }
-            sections.append((text, meta))
-        else:
-            empty_page_indices.append(i)
+            out.append((idx, (text, meta)))
+            if progress is not None:
+                progress(len(out), len(pages))
+            continue
 
-    # Fallback OCR per pagine vuote (PDF scannerizzati): rasterizza + pytesseract
-    if empty_page_indices and ocr_ready and pymupdf is not None:
-        assert pytesseract is not None
-        assert Image is not None
-        try:
-            for idx in empty_page_indices:
-                if idx < doc.page_count:
-                    page = doc[idx]
-                    pix = page.get_pixmap(dpi=OCR_DPI)
-                    img_bytes_png = pix.tobytes("png")
-                    ocr_text = ocr_image_bytes(img_bytes_png)
-                    if ocr_text and len(ocr_text.strip()) >= 5:
-                        meta = {
-                            "page": idx + 1,
-                            "method": "ocr_fallback",
-                            "ocr": True,
-                            "text_length": len(ocr_text),
-                        }
-                        sections.append((ocr_text, meta))
-        except Exception:
-            pass  # fallback OCR best-effort, non blocca
+        # Fallback OCR per pagine vuote (PDF scannerizzati): rasterizza + pytesseract
+        section: Optional[Tuple[str, dict]] = None
+        if ocr_ready and idx < doc.page_count:
+            try:
+                ocr_text, ocr_info = ocr_pdf_page(doc[idx])
+                if ocr_text and len(ocr_text.strip()) >= 5:
+                    section = (ocr_text, {
+                        "page": idx + 1,
+                        "method": "ocr_fallback",
+                        "ocr": True,
+                        "text_length": len(ocr_text),
+                        **ocr_info,
+                    })
+            except Exception:
+                pass  # fallback OCR best-effort, non blocca
+        out.append((idx, section))
+        if progress is not None:
+            progress(len(out), len(pages))
+    return out
+
+def _pdf_page_range_worker(pdf_path: str, start: int, end: int, ocr_ready: bool) -> List[Tuple[int, Optional[Tuple[str, dict]]]]:
+    """Eseguito nei processi del pool PDF: ogni worker apre il file dallo spool per conto suo."""
+    assert pymupdf is not None
+    doc = pymupdf.open(pdf_path)
+    try:
+        return _extract_pdf_pages(doc, list(range(start, min(end, doc.page_count))), ocr_ready)
+    finally:
+        doc.close()
+
+_PDF_POOL: Optional[ProcessPoolExecutor] = None
+_PDF_POOL_LOCK = threading.Lock()
+
+def _pdf_pool() -> ProcessPoolExecutor:
+    global _PDF_POOL
+    with _PDF_POOL_LOCK:
+        if _PDF_POOL is None:
+            # spawn: niente fork di un processo con thread uvicorn/chroma attivi.
+            _PDF_POOL = ProcessPoolExecutor(max_workers=RAG_PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _PDF_POOL
+
+def extract_text_from_pdf(
+    pdf_bytes: Optional[bytes],
+    progress: Optional[Callable[[int, int], None]] = None,
+    pdf_path: Optional[str] = None,
+) -> List[Tuple[str, dict]]:
+    """Estrae testo da PDF tramite pymupdf4llm (Markdown strutturato).
+
+    - PDF nativi: estrazione diretta via pymupdf4llm
+    - PDF scannerizzati: se pymupdf4llm non estrae testo, fallback OCR via Tesseract
+    - Oltre RAG_PDF_PAGES_PER_TASK pagine: range di pagine in parallelo sul pool di processi
+      (pdf_path evita di riscrivere i bytes su disco per i worker)
+    - Con pdf_path e pdf_bytes=None il documento viene aperto dal file, senza caricarlo in RAM
+    - progress(pagine_fatte, pagine_totali): puo' sollevare _IngestCancelled per interrompere
+    """
+    if not _pymupdf4llm_available:
+        raise HTTPException(status_code=500, detail="PDF parsing non disponibile: installa 'pymupdf4llm'.")
+    assert pymupdf is not None and pymupdf4llm is not None
+
+    ocr_ready = _ensure_ocr_ready()
 
-    doc.close()
+    # Apri Document dal file se disponibile, altrimenti da bytes (pymupdf4llm non accetta bytes)
+    if pdf_path:
+        doc = pymupdf.open(pdf_path, filetype="pdf")
+    else:
+        doc = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+    total_pages = int(doc.page_count)
+    per_task = max(1, RAG_PDF_PAGES_PER_TASK)
+    results: List[Tuple[int, Optional[Tuple[str, dict]]]] = []
+
+    if RAG_PDF_WORKERS <= 1 or total_pages <= per_task:
+        # Avanzamento pagina per pagina: pages_done resta aggiornato e la cancel ferma un OCR lungo.
+        try:
+            results = _extract_pdf_pages(doc, list(range(total_pages)), ocr_ready, progress=progress)
+        except (HTTPException, _IngestCancelled):
+            raise
+        except Exception as exc:
+            raise HTTPException(status_code=500, detail=f"Errore estrazione PDF: {exc}")
+        finally:
+            doc.close()
+    else:
+        doc.close()
+        temp_path = ""
+        if not pdf_path:
+            os.makedirs(RAG_INGEST_SPOOL_DIR, exist_ok=True)
+            temp_path = os.path.join(RAG_INGEST_SPOOL_DIR, f"pdf_{uuid.uuid4().hex}.pdf")
+            with open(temp_path, "wb") as handle:
+                handle.write(pdf_bytes or b"")
+        futures = [
+            _pdf_pool().submit(_pdf_page_range_worker, pdf_path or temp_path, start, start + per_task, ocr_ready)
+            for start in range(0, total_pages, per_task)
+        ]
+        try:
+            done_pages = 0
+            for fut in as_completed(futures):
+                try:
+                    chunk = fut.result()
+                except Exception as exc:
+                    raise HTTPException(status_code=500, detail=f"Errore estrazione PDF: {exc}")
+                results.extend(chunk)
+                done_pages += len(chunk)
+                if progress is not None:
+                    progress(done_pages, total_pages)
+        finally:
+            for fut in futures:
+                fut.cancel()
+            if temp_path:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    results.sort(key=lambda item: item[0])
+    sections: List[Tuple[str, dict]] = [section for _, section in results if section is not None]
 
     if not sections:
         raise HTTPException(
@@ -2594,8 +4312,81 @@ def chunk_text(text: str, chunk_chars: int = CHUNK_CHARS, overlap: int = CHUNK_O
 
     return chunks
 
-def _dedupe_chunks(docs: List[str], metas: List[dict], similarity: float = 0.92) -> Tuple[List[str], List[dict]]:
+# Near-duplicate: MinHash + LSH (bande nell'indice lessicale) solo per trovare i candidati nel
+# corpus dell'avatar, Jaccard su shingle di 3 parole come filtro veloce, conferma finale con lo
+# stesso controllo a caratteri di difflib (>= _DEDUPE_SIMILARITY): fatti brevi che differiscono
+# solo nel valore (numero di telefono, password) restano distinti.
+_DEDUPE_SIMILARITY = 0.92
+_SHINGLE_WORDS = 3
+_MINHASH_BANDS = 20
+_MINHASH_ROWS = 3
+_MINHASH_PRIME = np.uint64(4294967311)
+_MINHASH_RNG = np.random.RandomState(20240917)
+_MINHASH_A = _MINHASH_RNG.randint(1, 2**31 - 1, size=_MINHASH_BANDS * _MINHASH_ROWS).astype(np.uint64)
+_MINHASH_B = _MINHASH_RNG.randint(0, 2**31 - 1, size=_MINHASH_BANDS * _MINHASH_ROWS).astype(np.uint64)
+
+def _dedupe_norm(text: str) -> str:
+    return clean_text(text).lower() if text else ""
+
+def _shingle_hashes(norm: str) -> frozenset[int]:
+    words = _LEXICAL_TOKEN_RE.findall(norm or "")
+    if not words:
+        return frozenset()
+    k = _SHINGLE_WORDS
+    return frozenset(
+        zlib.crc32(" ".join(words[i:i + k]).encode("utf-8"))
+        for i in range(max(1, len(words) - k + 1))
+    )
+
+def _shingle_jaccard_threshold(similarity: float) -> float:
+    """
+    Soglia Jaccard equivalente a una quota `similarity` di parole invariate: uno shingle di k parole
+    sopravvive con probabilita' s^k, quindi J = s^k / (2 - s^k) (0.92 -> ~0.64 con k=3).
+    """
+    survive = max(0.0, min(1.0, float(similarity))) ** _SHINGLE_WORDS
+    return survive / (2.0 - survive)
+
+def _is_near_duplicate(
+    norm_a: str, sh_a: frozenset[int], norm_b: str, sh_b: frozenset[int], threshold: float, similarity: float,
+) -> bool:
+    if norm_a == norm_b:
+        return True
+    if not sh_a or not sh_b:
+        return False
+    small, large = sorted((len(sh_a), len(sh_b)))
+    if small < threshold * large:
+        return False
+    inter = len(sh_a & sh_b)
+    if inter / float(len(sh_a) + len(sh_b) - inter) < threshold:
+        return False
+    matcher = difflib.SequenceMatcher(None, norm_a, norm_b)
+    return matcher.quick_ratio() >= similarity and matcher.ratio() >= similarity
+
+def _minhash_band_keys(shingles: frozenset[int]) -> list[tuple[int, int]]:
+    if not shingles:
+        return []
+    hashes = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+    sig = ((_MINHASH_A[:, None] * hashes[None, :] + _MINHASH_B[:, None]) % _MINHASH_PRIME).min(axis=1)
+    rows = _MINHASH_ROWS
+    return [(band, zlib.crc32(sig[band * rows:(band + 1) * rows].tobytes())) for band in range(_MINHASH_BANDS)]
+
+def _dedupe_chunks(docs: List[str], metas: List[dict], similarity: float = _DEDUPE_SIMILARITY) -> Tuple[List[str], List[dict]]:
     """Rimuove duplicati (similarity > 0.92)."""
+    if not docs:
+        return docs, metas
+    threshold = _shingle_jaccard_threshold(similarity)
+    kept = []
+    for d, m in zip(docs, metas):
+        norm = _dedupe_norm(d)
+        if not norm:
+            continue
+        shingles = _shingle_hashes(norm)
+        if not any(_is_near_duplicate(norm, shingles, kn, ks, threshold, similarity) for _, _, kn, ks in kept):
+            kept.append((d, m or {}, norm, shingles))
+    return ([k[0] for k in kept], [k[1] for k in kept]) if kept else ([], [])
+
+def _dedupe_chunks_difflib(docs: List[str], metas: List[dict], similarity: float = _DEDUPE_SIMILARITY) -> Tuple[List[str], List[dict]]:
+    """Vecchia dedupe O(n^2) con difflib, tenuta solo come riferimento per bench_dedupe."""
     if not docs:
         return docs, metas
     kept = []
@@ -2605,6 +4396,555 @@ def _dedupe_chunks(docs: List[str], metas: List[dict], similarity: float = 0.92)
             kept.append((d, m or {}, norm))
     return (list(map(lambda x: x[0], kept)), list(map(lambda x: x[1], kept))) if kept else ([], [])
 
+def _find_near_duplicates(
+    col: Any,
+    ids: Sequence[str],
+    docs: Sequence[str],
+    similarity: float = _DEDUPE_SIMILARITY,
+    ignore_ids: Optional[set[str]] = None,
+    exact_only: bool = False,
+) -> list[Optional[str]]:
+    """
+    Per ogni chunk in ingresso: id del chunk quasi identico (nel corpus dell'avatar o prima
+    nello stesso batch), None se e' nuovo. Senza indice lessicale controlla solo il batch.
+    ignore_ids: chunk in uscita (es. versione precedente dello stesso file), mai usati come originale.
+    exact_only: duplicato solo se il testo normalizzato coincide (ricordi manuali).
+    """
+    threshold = _shingle_jaccard_threshold(similarity)
+
+    def same(norm_a: str, sh_a: frozenset[int], norm_b: str, sh_b: frozenset[int]) -> bool:
+        if exact_only:
+            return norm_a == norm_b
+        return _is_near_duplicate(norm_a, sh_a, norm_b, sh_b, threshold, similarity)
+
+    index = _lexical_index_for(col)
+    batch: list[tuple[str, frozenset[int], str]] = []
+    out: list[Optional[str]] = []
+    for doc_id, doc in zip(ids, docs):
+        norm = _dedupe_norm(doc)
+        shingles = _shingle_hashes(norm)
+        dup = next((bid for bn, bs, bid in batch if same(norm, shingles, bn, bs)), None)
+        if dup is None and index is not None and shingles:
+            candidates = index.near_duplicate_candidates(_minhash_band_keys(shingles), limit=8)
+            if ignore_ids:
+                candidates = [cand for cand in candidates if cand not in ignore_ids]
+            if candidates:
+                res = col.get(ids=candidates, include=["documents"])
+                for cand_id, cand_doc in zip(res.get("ids") or [], res.get("documents") or []):
+                    cand_norm = _dedupe_norm(cand_doc or "")
+                    if same(norm, shingles, cand_norm, _shingle_hashes(cand_norm)):
+                        dup = cand_id
+                        break
+        out.append(dup)
+        if dup is None:
+            batch.append((norm, shingles, doc_id))
+    return out
+
+_LEXICAL_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_LEXICAL_INDEX_FILENAME = "_lexical_index.sqlite3"
+_LEXICAL_INDEX_SCHEMA = 3  # PRAGMA user_version; se piu' vecchio l'indice viene ricostruito
+_BM25_K1 = 1.5
+_BM25_B = 0.75
+_RRF_K = 60
+
+def _lexical_tokens(text: str) -> list[str]:
+    return _LEXICAL_TOKEN_RE.findall(clean_text(text or "").lower())
+
+class _LexicalIndex:
+    """
+    Indice invertito BM25 sull'intera memoria di un avatar, piu' una tabella chunk_meta
+    (source_type, source_filename, page, hash file/chunk) per le probe per nome file e per
+    riconoscere i file gia' caricati.
+    Aggiornato in modo incrementale a ogni add; si riallinea a Chroma alla prima apertura
+    se il numero di documenti non coincide (avatar esistenti, restore, crash).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        # Serializza il riallineamento: le probe parallele non devono ricostruire l'indice due volte.
+        self.sync_lock = threading.Lock()
+        self.synced = False
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, length INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, id TEXT NOT NULL, tf INTEGER NOT NULL,"
+            " PRIMARY KEY (term, id)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS postings_by_id ON postings(id);"
+            "CREATE TABLE IF NOT EXISTS chunk_meta (id TEXT PRIMARY KEY, source_type TEXT, source_filename TEXT, page INTEGER);"
+            "CREATE INDEX IF NOT EXISTS chunk_meta_by_file ON chunk_meta(source_type, source_filename);"
+            "CREATE TABLE IF NOT EXISTS minhash_bands (band INTEGER NOT NULL, key INTEGER NOT NULL, id TEXT NOT NULL,"
+            " PRIMARY KEY (band, key, id)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS minhash_bands_by_id ON minhash_bands(id);"
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(chunk_meta)")}
+        for column in ("file_sha256", "chunk_sha"):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE chunk_meta ADD COLUMN {column} TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chunk_meta_by_file_sha ON chunk_meta(file_sha256)")
+        self.conn.commit()
+        self.schema_stale = int(self.conn.execute("PRAGMA user_version").fetchone()[0]) < _LEXICAL_INDEX_SCHEMA
+        row = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+        self.doc_count = int(row[0])
+        self.total_length = int(row[1])
+
+    def _delete_locked(self, ids: Sequence[str]) -> None:
+        for doc_id in ids:
+            row = self.conn.execute("SELECT length FROM docs WHERE id = ?", (doc_id,)).fetchone()
+            if row is None:
+                continue
+            terms = [t for (t,) in self.conn.execute("SELECT term FROM postings WHERE id = ?", (doc_id,))]
+            self.conn.executemany("UPDATE terms SET df = df - 1 WHERE term = ?", [(t,) for t in terms])
+            self.conn.execute("DELETE FROM postings WHERE id = ?", (doc_id,))
+            self.conn.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+            self.conn.execute("DELETE FROM chunk_meta WHERE id = ?", (doc_id,))
+            self.conn.execute("DELETE FROM minhash_bands WHERE id = ?", (doc_id,))
+            self.doc_count -= 1
+            self.total_length -= int(row[0])
+
+    def add(self, ids: Sequence[str], documents: Sequence[str], metadatas: Optional[Sequence[Any]] = None) -> None:
+        with self.lock, self.conn:
+            self._delete_locked(ids)
+            for i, (doc_id, doc) in enumerate(zip(ids, documents)):
+                meta = (metadatas[i] if metadatas is not None and i < len(metadatas) else None) or {}
+                page = meta.get("page")
+                self.conn.execute(
+                    "INSERT INTO chunk_meta (id, source_type, source_filename, page, file_sha256, chunk_sha)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        doc_id,
+                        str(meta.get("source_type") or ""),
+                        str(meta.get("source_filename") or ""),
+                        int(page) if isinstance(page, (int, float)) else None,
+                        str(meta.get("file_sha256") or "") or None,
+                        str(meta.get("chunk_sha") or "") or None,
+                    ),
+                )
+                tf: dict[str, int] = {}
+                tokens = _lexical_tokens(doc)
+                for tok in tokens:
+                    tf[tok] = tf.get(tok, 0) + 1
+                self.conn.execute("INSERT INTO docs (id, length) VALUES (?, ?)", (doc_id, len(tokens)))
+                self.conn.executemany(
+                    "INSERT INTO postings (term, id, tf) VALUES (?, ?, ?)",
+                    [(t, doc_id, n) for t, n in tf.items()],
+                )
+                self.conn.executemany(
+                    "INSERT INTO terms (term, df) VALUES (?, 1) ON CONFLICT(term) DO UPDATE SET df = df + 1",
+                    [(t,) for t in tf],
+                )
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO minhash_bands (band, key, id) VALUES (?, ?, ?)",
+                    [(band, key, doc_id) for band, key in _minhash_band_keys(_shingle_hashes(_dedupe_norm(doc)))],
+                )
+                self.doc_count += 1
+                self.total_length += len(tokens)
+
+    def delete(self, ids: Sequence[str]) -> None:
+        with self.lock, self.conn:
+            self._delete_locked(ids)
+
+    def rebuild(self, col: Any, page_size: int = 500) -> None:
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM postings")
+            self.conn.execute("DELETE FROM terms")
+            self.conn.execute("DELETE FROM docs")
+            self.conn.execute("DELETE FROM chunk_meta")
+            self.conn.execute("DELETE FROM minhash_bands")
+            self.doc_count = 0
+            self.total_length = 0
+        offset = 0
+        while True:
+            res = col.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+            ids = res.get("ids") or []
+            if not ids:
+                break
+            docs = [d if isinstance(d, str) else "" for d in (res.get("documents") or [])]
+            self.add(ids, docs, res.get("metadatas") or [])
+            offset += len(ids)
+        with self.lock, self.conn:
+            self.conn.execute(f"PRAGMA user_version = {_LEXICAL_INDEX_SCHEMA}")
+        self.schema_stale = False
+        self.synced = True
+
+    def ensure_synced(self, col: Any) -> None:
+        if self.synced:
+            return
+        with self.sync_lock:
+            if self.synced:
+                return
+            try:
+                with self.lock:
+                    meta_rows = int(self.conn.execute("SELECT COUNT(*) FROM chunk_meta").fetchone()[0])
+                if self.schema_stale or int(col.count()) != self.doc_count or meta_rows != self.doc_count:
+                    print(f"[INFO] Ricostruzione indice lessicale {self.path} ({self.doc_count} -> {col.count()} documenti)", flush=True)
+                    self.rebuild(col)
+            finally:
+                self.synced = True
+
+    def score(self, query: str, limit: int = 0, restrict_ids: Optional[set[str]] = None) -> list[tuple[str, float]]:
+        """BM25 con statistiche sull'intero corpus; limit>0 = top risultati, altrimenti solo restrict_ids."""
+        terms = list(dict.fromkeys(_lexical_tokens(query)))
+        if not terms or self.doc_count <= 0:
+            return []
+        n_docs = self.doc_count
+        avgdl = (self.total_length / n_docs) or 1.0
+        scores: dict[str, float] = {}
+        with self.lock:
+            for term in terms:
+                row = self.conn.execute("SELECT df FROM terms WHERE term = ?", (term,)).fetchone()
+                df = int(row[0]) if row else 0
+                if df <= 0:
+                    continue
+                idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+                postings = self.conn.execute(
+                    "SELECT p.id, p.tf, d.length FROM postings p JOIN docs d ON d.id = p.id WHERE p.term = ?",
+                    (term,),
+                )
+                for doc_id, tf, length in postings:
+                    if restrict_ids is not None and doc_id not in restrict_ids:
+                        continue
+                    denom = tf + _BM25_K1 * (1.0 - _BM25_B + _BM25_B * (length / avgdl))
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * (tf * (_BM25_K1 + 1.0)) / denom
+        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        return ranked[:limit] if limit > 0 else ranked
+
+    def near_duplicate_candidates(self, band_keys: Sequence[tuple[int, int]], limit: int = 8) -> list[str]:
+        """Id che condividono almeno una banda MinHash, i piu' simili per primi."""
+        if not band_keys:
+            return []
+        placeholders = ",".join("(?, ?)" for _ in band_keys)
+        params = [v for pair in band_keys for v in pair]
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT id, COUNT(*) AS hits FROM minhash_bands WHERE (band, key) IN (VALUES {placeholders}) "
+                "GROUP BY id ORDER BY hits DESC LIMIT ?",
+                (*params, max(1, int(limit))),
+            )
+            return [doc_id for doc_id, _ in rows]
+
+    def ids_for_file_sha(self, file_sha256: str) -> list[str]:
+        with self.lock:
+            rows = self.conn.execute("SELECT id FROM chunk_meta WHERE file_sha256 = ?", (file_sha256,))
+            return [doc_id for (doc_id,) in rows]
+
+    def file_chunks(self, source_filename: str) -> list[tuple[str, str]]:
+        """(id, chunk_sha) dei chunk ingeriti da un file; chunk_sha vuoto per chunk precedenti agli hash."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, COALESCE(chunk_sha, '') FROM chunk_meta WHERE source_type = 'file' AND source_filename = ?",
+                (source_filename,),
+            )
+            return [(doc_id, chunk_sha) for doc_id, chunk_sha in rows]
+
+    def ids_for_matching_filenames(self, query: str, source_type: str, min_boost: float, limit: int) -> list[str]:
+        """
+        Id dei chunk i cui file ottengono almeno min_boost da _filename_overlap_boost.
+        Il boost si calcola una volta per nome file distinto, non per chunk.
+        """
+        with self.lock:
+            filenames = [
+                fn for (fn,) in self.conn.execute(
+                    "SELECT DISTINCT source_filename FROM chunk_meta WHERE source_type = ? AND source_filename != ''",
+                    (source_type,),
+                )
+            ]
+            matching = [fn for fn in filenames if _filename_overlap_boost(query, {"source_filename": fn}) >= min_boost]
+            if not matching:
+                return []
+            placeholders = ",".join("?" for _ in matching)
+            rows = self.conn.execute(
+                f"SELECT id FROM chunk_meta WHERE source_type = ? AND source_filename IN ({placeholders}) "
+                "ORDER BY source_filename, page LIMIT ?",
+                (source_type, *matching, max(1, int(limit))),
+            )
+            return [doc_id for (doc_id,) in rows]
+
+    def close(self) -> None:
+        with self.lock:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+
+_LEXICAL_INDEXES: dict[str, _LexicalIndex] = {}
+_LEXICAL_INDEXES_LOCK = threading.Lock()
+
+def _collection_persist_dir(col: Any) -> Optional[str]:
+    """Cartella del PersistentClient che possiede la collection (stessi internals usati per lo stop system)."""
+    try:
+        settings = col._client._system.settings
+        return getattr(settings, "persist_directory", None) or None
+    except Exception:
+        return None
+
+def _lexical_index_for(col: Any) -> Optional[_LexicalIndex]:
+    if not RAG_LEXICAL_INDEX:
+        return None
+    persist_dir = _collection_persist_dir(col)
+    if not persist_dir or not os.path.isdir(persist_dir):
+        return None
+    key = os.path.abspath(persist_dir)
+    with _LEXICAL_INDEXES_LOCK:
+        index = _LEXICAL_INDEXES.get(key)
+        if index is None:
+            try:
+                index = _LexicalIndex(os.path.join(key, _LEXICAL_INDEX_FILENAME))
+            except Exception as e:
+                print(f"[WARN] Indice lessicale non disponibile per {key}: {e}", flush=True)
+                return None
+            _LEXICAL_INDEXES[key] = index
+    try:
+        index.ensure_synced(col)
+    except Exception as e:
+        print(f"[WARN] Riallineamento indice lessicale fallito per {key}: {e}", flush=True)
+    return index
+
+def _close_lexical_index(avatar_dir: str, drop: bool = False) -> None:
+    """Chiude l'handle SQLite (necessario prima di copy/rmtree su Windows); drop=True elimina anche il file."""
+    key = os.path.abspath(avatar_dir)
+    with _LEXICAL_INDEXES_LOCK:
+        index = _LEXICAL_INDEXES.pop(key, None)
+    if index is not None:
+        index.close()
+    if drop:
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(os.path.join(key, _LEXICAL_INDEX_FILENAME + suffix))
+            except OSError:
+                pass
+
+def _memory_add(
+    col: Any,
+    ids: List[str],
+    embeddings: List[List[float]],
+    documents: List[str],
+    metadatas: List[Any],
+) -> None:
+    """col.add piu' aggiornamento degli indici per avatar e feature lessicali nei metadata."""
+    metadatas = [
+        {**(meta or {}), **_lexical_features(doc, meta)}
+        for doc, meta in zip(documents, metadatas)
+    ]
+    col.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+    index = _lexical_index_for(col)
+    if index is not None:
+        try:
+            index.add(ids, documents, metadatas)
+        except Exception as e:
+            # L'indice si riallinea da Chroma alla prossima apertura.
+            index.synced = False
+            print(f"[WARN] Aggiornamento indice lessicale fallito: {e}", flush=True)
+
+def _memory_update_metadata(col: Any, ids: List[str], documents: List[str], metadatas: List[Any]) -> None:
+    """col.update dei metadata (completi, non parziali) tenendo allineato l'indice per avatar."""
+    if not ids:
+        return
+    col.update(ids=ids, metadatas=metadatas)
+    index = _lexical_index_for(col)
+    if index is not None:
+        try:
+            index.add(ids, documents, metadatas)
+        except Exception as e:
+            index.synced = False
+            print(f"[WARN] Aggiornamento indice lessicale fallito: {e}", flush=True)
+
+def _memory_delete(col: Any, ids: List[str]) -> None:
+    if not ids:
+        return
+    col.delete(ids=ids)
+    index = _lexical_index_for(col)
+    if index is not None:
+        try:
+            index.delete(ids)
+        except Exception as e:
+            index.synced = False
+            print(f"[WARN] Aggiornamento indice lessicale fallito: {e}", flush=True)
+
+def _chunk_sha(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def _ingested_file_ids(col: Any, file_sha256: str) -> list[str]:
+    """Id dei chunk gia' ingeriti da un file con questo sha256 (qualunque nome file)."""
+    index = _lexical_index_for(col)
+    if index is not None:
+        return index.ids_for_file_sha(file_sha256)
+    res = col.get(where={"file_sha256": file_sha256}, include=[])
+    return list(res.get("ids") or [])
+
+def _previous_file_chunks(col: Any, filename: str) -> list[tuple[str, str]]:
+    """(id, chunk_sha) dei chunk gia' presenti per questo nome file; l'hash mancante si ricalcola dal testo."""
+    index = _lexical_index_for(col)
+    if index is not None:
+        rows = index.file_chunks(filename)
+    else:
+        res = col.get(where={"$and": [{"source_type": "file"}, {"source_filename": filename}]}, include=["metadatas"])
+        rows = [
+            (doc_id, str((meta or {}).get("chunk_sha") or ""))
+            for doc_id, meta in zip(res.get("ids") or [], res.get("metadatas") or [])
+        ]
+    missing = [doc_id for doc_id, sha in rows if not sha]
+    if missing:
+        res = col.get(ids=missing, include=["documents"])
+        hashed = {doc_id: _chunk_sha(doc or "") for doc_id, doc in zip(res.get("ids") or [], res.get("documents") or [])}
+        rows = [(doc_id, sha or hashed.get(doc_id, "")) for doc_id, sha in rows]
+    return rows
+
+_VectorRow = Tuple[Any, Optional[dict], Any, str]  # (documento, metadata, distanza, id)
+
+_CANDIDATE_POOL_STATS: dict[str, int] = {"pool_queries": 0, "served_from_pool": 0, "chroma_fallbacks": 0, "fallback_cache_hits": 0}
+
+def _where_matcher(where: Optional[dict]):
+    """Filtri `where` che il pool sa valutare in memoria: nessuno, source_type uguale o $in."""
+    if not where:
+        return lambda meta: True
+    if set(where) != {"source_type"}:
+        return None
+    cond = where["source_type"]
+    if isinstance(cond, str):
+        return lambda meta: (meta or {}).get("source_type") == cond
+    if isinstance(cond, dict) and set(cond) == {"$in"}:
+        allowed = set(cond["$in"])
+        return lambda meta: (meta or {}).get("source_type") in allowed
+    return None
+
+class _CandidatePool:
+    """
+    Una query vettoriale larga per embedding, riusata da tutte le probe della stessa richiesta.
+    Una probe filtrata e' servita dal pool quando contiene almeno n_results righe che passano il
+    filtro (nessun documento fuori dal pool puo' essere piu' vicino) oppure quando il pool copre
+    tutta la collection; altrimenti si torna alla query Chroma filtrata.
+    """
+
+    def __init__(self, col: Any, size: int):
+        self.col = col
+        self.size = size
+        self._rows: dict[bytes, tuple[list[_VectorRow], bool]] = {}
+        self._fallbacks: dict[tuple[bytes, str, int], list[_VectorRow]] = {}
+        # Le probe parallele condividono il pool: la query larga parte una volta sola.
+        self._load_lock = threading.Lock()
+
+    def _load(self, key: bytes, query_embedding: List[float]) -> tuple[list[_VectorRow], bool]:
+        with self._load_lock:
+            if key not in self._rows:
+                rows = _chroma_vector_rows(self.col, query_embedding, self.size, None)
+                _CANDIDATE_POOL_STATS["pool_queries"] += 1
+                self._rows[key] = (rows, len(rows) < self.size)
+            return self._rows[key]
+
+    def query(self, query_embedding: List[float], n_results: int, where: Optional[dict]) -> list[_VectorRow]:
+        key = array("f", query_embedding).tobytes()
+        matcher = _where_matcher(where)
+        if matcher is not None:
+            rows, exhaustive = self._load(key, query_embedding)
+            filtered = [row for row in rows if matcher(row[1])]
+            if len(filtered) >= n_results or exhaustive:
+                _CANDIDATE_POOL_STATS["served_from_pool"] += 1
+                return filtered[:n_results]
+
+        fallback_key = (key, json.dumps(where or {}, sort_keys=True), n_results)
+        if fallback_key in self._fallbacks:
+            _CANDIDATE_POOL_STATS["fallback_cache_hits"] += 1
+            return self._fallbacks[fallback_key]
+        rows = _chroma_vector_rows(self.col, query_embedding, n_results, where)
+        _CANDIDATE_POOL_STATS["chroma_fallbacks"] += 1
+        self._fallbacks[fallback_key] = rows
+        return rows
+
+_ACTIVE_CANDIDATE_POOL: ContextVar[Optional[_CandidatePool]] = ContextVar("_ACTIVE_CANDIDATE_POOL", default=None)
+
+@contextmanager
+def _candidate_pool_scope(col: Any):
+    """Attiva un pool di candidati per la durata di una retrieval sulla collection indicata."""
+    if RAG_CANDIDATE_POOL_SIZE <= 0 or _ACTIVE_CANDIDATE_POOL.get() is not None:
+        yield
+        return
+    token = _ACTIVE_CANDIDATE_POOL.set(_CandidatePool(col, RAG_CANDIDATE_POOL_SIZE))
+    try:
+        yield
+    finally:
+        _ACTIVE_CANDIDATE_POOL.reset(token)
+
+_PROBE_EXECUTOR = ThreadPoolExecutor(max_workers=RAG_PROBE_WORKERS, thread_name_prefix="rag-probe")
+
+def _run_probes(*probes: Optional[Callable[[], list]]) -> list[list]:
+    """
+    Esegue probe di retrieval indipendenti e ritorna i risultati nell'ordine dato, quindi i merge
+    a valle (sorted stabile) danno lo stesso ranking della versione seriale; None = probe non
+    necessaria ([]). Ogni probe gira in una copia del contesto: pool di candidati e piano
+    embedding della richiesta restano visibili.
+    """
+    if not RAG_PARALLEL_PROBES or sum(1 for probe in probes if probe is not None) <= 1:
+        return [probe() if probe is not None else [] for probe in probes]
+    futures = [
+        _PROBE_EXECUTOR.submit(copy_context().run, probe) if probe is not None else None
+        for probe in probes
+    ]
+    return [fut.result() if fut is not None else [] for fut in futures]
+
+def _chroma_vector_rows(col: Any, query_embedding: List[float], n_results: int, where: Optional[dict]) -> list[_VectorRow]:
+    kwargs: dict[str, Any] = {
+        "query_embeddings": [query_embedding],
+        "n_results": n_results,
+        "include": ["documents", "metadatas", "distances"],
+    }
+    if where:
+        kwargs["where"] = where
+    res = col.query(**kwargs)
+    docs = (res.get("documents") or [[]])[0]
+    metas = (res.get("metadatas") or [[]])[0]
+    dists = (res.get("distances") or [[]])[0]
+    ids = (res.get("ids") or [[]])[0]
+    return list(zip(docs, metas, dists, ids))
+
+def _vector_rows_for_ids(
+    col: Any,
+    query_embedding: List[float],
+    ids: List[str],
+    lexical_index: Optional[_LexicalIndex] = None,
+) -> list[_VectorRow]:
+    """
+    Documenti, metadata e distanza dalla query per id noti (es. match solo lessicali).
+    Chroma fallisce su id inesistenti: gli id non piu' presenti (indice disallineato a parita'
+    di conteggio, es. delete + add) vengono scartati e rimossi dall'indice lessicale.
+    """
+    if not ids:
+        return []
+    present = set(col.get(ids=ids, include=[]).get("ids") or [])
+    stale = [doc_id for doc_id in ids if doc_id not in present]
+    if stale:
+        if lexical_index is not None:
+            lexical_index.delete(stale)
+            print(f"[INFO] Indice lessicale {lexical_index.path}: rimossi {len(stale)} id non piu' in Chroma", flush=True)
+        ids = [doc_id for doc_id in ids if doc_id in present]
+        if not ids:
+            return []
+    res = col.query(
+        query_embeddings=[query_embedding],
+        ids=ids,
+        n_results=len(ids),
+        include=["documents", "metadatas", "distances"],
+    )
+    return list(zip(
+        (res.get("documents") or [[]])[0],
+        (res.get("metadatas") or [[]])[0],
+        (res.get("distances") or [[]])[0],
+        (res.get("ids") or [[]])[0],
+    ))
+
+def _query_vector_rows(col: Any, query_embedding: List[float], n_results: int, where: Optional[dict] = None) -> list[_VectorRow]:
+    """(doc, meta, distance) ordinati per distanza; passa dal pool della richiesta se attivo."""
+    pool = _ACTIVE_CANDIDATE_POOL.get()
+    if pool is not None and pool.col is col:
+        return pool.query(query_embedding, n_results, where)
+    return _chroma_vector_rows(col, query_embedding, n_results, where)
+
+def _candidate_pool_health() -> dict[str, Any]:
+    return {"size": RAG_CANDIDATE_POOL_SIZE, **_CANDIDATE_POOL_STATS}
+
 def _hybrid_search_ranked(
     query: str,
     query_embedding: List[float],
@@ -2612,29 +4952,46 @@ def _hybrid_search_ranked(
     top_k: int = 20,
     bm25_weight: float = 0.6,
 ) -> List[Tuple[float, str, dict]]:
-    """Ricerca ibrida BM25+vector → lista ranked (score, doc, meta)."""
+    """
+    Ricerca ibrida BM25+vector → lista ranked (score, doc, meta).
+    Con l'indice lessicale dell'avatar il BM25 usa statistiche sull'intero corpus e i match
+    solo lessicali entrano tra i candidati; quali candidati restano (top_k) lo decide la
+    reciprocal rank fusion delle due liste, mentre lo score restituito resta la media pesata
+    normalizzata usata dalle soglie a valle.
+    """
     try:
         candidate_k = min(top_k * 3, 100)
-        res = col.query(
-            query_embeddings=[query_embedding],
-            n_results=candidate_k,
-            include=["documents", "metadatas", "distances"],
-        )
-        vec_docs = (res.get("documents") or [[]])[0]
-        vec_metas = (res.get("metadatas") or [[]])[0]
-        vec_distances = (res.get("distances") or [[]])[0]
-
         candidates: list[tuple[str, dict, float | None]] = []
-        for d, m, dist in zip(vec_docs, vec_metas, vec_distances):
+        candidate_ids: list[str] = []
+        for d, m, dist, doc_id in _query_vector_rows(col, query_embedding, candidate_k):
             if not isinstance(d, str) or not d.strip():
                 continue
             candidates.append((d, m or {}, dist if isinstance(dist, (int, float)) else None))
+            candidate_ids.append(str(doc_id))
+        vector_rank = {doc_id: rank for rank, doc_id in enumerate(candidate_ids)}
+
+        lexical_index = _lexical_index_for(col)
+        lexical_scores: dict[str, float] = {}
+        lexical_rank: dict[str, int] = {}
+        if lexical_index is not None:
+            lexical_all = lexical_index.score(query)
+            lexical_scores = dict(lexical_all)
+            lexical_rank = {doc_id: rank for rank, (doc_id, _) in enumerate(lexical_all[:candidate_k])}
+            lexical_only = [doc_id for doc_id in lexical_rank if doc_id not in vector_rank]
+            for d, m, dist, doc_id in _vector_rows_for_ids(col, query_embedding, lexical_only, lexical_index):
+                if not isinstance(d, str) or not d.strip():
+                    continue
+                candidates.append((d, m or {}, dist if isinstance(dist, (int, float)) else None))
+                candidate_ids.append(str(doc_id))
         if not candidates:
             return []
 
-        tokenized_docs = [d.lower().split() for d, _, _ in candidates]
-        bm25 = BM25Okapi(tokenized_docs)
-        bm25_scores = bm25.get_scores(query.lower().split())
+        if lexical_index is not None:
+            bm25_scores = [lexical_scores.get(doc_id, 0.0) for doc_id in candidate_ids]
+        else:
+            tokenized_docs = [d.lower().split() for d, _, _ in candidates]
+            bm25 = BM25Okapi(tokenized_docs)
+            bm25_scores = list(bm25.get_scores(query.lower().split()))
         max_bm25 = max(bm25_scores) if max(bm25_scores) > 0 else 1
         bm25_norm = [s / max_bm25 for s in bm25_scores]
 
@@ -2643,13 +5000,29 @@ def _hybrid_search_ranked(
         vec_norm = [s / max_vec for s in vec_scores_raw]
 
         ranked: list[tuple[float, str, dict]] = []
+        fusion: list[float] = []
         for i, (doc, meta, _) in enumerate(candidates):
             score = (bm25_weight * bm25_norm[i]) + ((1 - bm25_weight) * vec_norm[i])
             safe_meta = dict(meta or {})
             safe_meta["_hybrid_score"] = round(float(score), 6)
             safe_meta["_vector_similarity"] = round(float(vec_scores_raw[i]), 6)
             safe_meta["_bm25_norm"] = round(float(bm25_norm[i]), 6)
+            if lexical_index is not None:
+                doc_id = candidate_ids[i]
+                rrf = 0.0
+                if doc_id in vector_rank:
+                    rrf += 1.0 / (_RRF_K + vector_rank[doc_id] + 1)
+                if doc_id in lexical_rank:
+                    rrf += 1.0 / (_RRF_K + lexical_rank[doc_id] + 1)
+                safe_meta["_rrf_score"] = round(rrf, 6)
+                if doc_id not in vector_rank:
+                    safe_meta["_lexical_only"] = True
+                fusion.append(rrf)
             ranked.append((float(score), doc, safe_meta))
+
+        if lexical_index is not None:
+            keep = sorted(range(len(ranked)), key=lambda i: fusion[i], reverse=True)[:top_k]
+            ranked = [ranked[i] for i in keep]
         ranked.sort(key=lambda x: x[0], reverse=True)
         return ranked[:top_k]
 
@@ -2686,22 +5059,12 @@ def _vector_search_ranked(
     if top_k <= 0:
         return []
     try:
-        kwargs: dict[str, Any] = {
-            "query_embeddings": [query_embedding],
-            "n_results": top_k,
-            "include": ["documents", "metadatas", "distances"],
-        }
-        if where:
-            kwargs["where"] = where
-        res = col.query(**kwargs)
+        rows = _query_vector_rows(col, query_embedding, top_k, where)
     except Exception:
         return []
 
-    docs = (res.get("documents") or [[]])[0]
-    metas = (res.get("metadatas") or [[]])[0]
-    dists = (res.get("distances") or [[]])[0]
     ranked: list[tuple[float, str, dict]] = []
-    for doc, meta, dist in zip(docs, metas, dists):
+    for doc, meta, dist, _ in rows:
         if not isinstance(doc, str) or not doc.strip():
             continue
         dist_val = float(dist) if isinstance(dist, (int, float)) else 1.0
@@ -2724,7 +5087,7 @@ def _select_factual_hits(
     factual_score_min = max(0.0, min(1.0, float(RAG_FACTUAL_SCORE_MIN)))
     factual_score_gap = max(0.0, float(RAG_FACTUAL_SCORE_GAP_MIN))
     best_score = ranked_hits[0][0]
-    query_token_count = len(_token_set(query))
+    query_token_count = len(_query_token_set(query))
     short_query = query_token_count <= 2
     has_reference_tokens = bool(_reference_content_tokens(query))
     selected: list[tuple[str, dict]] = []
@@ -2737,7 +5100,7 @@ def _select_factual_hits(
         if profile_target and not _profile_subject_matches_target(subject, profile_target):
             continue
 
-        lexical = _lexical_overlap_ratio(query, doc)
+        lexical = _lexical_overlap_ratio(query, doc, meta)
         vector_similarity = 0.0
         try:
             vector_similarity = float((meta or {}).get("_vector_similarity", 0.0))
@@ -2923,10 +5286,7 @@ def _select_multi_facet_hits(
                 family_ok = source_type == facet.preferred_family
         if not family_ok:
             return False
-        doc_tokens = _token_set(doc)
-        filename = clean_text(str((meta or {}).get("source_filename") or "")).lower()
-        if filename:
-            doc_tokens |= _token_set(filename)
+        doc_tokens = _doc_token_set(doc, meta) | _filename_token_set(str((meta or {}).get("source_filename") or ""))
         anchor_hits = sum(1 for t in facet.anchor_terms if t in doc_tokens)
         return anchor_hits >= 1
 
@@ -3016,6 +5376,18 @@ def _build_structured_recap_context(
 
 app = FastAPI(title="SOULFRAME RAG Server", version="3.0")
 
+_UPLOAD_PATHS = {"/ingest_file", "/describe_image", "/debug_pdf_ocr"}
+
+@app.middleware("http")
+
+async def _reject_oversized_uploads(request: Request, call_next):
+    """413 dal Content-Length prima che il multipart venga letto e salvato."""
+    if request.method == "POST" and request.url.path in _UPLOAD_PATHS:
+        length = request.headers.get("content-length", "")
+        if length.isdigit() and int(length) > RAG_UPLOAD_MAX_BYTES:
+            return JSONResponse(status_code=413, content={"detail": _upload_too_large_detail()})
+    return await call_next(request)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -3068,6 +5440,7 @@ class ChatReq(BaseModel):
     input_mode: Optional[str] = None
     log_conversation: bool = False
     empirical_test_mode: bool = False
+    latency_budget_ms: Optional[int] = None  # None = RAG_CHAT_LATENCY_BUDGET_MS, 0 = illimitato
 
 class ChatSessionStartReq(BaseModel):
     avatar_id: str
@@ -3098,18 +5471,25 @@ def _detect_remember_intent(text: str) -> Optional[str]:
                 return content
     return None
 
+def _auto_remember_text(original_text: str, remember_content: str) -> Optional[str]:
+    """Testo che _auto_remember salverebbe (None se troppo corto o non valido)."""
+    txt = clean_text(remember_content)
+    if len(txt) < MIN_CHUNK_CHARS:
+        txt = clean_text(original_text)
+    if len(txt) < MIN_CHUNK_CHARS or looks_like_garbage(txt):
+        return None
+    return txt
+
 def _auto_remember(avatar_id: str, original_text: str, remember_content: str, col: Any) -> Optional[str]:
     """Salva automaticamente il contenuto nella memoria RAG.
     Ritorna l'ID del documento salvato, oppure None in caso di errore.
     """
     try:
-        txt = clean_text(remember_content)
-        if len(txt) < MIN_CHUNK_CHARS:
-            txt = clean_text(original_text)
-        if len(txt) < MIN_CHUNK_CHARS or looks_like_garbage(txt):
+        txt = _auto_remember_text(original_text, remember_content)
+        if txt is None:
             return None
 
-        emb = ollama_embed_many([txt])[0]
+        emb = _planned_embedding(txt)
         _id = str(uuid.uuid4())
         meta: dict[str, Any] = {
             "source_type": "auto_remember_voice",
@@ -3124,7 +5504,8 @@ def _auto_remember(avatar_id: str, original_text: str, remember_content: str, co
             "ts": int(time.time()),
             "original_utterance": original_text[:500], #
         }
-        col.add(
+        _memory_add(
+            col,
             ids=[_id],
             embeddings=[emb],
             documents=[txt],
@@ -3137,32 +5518,82 @@ def _auto_remember(avatar_id: str, original_text: str, remember_content: str, co
         traceback.print_exc()
         return None
 
+def _format_context_piece(d: str, m: dict) -> str:
+    safe_meta = _annotate_memory_subject(m, d)
+    src = safe_meta.get("source_filename") or safe_meta.get("source_type") or "memoria"
+    page = safe_meta.get("page")
+    tag_parts = [f"{src}{' p.' + str(page) if page else ''}"]
+    if safe_meta.get("source_type") in _PROFILE_MEMORY_SOURCE_TYPES:
+        subject = str(safe_meta.get("memory_subject") or "")
+        if subject == _MEMORY_SUBJECT_AVATAR:
+            tag_parts.append("soggetto: avatar")
+        elif subject == _MEMORY_SUBJECT_USER:
+            tag_parts.append("soggetto: utente")
+        elif subject == _MEMORY_SUBJECT_AMBIGUOUS:
+            tag_parts.append("soggetto: ambiguo")
+    tag = f"[{' | '.join(tag_parts)}]"
+    return f"{tag} {d}"
+
 def _build_context_from_docs(docs: List[str], metas: List[dict], max_chars: int) -> str:
     parts: List[str] = []
     total = 0
     for d, m in zip(docs, metas):
         if not d:
             continue
-        safe_meta = _annotate_memory_subject(m, d)
-        src = safe_meta.get("source_filename") or safe_meta.get("source_type") or "memoria"
-        page = safe_meta.get("page")
-        tag_parts = [f"{src}{' p.' + str(page) if page else ''}"]
-        if safe_meta.get("source_type") in _PROFILE_MEMORY_SOURCE_TYPES:
-            subject = str(safe_meta.get("memory_subject") or "")
-            if subject == _MEMORY_SUBJECT_AVATAR:
-                tag_parts.append("soggetto: avatar")
-            elif subject == _MEMORY_SUBJECT_USER:
-                tag_parts.append("soggetto: utente")
-            elif subject == _MEMORY_SUBJECT_AMBIGUOUS:
-                tag_parts.append("soggetto: ambiguo")
-        tag = f"[{' | '.join(tag_parts)}]"
-        piece = f"{tag} {d}"
+        piece = _format_context_piece(d, m)
         if total + len(piece) > max_chars:
             break
         parts.append(piece)
         total += len(piece)
     return "\n\n".join(parts)
 
+def _build_context_within_tokens(docs: List[str], metas: List[dict], max_tokens: int) -> tuple[str, int, int]:
+    """
+    Contesto factual entro max_tokens: sceglie chunk interi in ordine di _hybrid_score, salta quelli
+    che non entrano e prova i successivi. Se non entra nemmeno il migliore lo tronca.
+    Restituisce (contesto nell'ordine di retrieval, token stimati, chunk esclusi).
+    """
+    candidates: list[tuple[float, int, str, int]] = []
+    for idx, (d, m) in enumerate(zip(docs, metas)):
+        if not d:
+            continue
+        piece = _format_context_piece(d, m)
+        score = float((m or {}).get("_hybrid_score", 0.0) or 0.0)
+        candidates.append((score, idx, piece, _estimate_tokens(piece) + 2))
+    chosen: list[tuple[int, str]] = []
+    used = 0
+    for score, idx, piece, tokens in sorted(candidates, key=lambda item: (-item[0], item[1])):
+        if used + tokens <= max_tokens:
+            chosen.append((idx, piece))
+            used += tokens
+    if not chosen and candidates:
+        score, idx, piece, _ = min(candidates, key=lambda item: (-item[0], item[1]))
+        piece = _fit_text_to_tokens(piece, max(0, max_tokens - 2))
+        if piece:
+            chosen.append((idx, piece))
+            used = _estimate_tokens(piece) + 2
+    chosen.sort()
+    return "\n\n".join(piece for _, piece in chosen), used, len(candidates) - len(chosen)
+
+def _trim_history_to_tokens(recent_conversation: str, max_tokens: int) -> tuple[str, int]:
+    """Tiene le righe piu' recenti dello storico entro max_tokens; restituisce (storico, righe scartate)."""
+    lines = [line for line in (recent_conversation or "").splitlines() if line.strip()]
+    kept: list[str] = []
+    used = 0
+    for line in reversed(lines):
+        tokens = _estimate_tokens(line) + 1
+        if used + tokens > max_tokens:
+            if not kept:
+                line = _fit_text_to_tokens(line, max(0, max_tokens - 1))
+                if line:
+                    kept.append(line)
+            break
+        kept.append(line)
+        used += tokens
+    if not kept:
+        return "- Nessun turno precedente disponibile.", len(lines)
+    return "\n".join(reversed(kept)), len(lines) - len(kept)
+
 def _build_rag_used_payload(docs: List[str], metas: List[dict]) -> List[dict]:
     rag_used: List[dict] = []
     for d, m in zip(docs, metas):
@@ -3189,7 +5620,7 @@ def _focused_source_retrieval(
             where={"source_type": source_type},
         )
         for score, doc, meta in ranked:
-            lexical = _lexical_overlap_ratio(query, doc)
+            lexical = _lexical_overlap_ratio(query, doc, meta)
             boosted = min(1.0, max(score, score_floor) + 0.16 + min(0.08, lexical) + _filename_overlap_boost(query, meta or {}))
             safe_meta = dict(meta or {})
             safe_meta["_hybrid_score"] = round(float(boosted), 6)
@@ -3213,6 +5644,16 @@ def _retrieve_context_for_intent(
     if effective_intent in {"chitchat", "session_recap", "creative_open"}:
         return [], []
 
+    with _candidate_pool_scope(col):
+        return _retrieve_context_for_plan(col, query, query_plan, factual_top_k)
+
+def _retrieve_context_for_plan(
+    col: Any,
+    query: str,
+    query_plan: QueryPlan,
+    factual_top_k: int,
+) -> tuple[List[str], List[dict]]:
+    effective_intent = query_plan.normalized_intent
     try:
         if effective_intent == "memory_qna":
             document_query = query_plan.document_query
@@ -3224,7 +5665,6 @@ def _retrieve_context_for_intent(
             profile_target = query_plan.profile_target if profile_query else _MEMORY_SUBJECT_AMBIGUOUS
             qemb = _embed_one_or_http_500(query)
             visual_memory_query = query_plan.visual_query
-            profile_boosted: list[tuple[float, str, dict]] = []
             if focus_sources and not reference_tokens:
                 focused_ranked = _focused_source_retrieval(col, query, qemb, focus_sources, factual_top_k, score_floor=0.18)
                 focused_docs, focused_metas = _select_factual_hits(
@@ -3236,15 +5676,6 @@ def _retrieve_context_for_intent(
                 if visual_memory_query:
                     return [], []
 
-            if profile_query:
-                profile_boosted = _retrieve_profile_boosted_hits(
-                    col=col,
-                    query=query,
-                    query_embedding=qemb,
-                    top_k=factual_top_k,
-                    profile_target=profile_target,
-                )
-
             if not (document_query or profile_query or memory_reference or definition_query):
                 return [], []
 
@@ -3258,20 +5689,30 @@ def _retrieve_context_for_intent(
                 if definition_docs:
                     return definition_docs, definition_metas
 
-            ranked = _hybrid_search_ranked(
-                query=query,
-                query_embedding=qemb,
-                col=col,
-                top_k=max(2, min(factual_top_k, 6)) if (memory_reference or definition_query) else factual_top_k,
-                bm25_weight=0.6,
-            )
-            if reference_tokens and not profile_query:
-                source_probe_ranked = _rank_source_probe_hits(
+            # Profilo, ibrida e probe per nome file dipendono solo da qemb: in parallelo.
+            ranked, profile_boosted, source_probe_ranked = _run_probes(
+                lambda: _hybrid_search_ranked(
+                    query=query,
+                    query_embedding=qemb,
+                    col=col,
+                    top_k=max(2, min(factual_top_k, 6)) if (memory_reference or definition_query) else factual_top_k,
+                    bm25_weight=0.6,
+                ),
+                (lambda: _retrieve_profile_boosted_hits(
+                    col=col,
+                    query=query,
+                    query_embedding=qemb,
+                    top_k=factual_top_k,
+                    profile_target=profile_target,
+                )) if profile_query else None,
+                (lambda: _rank_source_probe_hits(
                     col=col,
                     query=query,
                     query_embedding=qemb,
                     top_k=max(2, min(factual_top_k, 6)),
-                )
+                )) if (reference_tokens and not profile_query) else None,
+            )
+            if reference_tokens and not profile_query:
                 if source_probe_ranked:
                     ranked = sorted(source_probe_ranked + ranked, key=lambda x: x[0], reverse=True)
                 ranked = _rerank_reference_hits(
@@ -3311,7 +5752,7 @@ def _retrieve_context_for_intent(
                     return _dedupe_chunks(doc_probe_docs, doc_probe_metas)
                 if doc_probe_ranked:
                     top_score, top_doc, top_meta = doc_probe_ranked[0]
-                    top_lexical = _lexical_overlap_ratio(query, top_doc)
+                    top_lexical = _lexical_overlap_ratio(query, top_doc, top_meta)
                     top_reference_ok = _has_reference_evidence(
                         query,
                         top_doc,
@@ -3328,11 +5769,12 @@ def _retrieve_context_for_intent(
                 fallback_top_k = max(1, min(factual_top_k, 3))
                 probe_k = max(2, min(factual_top_k, 6))
                 all_mem_sources = list(_PROFILE_MEMORY_SOURCE_TYPES) + ["file", "image_description", "image_ocr"]
-                probe_lists: list[list[tuple[float, str, dict]]] = [
-                    _rank_source_probe_hits(col=col, query=query, query_embedding=qemb, top_k=probe_k),
-                    _rank_external_probe_hits(col=col, query=query, query_embedding=qemb, top_k=probe_k),
-                ]
-                broad = _vector_search_ranked(col=col, query_embedding=qemb, top_k=probe_k, where={"source_type": {"$in": all_mem_sources}})
+                source_hits, external_hits, broad = _run_probes(
+                    lambda: _rank_source_probe_hits(col=col, query=query, query_embedding=qemb, top_k=probe_k),
+                    lambda: _rank_external_probe_hits(col=col, query=query, query_embedding=qemb, top_k=probe_k),
+                    lambda: _vector_search_ranked(col=col, query_embedding=qemb, top_k=probe_k, where={"source_type": {"$in": all_mem_sources}}),
+                )
+                probe_lists: list[list[tuple[float, str, dict]]] = [source_hits, external_hits]
                 if not document_query and not profile_query:
                     broad = _rerank_reference_hits(query=query, ranked_hits=broad, strict_external=True)
                 probe_lists.append(broad)
@@ -3376,22 +5818,23 @@ def _retrieve_context_for_intent(
                     if _src_type(meta) in recap_sources
                 ]
                 if ranked:
-                    if profile_query:
-                        profile_ranked = _retrieve_profile_boosted_hits(
+                    profile_ranked, external_ranked = _run_probes(
+                        (lambda: _retrieve_profile_boosted_hits(
                             col=col,
                             query=query,
                             query_embedding=qemb,
                             top_k=max(2, min(factual_top_k, 6)),
                             profile_target=query_plan.profile_target,
-                        )
-                        if profile_ranked:
-                            ranked = sorted(profile_ranked + ranked, key=lambda x: x[0], reverse=True)
-                    external_ranked = _rank_source_probe_hits(
-                        col=col,
-                        query=query,
-                        query_embedding=qemb,
-                        top_k=max(3, min(factual_top_k, 6)),
+                        )) if profile_query else None,
+                        lambda: _rank_source_probe_hits(
+                            col=col,
+                            query=query,
+                            query_embedding=qemb,
+                            top_k=max(3, min(factual_top_k, 6)),
+                        ),
                     )
+                    if profile_ranked:
+                        ranked = sorted(profile_ranked + ranked, key=lambda x: x[0], reverse=True)
                     if external_ranked:
                         ranked = sorted(external_ranked + ranked, key=lambda x: x[0], reverse=True)
                     ranked = _rerank_reference_hits(
@@ -3429,8 +5872,7 @@ def _retrieve_context_for_intent(
                         return _dedupe_chunks(docs, metas)
 
             if profile_query:
-                recap_profile_query = "memorie personali identita nome dove vivi preferenze ricordi salvati"
-                recap_profile_emb = ollama_embed_many([recap_profile_query])[0]
+                recap_profile_emb = _planned_embedding(_RECAP_PROFILE_PROBE)
                 profile_ranked = _vector_search_ranked(
                     col=col,
                     query_embedding=recap_profile_emb,
@@ -3446,8 +5888,7 @@ def _retrieve_context_for_intent(
                     if profile_docs:
                         return _dedupe_chunks(profile_docs, profile_metas)
 
-            recap_query = "memorie personali fatti importanti identita preferenze eventi conversazioni passate"
-            recap_emb = ollama_embed_many([recap_query])[0]
+            recap_emb = _planned_embedding(_RECAP_MEMORY_PROBE)
             recap_sources = list(_PROFILE_MEMORY_SOURCE_TYPES) + ["image_description", "image_ocr", "file"]
             ranked = _vector_search_ranked(
                 col=col,
@@ -3466,8 +5907,9 @@ def _retrieve_context_for_intent(
 
     return [], []
 
-def _build_chat_system_prompt(base_system: Optional[str], intent: str, has_factual_context: bool) -> str:
-    system = base_system or (
+def _chat_base_system(base_system: Optional[str]) -> str:
+    """Persona e regole fisse: identiche a ogni turno dello stesso avatar (prefisso stabile)."""
+    return base_system or (
         "Sei l'avatar stesso, non un assistente. Parla in prima persona in modo naturale e diretto. "
         "Se la memoria include indicazioni sul tuo carattere o stile, rispettale in modo lieve e naturale. "
         "Mantieni coerenza con il contesto conversazionale recente. "
@@ -3478,6 +5920,9 @@ def _build_chat_system_prompt(base_system: Optional[str], intent: str, has_factu
         "Non dire mai di essere un avatar, una IA, un assistente, un bot o un sistema."
     )
 
+def _chat_turn_directives(intent: str, has_factual_context: bool) -> str:
+    """Regole che dipendono dal turno (grounding e modalita' dell'intento), con spazio iniziale."""
+    system = ""
     if RAG_ENFORCE_GROUNDED and has_factual_context:
         system += (
             " Usa solo memoria factual pertinente e non inventare fatti non presenti. "
@@ -3517,6 +5962,7 @@ def _build_chat_user_prompt(
     factual_context: str,
     query: str,
     auto_remembered: bool,
+    turn_directives: Optional[str] = None,
 ) -> str:
     recent_for_prompt = recent_conversation
     factual_for_prompt = factual_context
@@ -3524,13 +5970,24 @@ def _build_chat_user_prompt(
         recent_for_prompt = "(Saluto/conversazione sociale: non usare recap della memoria.)"
         factual_for_prompt = "(Nessuna memoria factual richiesta.)"
 
-    user = (
-        f"INTENTO ROUTER: {intent}\n\n"
-        f"CONTESTO CONVERSAZIONALE RECENTE:\n{recent_for_prompt}\n\n"
-        f"MEMORIA FACTUAL PERTINENTE:\n{factual_for_prompt}\n\n"
-        f"MESSAGGIO UTENTE:\n{query}\n\n"
-        "Rispondi in italiano naturale in 3-6 frasi, salvo richiesta esplicita di risposta lunga."
-    )
+    if turn_directives is None:
+        user = (
+            f"INTENTO ROUTER: {intent}\n\n"
+            f"CONTESTO CONVERSAZIONALE RECENTE:\n{recent_for_prompt}\n\n"
+            f"MEMORIA FACTUAL PERTINENTE:\n{factual_for_prompt}\n\n"
+            f"MESSAGGIO UTENTE:\n{query}\n\n"
+            "Rispondi in italiano naturale in 3-6 frasi, salvo richiesta esplicita di risposta lunga."
+        )
+    else:
+        # Layout a prefisso stabile: prima le parti che cambiano meno, in coda istruzioni del turno e domanda.
+        user = (
+            f"CONTESTO CONVERSAZIONALE RECENTE:\n{recent_for_prompt}\n\n"
+            f"MEMORIA FACTUAL PERTINENTE:\n{factual_for_prompt}\n\n"
+            f"INTENTO ROUTER: {intent}\n"
+            f"ISTRUZIONI PER QUESTO TURNO:\n{turn_directives.strip() or '(nessuna)'}\n\n"
+            f"MESSAGGIO UTENTE:\n{query}\n\n"
+            "Rispondi in italiano naturale in 3-6 frasi, salvo richiesta esplicita di risposta lunga."
+        )
     if intent in {"session_recap", "memory_recap"}:
         user += "\nFormato: fino a 5 punti brevi e verificabili. Copri ogni tema richiesto se supportato dalla memoria factual, senza fermarti al primo."
     if auto_remembered:
@@ -3571,7 +6028,88 @@ def _chat_fast_path(
         return definition_answer
     return None
 
-def _chat_generate(
+# Token dei marcatori di ruolo del template chat (header system/user/assistant).
+_CHAT_TEMPLATE_TOKENS = 16
+# Margine sulla stima dei token: la stima euristica puo' sbagliare di qualche punto percentuale.
+_TOKEN_ESTIMATE_MARGIN = 1.1
+
+def _allocate_chat_context(
+    system: str,
+    build_user: Callable[[str, str], str],
+    recent_conversation: str,
+    factual_docs: List[str],
+    factual_metas: List[dict],
+    structured_facets: Optional[list[QueryFacet]],
+    num_predict_override: Optional[int],
+) -> tuple[str, str, dict[str, Any]]:
+    """
+    Divide num_ctx della generazione tra prompt fisso (system, istruzioni, domanda), storico,
+    memoria factual e riserva per la risposta. Restituisce (contesto factual, storico, report).
+    """
+    num_ctx = _stage_num_ctx("generate") or RAG_CHAT_NUM_CTX
+    reserve = _stage_num_predict("generate", num_predict_override)
+    if reserve <= 0:
+        reserve = max(1, CHAT_NUM_PREDICT)
+    fixed = _estimate_tokens(system) + _estimate_tokens(build_user("", "")) + _CHAT_TEMPLATE_TOKENS
+    free = max(0, int((num_ctx - reserve - fixed) / _TOKEN_ESTIMATE_MARGIN))
+
+    history_cap = int(free * RAG_CTX_HISTORY_SHARE)
+    history, history_dropped = _trim_history_to_tokens(recent_conversation, history_cap)
+    history_used = _estimate_tokens(history)
+    factual_cap = max(0, free - history_used)
+
+    chunks_dropped = 0
+    if structured_facets:
+        # Il recap strutturato raggruppa per tema con un limite in caratteri: lo si riduce finche' entra.
+        max_chars = max(200, factual_cap * 4)
+        factual = _build_structured_recap_context(factual_docs, factual_metas, structured_facets, max_chars=max_chars)
+        for _ in range(8):
+            if _estimate_tokens(factual) <= factual_cap:
+                break
+            max_chars = int(max_chars * 0.85)
+            factual = _build_structured_recap_context(factual_docs, factual_metas, structured_facets, max_chars=max_chars)
+        factual = _fit_text_to_tokens(factual, factual_cap)
+        factual_used = _estimate_tokens(factual)
+    else:
+        factual, factual_used, chunks_dropped = _build_context_within_tokens(factual_docs, factual_metas, factual_cap)
+
+    report = {
+        "num_ctx": num_ctx,
+        "allocated": {
+            "fixed": fixed,
+            "history": history_cap,
+            "factual": factual_cap,
+            "generation_reserve": reserve,
+        },
+        "used": {
+            "system": _estimate_tokens(system),
+            "history": history_used,
+            "factual": factual_used,
+        },
+        "history_lines_dropped": history_dropped,
+        "factual_chunks_dropped": chunks_dropped,
+    }
+    return factual, history, report
+
+@dataclass(frozen=True)
+
+class ChatGenerationPlan:
+    system: str
+    user: str
+    num_predict_override: Optional[int]
+    factual_context: str
+    profile_target: str
+    visual_memory_query: bool
+    support_recent: str
+    context_budget: Optional[dict[str, Any]] = None
+
+    def messages(self, system: Optional[str] = None) -> list[dict[str, str]]:
+        return [
+            {"role": "system", "content": system or self.system},
+            {"role": "user", "content": self.user},
+        ]
+
+def _plan_chat_generation(
     req: ChatReq,
     intent: str,
     query: str,
@@ -3580,26 +6118,15 @@ def _chat_generate(
     factual_docs: List[str],
     factual_metas: List[dict],
     auto_remembered: bool,
-) -> tuple[str, str, str, bool, str]:
-    factual_max_chars = min(MAX_CONTEXT_CHARS, max(1200, FACTUAL_MAX_CONTEXT_CHARS))
-
+) -> ChatGenerationPlan:
+    """Prompt e parametri della generazione principale, condivisi da /chat e /chat_stream."""
     facets = _extract_requested_facets(query, query_plan)
-    if len(facets) >= 2 and query_plan.wants_multi_source_coverage and factual_docs:
-        factual_context = _build_structured_recap_context(
-            factual_docs, factual_metas, facets, max_chars=factual_max_chars,
-        )
-    else:
-        factual_context = _build_context_from_docs(factual_docs, factual_metas, max_chars=factual_max_chars)
-    if not factual_context:
-        factual_context = "(Nessuna memoria factual pertinente recuperata.)"
+    structured_facets = facets if len(facets) >= 2 and query_plan.wants_multi_source_coverage and factual_docs else None
 
-    system = _build_chat_system_prompt(
-        base_system=req.system,
-        intent=intent,
-        has_factual_context=bool(factual_docs),
-    )
+    base_system = _chat_base_system(req.system)
+    directives = _chat_turn_directives(intent, has_factual_context=bool(factual_docs))
     if query_plan.document_query and factual_docs:
-        system += (
+        directives += (
             " La richiesta riguarda contenuti da documenti/immagini: usa i blocchi recuperati "
             "e non negare la presenza di tali fonti. "
             "Resta sul contenuto richiesto, senza premesse su argomenti non richiesti. "
@@ -3609,7 +6136,7 @@ def _chat_generate(
 
     visual_memory_query = query_plan.visual_query
     if visual_memory_query and _has_visual_factual_hits(factual_metas):
-        system += (
+        directives += (
             " La richiesta riguarda contenuti visivi: descrivi almeno 2-3 elementi strutturali reali "
             "presenti nei blocchi recuperati (componenti, relazioni, etichette, elementi principali). "
             "Non limitarti al titolo o a una frase generica. "
@@ -3618,7 +6145,7 @@ def _chat_generate(
 
     if query_plan.wants_multi_source_coverage and len(facets) >= 2 and factual_docs:
         facet_labels = ", ".join(f.topic for f in facets[:5])
-        system += (
+        directives += (
             f" La richiesta e' un riepilogo multi-sorgente. Devi coprire TUTTI i temi richiesti: {facet_labels}. "
             "Per ogni tema, riporta almeno un dettaglio concreto dalla memoria factual. "
             "Non fissarti su una sola sorgente ignorando le altre."
@@ -3626,25 +6153,12 @@ def _chat_generate(
 
     profile_target = query_plan.profile_target if query_plan.profile_query else _MEMORY_SUBJECT_AMBIGUOUS
     if query_plan.profile_query and factual_docs:
-        system += (
+        directives += (
             " La richiesta riguarda identita/carattere: resta coerente con i fatti recuperati "
             "e non contraddirli. Se un blocco e' marcato come soggetto: utente, trattalo come "
             "informazione sull'interlocutore e non come autobiografia tua."
         )
-        system += _PROFILE_SYS_SUFFIX.get(profile_target, "")
-
-    recent_for_prompt = recent_conversation
-    if intent in {"memory_qna", "memory_recap"}:
-        recent_for_prompt = _recent_user_only_context(recent_conversation)
-    user = _build_chat_user_prompt(
-        intent=intent,
-        recent_conversation=recent_for_prompt,
-        factual_context=factual_context,
-        query=query,
-        auto_remembered=auto_remembered,
-    )
-    if query_plan.profile_query and factual_docs:
-        user += _PROFILE_USR_SUFFIX.get(profile_target, "")
+        directives += _PROFILE_SYS_SUFFIX.get(profile_target, "")
 
     if query_plan.wants_multi_source_coverage and len(facets) >= 2 and factual_docs:
         generation_override = 400
@@ -3654,40 +6168,91 @@ def _chat_generate(
         generation_override = 360
     else:
         generation_override = None
-    raw_answer = ollama_chat(
-        [
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ],
+
+    recent_for_prompt = recent_conversation
+    if intent in {"memory_qna", "memory_recap"}:
+        recent_for_prompt = _recent_user_only_context(recent_conversation)
+    # Con il prefisso stabile le direttive del turno vanno nel messaggio utente.
+    system = base_system if RAG_PROMPT_STABLE_PREFIX else base_system + directives
+    user_suffix = _PROFILE_USR_SUFFIX.get(profile_target, "") if query_plan.profile_query and factual_docs else ""
+
+    def build_user(recent_text: str, factual_text: str) -> str:
+        return _build_chat_user_prompt(
+            intent=intent,
+            recent_conversation=recent_text,
+            factual_context=factual_text,
+            query=query,
+            auto_remembered=auto_remembered,
+            turn_directives=directives if RAG_PROMPT_STABLE_PREFIX else None,
+        ) + user_suffix
+
+    context_budget: Optional[dict[str, Any]] = None
+    if RAG_TOKEN_BUDGET:
+        factual_context, recent_for_prompt, context_budget = _allocate_chat_context(
+            system=system,
+            build_user=build_user,
+            recent_conversation=recent_for_prompt,
+            factual_docs=factual_docs,
+            factual_metas=factual_metas,
+            structured_facets=structured_facets,
+            num_predict_override=generation_override,
+        )
+    else:
+        factual_max_chars = min(MAX_CONTEXT_CHARS, max(1200, FACTUAL_MAX_CONTEXT_CHARS))
+        if structured_facets:
+            factual_context = _build_structured_recap_context(
+                factual_docs, factual_metas, structured_facets, max_chars=factual_max_chars,
+            )
+        else:
+            factual_context = _build_context_from_docs(factual_docs, factual_metas, max_chars=factual_max_chars)
+    if not factual_context:
+        factual_context = "(Nessuna memoria factual pertinente recuperata.)"
+    user = build_user(recent_for_prompt, factual_context)
+    if context_budget is not None:
+        context_budget["used"]["prompt_total"] = _estimate_tokens(system) + _estimate_tokens(user) + _CHAT_TEMPLATE_TOKENS
+
+    support_recent = recent_conversation
+    if intent in {"memory_qna", "memory_recap"}:
+        support_recent = ""
+    return ChatGenerationPlan(
+        system=system,
+        user=user,
         num_predict_override=generation_override,
-    ).strip()
-    answer = _finalize_chat_answer(raw_answer) or "Non lo so."
+        factual_context=factual_context,
+        profile_target=profile_target,
+        visual_memory_query=visual_memory_query,
+        support_recent=support_recent,
+        context_budget=context_budget,
+    )
+
+def _finish_chat_generation(
+    raw_answer: str,
+    plan: ChatGenerationPlan,
+    intent: str,
+    query: str,
+    factual_docs: List[str],
+) -> str:
+    answer = _finalize_chat_answer(raw_answer.strip()) or "Non lo so."
 
     if _IDENTITY_META_RE.search(answer):
         retry_system = (
-            system
+            plan.system
             + " Riscrivi la risposta senza menzionare avatar/IA/assistente/sistema. "
             + "Parla in prima persona naturale."
         )
-        retry_answer = _finalize_chat_answer(
-            ollama_chat(
-                [
-                    {"role": "system", "content": retry_system},
-                    {"role": "user", "content": user},
-                ]
-            ).strip()
-        ) or ""
+        try:
+            retry_answer = _finalize_chat_answer(
+                ollama_chat(plan.messages(retry_system), stage="identity_retry").strip()
+            ) or ""
+        except _StageSkipped:
+            retry_answer = ""
         if retry_answer and not _IDENTITY_META_RE.search(retry_answer):
             answer = retry_answer
         elif intent in {"memory_qna", "memory_recap"} and not factual_docs:
             answer = _memory_unknown_reply(intent, query)
         else:
             answer = "Parlo in prima persona."
-
-    support_recent = recent_conversation
-    if intent in {"memory_qna", "memory_recap"}:
-        support_recent = ""
-    return answer, factual_context, profile_target, visual_memory_query, support_recent
+    return answer
 
 def _chat_repair(
     intent: str,
@@ -4019,6 +6584,7 @@ def _verify_answer_coverage(
                 ],
                 timeout=50,
                 num_predict_override=retry_predict,
+                stage="coverage_retry",
             ).strip()
         )
     except Exception:
@@ -4066,6 +6632,7 @@ def health():
         "ollama": OLLAMA_HOST,
         "embed_model": EMBED_MODEL,
         "chat_model": CHAT_MODEL,
+        "stage_profiles": _stage_profiles_health(),
         "rag_root": PERSIST_ROOT,
         "rag_log_root": RAG_LOG_DIR,
         "empirical_rag_root": EMPIRICAL_PERSIST_ROOT,
@@ -4073,6 +6640,7 @@ def health():
         "per_avatar_db": True,
         "cached_avatars": len(_AVATAR_CLIENTS),
         "ocr": bool(pytesseract and Image),
+        "ocr_engine": _OCR_ENGINE.health(),
         "pdf": _pymupdf4llm_available,
         "ocr_lang": RAG_OCR_LANG,
         "gemini_vision": bool(_gemini_client and GEMINI_API_KEY),
@@ -4090,8 +6658,15 @@ def health():
         "grounding_score_min": RAG_GROUNDING_SCORE_MIN,
         "factual_max_context_chars": FACTUAL_MAX_CONTEXT_CHARS,
         "session_turns": _effective_session_turns(),
+        "session_summary": _session_summary_health(),
         "intent_router_num_predict": RAG_INTENT_ROUTER_NUM_PREDICT,
+        "intent_classifier": _intent_classifier_health(),
         "grounded_mode": RAG_ENFORCE_GROUNDED,
+        "embed_cache": _embed_cache_health(),
+        "embed_batcher": _EMBED_BATCHER.health(),
+        "ollama_http": _ollama_http_health(),
+        "candidate_pool": _candidate_pool_health(),
+        "embedding_planner": _embedding_plan_health(),
     }
 
 @app.get("/avatar_stats")
@@ -4116,8 +6691,14 @@ def remember(req: RememberReq):
     if remember_error is not None:
         raise HTTPException(status_code=400, detail=remember_error)
 
-    emb = ollama_embed_many([txt])[0]
     _id = str(uuid.uuid4())
+    if RAG_INGEST_DEDUPE:
+        # Un ricordo aggiornato (stesso fatto, valore diverso) non va mai scartato: solo testo identico.
+        duplicate_of = _find_near_duplicates(col, [_id], [txt], exact_only=True)[0]
+        if duplicate_of is not None:
+            return {"ok": True, "id": duplicate_of, "duplicate": True}
+
+    emb = ollama_embed_many([txt])[0]
 
     meta = _sanitize_metadata(req.meta or {})
     meta.setdefault("source_type", "manual")
@@ -4133,7 +6714,8 @@ def remember(req: RememberReq):
     meta.setdefault("avatar_id", req.avatar_id)
     meta.setdefault("ts", int(time.time()))
 
-    col.add(
+    _memory_add(
+        col,
         ids=[_id],
         embeddings=[emb],
         documents=[txt],
@@ -4156,6 +6738,10 @@ def recall(req: RecallReq):
     if memory_count == 0:
         return _build_recall_response([], [])
 
+    with _embedding_plan_scope([q, _RECAP_PROFILE_PROBE, _RECAP_MEMORY_PROBE]):
+        return _recall_planned(req, col, q, fallback_top_k)
+
+def _recall_planned(req: RecallReq, col: Any, q: str, fallback_top_k: int):
     try:
         recall_plan = _build_query_plan(q, "memory_qna")
         recall_intent = recall_plan.normalized_intent
@@ -4190,6 +6776,7 @@ def recall(req: RecallReq):
             n_results=req.top_k,
             include=["documents", "metadatas", "distances"],
         )
+        res["metadatas"] = [[_public_metadata(m) for m in row] for row in (res.get("metadatas") or [])]
         return res
 
 @app.post("/chat_session/start")
@@ -4216,25 +6803,56 @@ def chat_session_start(req: ChatSessionStartReq):
         "empirical_test_mode": req.empirical_test_mode,
     }
 
-@app.post("/chat")
+@dataclass(frozen=True)
 
-def chat(req: ChatReq):
+class ChatTurn:
+    col: Any
+    query: str
+    auto_remembered: bool
+    session_for_history: Optional[str]
+    recent_conversation: str
+    query_plan: QueryPlan
+    intent: str
+    retrieval_query: str
+    factual_docs: List[str]
+    factual_metas: List[dict]
+
+def _prepare_chat_turn(req: ChatReq) -> ChatTurn:
+    """Auto-remember, routing e retrieval: tutto cio' che precede la generazione."""
     col = get_collection(req.avatar_id, req.empirical_test_mode)
 
     q = clean_text(req.user_text)
     if not q:
         raise HTTPException(status_code=400, detail="Messaggio vuoto.")
 
+    remember_content = _detect_remember_intent(q)
+    memory_count = _safe_collection_count(col)
+    # Tutto quello che il turno puo' embeddare, in un'unica chiamata a Ollama.
+    planned_texts = [q]
+    if remember_content:
+        planned_texts.append(_auto_remember_text(q, remember_content) or "")
+    if memory_count > 0:
+        planned_texts.extend((_RECAP_PROFILE_PROBE, _RECAP_MEMORY_PROBE))
+    with _embedding_plan_scope(planned_texts):
+        return _prepare_chat_turn_planned(req, col, q, remember_content, memory_count)
+
+def _prepare_chat_turn_planned(
+    req: ChatReq,
+    col: Any,
+    q: str,
+    remember_content: Optional[str],
+    memory_count: int,
+) -> ChatTurn:
     auto_remembered = False
     auto_remember_id = None
-    remember_content = _detect_remember_intent(q)
     if remember_content:
         auto_remember_id = _auto_remember(req.avatar_id, q, remember_content, col)
         auto_remembered = auto_remember_id is not None
 
     session_for_history = _ensure_session_history(req.avatar_id, req.session_id, req.empirical_test_mode)
     recent_conversation = _build_recent_conversation_context(req.avatar_id, session_for_history, req.empirical_test_mode)
-    memory_count = _safe_collection_count(col)
+    if auto_remembered:
+        memory_count = _safe_collection_count(col)
     fallback_top_k = min(req.top_k, 4)
     query_plan = _route_chat_intent(q, recent_conversation, has_memory=(memory_count > 0))
     intent = query_plan.normalized_intent
@@ -4265,83 +6883,241 @@ def chat(req: ChatReq):
                     plan=probe_plan,
                 )
                 if probe_docs:
-                    query_plan = probe_plan
+                    query_plan = dataclass_replace(probe_plan, intent_source="fallback")
                     intent = query_plan.normalized_intent
                     factual_docs, factual_metas = probe_docs, probe_metas
                     break
 
-    answer = _chat_fast_path(
-        intent=intent,
+    return ChatTurn(
+        col=col,
         query=q,
+        auto_remembered=auto_remembered,
+        session_for_history=session_for_history,
+        recent_conversation=recent_conversation,
         query_plan=query_plan,
+        intent=intent,
+        retrieval_query=retrieval_query,
         factual_docs=factual_docs,
         factual_metas=factual_metas,
-        auto_remembered=auto_remembered,
     )
-    if answer is None:
-        answer, factual_context, profile_target, visual_memory_query, support_recent = _chat_generate(
-            req=req,
-            intent=intent,
-            query=q,
-            query_plan=query_plan,
-            recent_conversation=recent_conversation,
-            factual_docs=factual_docs,
-            factual_metas=factual_metas,
-            auto_remembered=auto_remembered,
-        )
-        answer = _chat_repair(
-            intent=intent,
-            query=q,
-            query_plan=query_plan,
-            recent_conversation=recent_conversation,
-            factual_docs=factual_docs,
-            factual_metas=factual_metas,
-            answer=answer,
-            factual_context=factual_context,
-            profile_target=profile_target,
-            visual_memory_query=visual_memory_query,
-            support_recent=support_recent,
-        )
-        answer = _verify_answer_coverage(
-            answer=answer,
-            query=q,
-            query_plan=query_plan,
-            factual_docs=factual_docs,
-            factual_metas=factual_metas,
-            factual_context=factual_context,
-            profile_target=profile_target,
-            visual_memory_query=visual_memory_query,
-            recent_conversation=recent_conversation,
-        )
 
+def _chat_turn_fast_path(turn: ChatTurn) -> Optional[str]:
+    return _chat_fast_path(
+        intent=turn.intent,
+        query=turn.query,
+        query_plan=turn.query_plan,
+        factual_docs=turn.factual_docs,
+        factual_metas=turn.factual_metas,
+        auto_remembered=turn.auto_remembered,
+    )
+
+def _plan_chat_turn_generation(req: ChatReq, turn: ChatTurn) -> ChatGenerationPlan:
+    return _plan_chat_generation(
+        req=req,
+        intent=turn.intent,
+        query=turn.query,
+        query_plan=turn.query_plan,
+        recent_conversation=turn.recent_conversation,
+        factual_docs=turn.factual_docs,
+        factual_metas=turn.factual_metas,
+        auto_remembered=turn.auto_remembered,
+    )
+
+def _repair_chat_turn_answer(turn: ChatTurn, plan: ChatGenerationPlan, answer: str) -> str:
+    answer = _chat_repair(
+        intent=turn.intent,
+        query=turn.query,
+        query_plan=turn.query_plan,
+        recent_conversation=turn.recent_conversation,
+        factual_docs=turn.factual_docs,
+        factual_metas=turn.factual_metas,
+        answer=answer,
+        factual_context=plan.factual_context,
+        profile_target=plan.profile_target,
+        visual_memory_query=plan.visual_memory_query,
+        support_recent=plan.support_recent,
+    )
+    return _verify_answer_coverage(
+        answer=answer,
+        query=turn.query,
+        query_plan=turn.query_plan,
+        factual_docs=turn.factual_docs,
+        factual_metas=turn.factual_metas,
+        factual_context=plan.factual_context,
+        profile_target=plan.profile_target,
+        visual_memory_query=plan.visual_memory_query,
+        recent_conversation=turn.recent_conversation,
+    )
+
+def _complete_chat_turn(req: ChatReq, turn: ChatTurn, answer: str) -> dict[str, Any]:
+    """Metriche, storia sessione e log conversazione dopo la risposta finale."""
     quality_metrics = _build_chat_quality_metrics(
-        intent=intent,
-        query=q,
-        factual_docs=factual_docs,
-        factual_metas=factual_metas,
+        intent=turn.intent,
+        query=turn.query,
+        factual_docs=turn.factual_docs,
+        factual_metas=turn.factual_metas,
         answer=answer,
-        rewritten_query=retrieval_query,
+        rewritten_query=turn.retrieval_query,
     )
     quality_metrics["intent_confidence_min"] = round(float(max(0.0, min(1.0, RAG_INTENT_CONFIDENCE_MIN))), 3)
+    quality_metrics["intent_source"] = turn.query_plan.intent_source
+    quality_metrics["query"] = _truncate_for_prompt(turn.query, 300)
     print(f"[CHAT_QUALITY] {json.dumps(quality_metrics, ensure_ascii=False)}")
 
-    _append_session_turn(req.avatar_id, session_for_history, q, answer, req.empirical_test_mode)
+    _append_session_turn(req.avatar_id, turn.session_for_history, turn.query, answer, req.empirical_test_mode)
     conversation_logged, conversation_session_id = _append_chat_log_if_enabled(
         req=req,
-        query=q,
+        query=turn.query,
         answer=answer,
-        session_for_history=session_for_history,
+        session_for_history=turn.session_for_history,
     )
 
     return {
         "text": answer,
-        "rag_used": _build_rag_used_payload(factual_docs, factual_metas),
-        "intent": intent,
-        "auto_remembered": auto_remembered,
+        "rag_used": _build_rag_used_payload(turn.factual_docs, turn.factual_metas),
+        "intent": turn.intent,
+        "auto_remembered": turn.auto_remembered,
         "conversation_logged": conversation_logged,
         "conversation_session_id": conversation_session_id,
     }
 
+def _chat_stage_budget(req: ChatReq) -> _ChatStageBudget:
+    budget_ms = RAG_CHAT_LATENCY_BUDGET_MS if req.latency_budget_ms is None else req.latency_budget_ms
+    return _ChatStageBudget(budget_ms)
+
+def _budget_timeout_answer(turn: ChatTurn, budget: _ChatStageBudget, detail: Any) -> str:
+    """
+    Generazione oltre il budget: per le domande sulla memoria la risposta deterministica "non ho
+    abbastanza elementi"; per gli altri intenti quella frase non ha senso, quindi resta l'errore HTTP.
+    """
+    if turn.intent not in {"memory_qna", "memory_recap"}:
+        raise HTTPException(status_code=504, detail=detail)
+    budget.note_fallback("generate_timeout")
+    return _memory_unknown_reply(turn.intent, turn.query)
+
+@app.post("/chat")
+
+def chat(req: ChatReq):
+    budget = _chat_stage_budget(req)
+    with _stage_budget_scope(budget):
+        turn = _prepare_chat_turn(req)
+        answer = _chat_turn_fast_path(turn)
+        if answer is None:
+            plan = _plan_chat_turn_generation(req, turn)
+            try:
+                raw_answer = ollama_chat(plan.messages(), num_predict_override=plan.num_predict_override)
+            except _StageBudgetExceeded as e:
+                answer = _budget_timeout_answer(turn, budget, e.detail)
+            else:
+                answer = _finish_chat_generation(raw_answer, plan, turn.intent, turn.query, turn.factual_docs)
+                answer = _repair_chat_turn_answer(turn, plan, answer)
+        else:
+            plan = None
+        response = _complete_chat_turn(req, turn, answer)
+    response["stages"] = budget.report()
+    if plan is not None and plan.context_budget is not None:
+        response["context_tokens"] = plan.context_budget
+    return response
+
+def _chat_stream_event(event: str, payload: dict[str, Any], sse: bool) -> str:
+    if sse:
+        return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+    return json.dumps({"event": event, **payload}, ensure_ascii=False) + "\n"
+
+@app.post("/chat_stream")
+
+def chat_stream(req: ChatReq, request: Request):
+    """
+    Come /chat ma in streaming (NDJSON, oppure SSE con Accept: text/event-stream).
+    Eventi: "metadata" (rag_used, intent), "token" (testo grezzo della bozza),
+    "final" (risposta dopo repair/coverage + replaced se diversa dalla bozza), "error".
+    """
+    sse = "text/event-stream" in (request.headers.get("accept") or "").lower()
+    budget = _chat_stage_budget(req)
+    # Retrieval e routing prima di aprire lo stream: gli errori restano HTTP normali.
+    with _stage_budget_scope(budget):
+        turn = _prepare_chat_turn(req)
+
+    def _events() -> Iterator[str]:
+        yield _chat_stream_event(
+            "metadata",
+            {
+                "rag_used": _build_rag_used_payload(turn.factual_docs, turn.factual_metas),
+                "intent": turn.intent,
+                "auto_remembered": turn.auto_remembered,
+            },
+            sse,
+        )
+        draft = ""
+        try:
+            # Lo scope del budget non attraversa gli yield (il generatore puo' riprendere su un altro thread).
+            with _stage_budget_scope(budget):
+                answer = _chat_turn_fast_path(turn)
+                plan = _plan_chat_turn_generation(req, turn) if answer is None else None
+            if plan is not None:
+                pieces: list[str] = []
+                started = time.perf_counter()
+                stream_ok = False
+                timed_out = False
+                stream = ollama_chat_stream(
+                    plan.messages(),
+                    timeout=int(budget.cap_timeout(600)),
+                    num_predict_override=plan.num_predict_override,
+                )
+                try:
+                    # Il timeout HTTP vale per singolo chunk: il limite totale e' la deadline del budget.
+                    for piece in stream:
+                        pieces.append(piece)
+                        yield _chat_stream_event("token", {"text": piece}, sse)
+                        if budget.expired():
+                            timed_out = True
+                            break
+                    stream_ok = not timed_out
+                except HTTPException:
+                    if not budget.expired():
+                        raise
+                    timed_out = True
+                finally:
+                    stream.close()
+                    budget.record("generate", (time.perf_counter() - started) * 1000.0, stream_ok)
+                draft = "".join(pieces).strip()
+                with _stage_budget_scope(budget):
+                    if timed_out and not _finalize_chat_answer(draft):
+                        answer = _budget_timeout_answer(
+                            turn, budget, "Budget di latenza esaurito durante la generazione."
+                        )
+                    else:
+                        if timed_out:
+                            budget.note_fallback("generate_timeout")
+                        # Bozza parziale a deadline scaduta: _finalize_chat_answer la chiude all'ultima frase.
+                        answer = _finish_chat_generation(draft, plan, turn.intent, turn.query, turn.factual_docs)
+                        answer = _repair_chat_turn_answer(turn, plan, answer)
+            else:
+                draft = answer or ""
+                yield _chat_stream_event("token", {"text": draft}, sse)
+            with _stage_budget_scope(budget):
+                response = _complete_chat_turn(req, turn, answer)
+            response["stages"] = budget.report()
+            if plan is not None and plan.context_budget is not None:
+                response["context_tokens"] = plan.context_budget
+        except HTTPException as e:
+            yield _chat_stream_event("error", {"status_code": e.status_code, "detail": e.detail}, sse)
+            return
+        except Exception as e:
+            traceback.print_exc()
+            yield _chat_stream_event("error", {"status_code": 500, "detail": str(e)}, sse)
+            return
+        # La bozza va confrontata nella forma normalizzata (spazi, punteggiatura finale): "replaced"
+        # deve segnalare solo una risposta diversa, non la pulizia di _finalize_chat_answer.
+        response["replaced"] = response["text"].strip() != (_finalize_chat_answer(draft) or draft.strip())
+        yield _chat_stream_event("final", response, sse)
+
+    return StreamingResponse(
+        _events(),
+        media_type="text/event-stream" if sse else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.post("/clear_avatar_logs")
 
 def clear_avatar_logs(avatar_id: str = Form(...), empirical_test_mode: bool = Form(False)):
@@ -4445,6 +7221,7 @@ def clear_avatar(
     avatar_log_dir = os.path.join(log_root, avatar_key)
 
     client = _AVATAR_CLIENTS.pop((_mode_key(empirical_test_mode), avatar_key), None)
+    _close_lexical_index(avatar_dir)
     try:
         if client is None:
             client = chromadb.PersistentClient(path=avatar_dir)
@@ -4459,6 +7236,8 @@ def clear_avatar(
                 collection_deleted = True
             except Exception:
                 pass
+            if collection_deleted:
+                _close_lexical_index(avatar_dir, drop=True)
     except Exception:
         pass
 
@@ -4495,6 +7274,49 @@ def clear_avatar(
         "empirical_test_mode": empirical_test_mode,
     }
 
+def _upload_too_large_detail() -> str:
+    return f"File troppo grande (limite {RAG_UPLOAD_MAX_BYTES // (1024 * 1024)} MB)."
+
+def _new_spool_path(filename: str, prefix: str = "upload") -> str:
+    os.makedirs(RAG_INGEST_SPOOL_DIR, exist_ok=True)
+    ext = os.path.splitext(filename)[1].lower()
+    return os.path.join(RAG_INGEST_SPOOL_DIR, f"{prefix}_{uuid.uuid4().hex}{ext}")
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+async def _spool_upload(file: UploadFile, dest_path: str) -> Tuple[int, str]:
+    """
+    Copia l'upload in dest_path a blocchi da RAG_UPLOAD_CHUNK_BYTES, senza tenerlo intero in RAM.
+    413 oltre RAG_UPLOAD_MAX_BYTES (upload senza Content-Length), 400 se vuoto.
+    Ritorna byte scritti e sha256 del contenuto, calcolato durante la copia.
+    """
+    written = 0
+    digest = hashlib.sha256()
+    try:
+        with open(dest_path, "wb") as handle:
+            while True:
+                block = await file.read(RAG_UPLOAD_CHUNK_BYTES)
+                if not block:
+                    break
+                written += len(block)
+                if written > RAG_UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail=_upload_too_large_detail())
+                digest.update(block)
+                handle.write(block)
+    except BaseException:
+        _remove_quietly(dest_path)
+        raise
+    finally:
+        await file.close()
+    if written == 0:
+        _remove_quietly(dest_path)
+        raise HTTPException(status_code=400, detail="File vuoto.")
+    return written, digest.hexdigest()
+
 @app.post("/debug_pdf_ocr")
 
 async def debug_pdf_ocr(
@@ -4506,22 +7328,23 @@ async def debug_pdf_ocr(
     if not filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Solo PDF")
 
-    raw = await file.read()
-    if not raw:
-        raise HTTPException(status_code=400, detail="File vuoto")
-
     if not _pymupdf4llm_available:
         raise HTTPException(status_code=500, detail="pymupdf4llm non disponibile")
     assert pymupdf is not None and pymupdf4llm is not None
 
-    ocr_ready = _ensure_ocr_ready()
-    doc = pymupdf.open(stream=raw, filetype="pdf")
+    spool_path = _new_spool_path(filename, prefix="debug")
+    await _spool_upload(file, spool_path)
     try:
-        pages_data = pymupdf4llm.to_markdown(doc, pages=[page], page_chunks=True)
-    except Exception as e:
-        doc.close()
-        raise HTTPException(status_code=500, detail=f"Errore estrazione: {str(e)[:100]}")
-    doc.close()
+        ocr_ready = _ensure_ocr_ready()
+        doc = pymupdf.open(spool_path, filetype="pdf")
+        try:
+            pages_data = pymupdf4llm.to_markdown(doc, pages=[page], page_chunks=True)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Errore estrazione: {str(e)[:100]}")
+        finally:
+            doc.close()
+    finally:
+        _remove_quietly(spool_path)
 
     if not pages_data:
         raise HTTPException(status_code=400, detail=f"Pagina {page} non trovata o vuota")
@@ -4549,9 +7372,8 @@ async def describe_image(
         raise HTTPException(status_code=500, detail="Gemini non configurato. Imposta GEMINI_API_KEY.")
 
     filename = file.filename or "image"
-    raw = await file.read()
-    if not raw:
-        raise HTTPException(status_code=400, detail="File vuoto.")
+    spool_path = _new_spool_path(filename, prefix="image")
+    await _spool_upload(file, spool_path)
 
     mime_type = (file.content_type or "").strip().lower()
     ext = filename.lower().split(".")[-1]
@@ -4563,17 +7385,24 @@ async def describe_image(
         elif ext == "webp":
             mime_type = "image/webp"
 
-    if ext not in ["png", "jpg", "jpeg", "webp"]:
-        if Image is None:
-            raise HTTPException(status_code=400, detail="Formato non supportato. Installa pillow.")
-        try:
-            img = Image.open(io.BytesIO(raw))
-            png_buf = io.BytesIO()
-            img.save(png_buf, format="PNG")
-            raw = png_buf.getvalue()
-            mime_type = "image/png"
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Errore conversione immagine: {e}")
+    # Gemini vuole i bytes inline: si leggono dallo spool solo dopo il controllo dimensione.
+    try:
+        if ext not in ["png", "jpg", "jpeg", "webp"]:
+            if Image is None:
+                raise HTTPException(status_code=400, detail="Formato non supportato. Installa pillow.")
+            try:
+                with Image.open(spool_path) as img:
+                    png_buf = io.BytesIO()
+                    img.save(png_buf, format="PNG")
+                raw = png_buf.getvalue()
+                mime_type = "image/png"
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Errore conversione immagine: {e}")
+        else:
+            with open(spool_path, "rb") as handle:
+                raw = handle.read()
+    finally:
+        _remove_quietly(spool_path)
 
     description = describe_image_with_gemini(raw, prompt, mime_type)
 
@@ -4598,7 +7427,8 @@ async def describe_image(
                 "ts": int(time.time()),
             }
             col = get_collection(avatar_id, empirical_test_mode)
-            col.add(
+            _memory_add(
+                col,
                 ids=[_id],
                 embeddings=[emb],
                 documents=[txt],
@@ -4618,45 +7448,297 @@ async def describe_image(
         "empirical_test_mode": empirical_test_mode,
     }
 
-@app.post("/ingest_file")
+class _IngestCancelled(Exception):
+    """Job di ingest annullato via /ingest_jobs/{id}/cancel."""
+
+class _IngestJob:
+    """Stato di un ingest in background, letto da /ingest_jobs/{id}."""
+
+    def __init__(self, avatar_id: str, filename: str, spool_path: str, empirical_test_mode: bool):
+        self.job_id = uuid.uuid4().hex
+        self.avatar_id = avatar_id
+        self.filename = filename
+        self.spool_path = spool_path
+        self.size_bytes = 0
+        self.file_sha256 = ""
+        self.dedup = False
+        self.empirical_test_mode = empirical_test_mode
+        self.lock = threading.Lock()
+        self.status = "queued"  # queued | running | done | error | cancelled
+        self.stage = "queued"
+        self.pages_total = 0
+        self.pages_done = 0
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.chunks_added = 0
+        self.embed_batch_size = 0
+        self.errors: list[str] = []
+        self.result: Optional[dict] = None
+        self.cancel_requested = False
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def update(self, **fields: Any) -> None:
+        """Aggiorna i contatori; punto di controllo per la cancellazione."""
+        with self.lock:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            if self.cancel_requested:
+                raise _IngestCancelled()
+
+    def finish(self, status: str, *, result: Optional[dict] = None, error: str = "") -> None:
+        with self.lock:
+            self.status = status
+            self.stage = status
+            self.result = result
+            if error:
+                self.errors.append(error)
+            self.finished_at = time.time()
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            out = {
+                "ok": self.status != "error",
+                "job_id": self.job_id,
+                "avatar_id": self.avatar_id,
+                "filename": self.filename,
+                "size_bytes": self.size_bytes,
+                "file_sha256": self.file_sha256,
+                "dedup": self.dedup,
+                "status": self.status,
+                "stage": self.stage,
+                "pages_total": self.pages_total,
+                "pages_done": self.pages_done,
+                "chunks_total": self.chunks_total,
+                "chunks_embedded": self.chunks_embedded,
+                "chunks_added": self.chunks_added,
+                "embed_batch_size": self.embed_batch_size,
+                "error": self.errors[-1] if self.errors else "",
+                "errors": list(self.errors),
+                "cancel_requested": self.cancel_requested,
+                "elapsed_s": round((self.finished_at or time.time()) - (self.started_at or self.created_at), 3),
+            }
+            if self.result is not None:
+                out["result"] = dict(self.result)
+            return out
 
-async def ingest_file(
-    avatar_id: str = Form(...),
-    file: UploadFile = File(...),
-    empirical_test_mode: bool = Form(False),
-):
-    """Ingest PDF / immagini / testo. Usa sempre OCR per PDF e immagini.
+_INGEST_JOBS: "OrderedDict[str, _IngestJob]" = OrderedDict()
+_INGEST_JOBS_LOCK = threading.Lock()
+_INGEST_EXECUTOR = ThreadPoolExecutor(max_workers=RAG_INGEST_WORKERS, thread_name_prefix="ingest")
 
-    Args:
-        avatar_id: ID dell'avatar
-        file: File da processare (PDF, immagini, testo)
+class _EmbedBatchTuner:
+    """
+    Dimensione dei batch di embedding dell'ingest: media mobile dei ms per chunk misurati su
+    Ollama, batch = RAG_INGEST_EMBED_TARGET_MS / ms_per_chunk entro [BATCH_MIN, BATCH_MAX].
+    Condiviso tra i job: il throughput imparato resta valido per gli ingest successivi.
     """
 
-    filename = file.filename or "upload"
-    ext = os.path.splitext(filename)[1].lower()
+    def __init__(self, initial: int = 16, alpha: float = 0.3):
+        self.lock = threading.Lock()
+        self.size = max(RAG_INGEST_EMBED_BATCH_MIN, min(RAG_INGEST_EMBED_BATCH_MAX, initial))
+        self.alpha = alpha
+        self.ms_per_chunk: Optional[float] = None
+
+    def next_size(self) -> int:
+        with self.lock:
+            return self.size
+
+    def record(self, chunks: int, elapsed_ms: float) -> None:
+        if chunks <= 0:
+            return
+        sample = max(0.01, elapsed_ms / chunks)
+        with self.lock:
+            if self.ms_per_chunk is None:
+                self.ms_per_chunk = sample
+            else:
+                self.ms_per_chunk = self.alpha * sample + (1.0 - self.alpha) * self.ms_per_chunk
+            ideal = int(RAG_INGEST_EMBED_TARGET_MS / self.ms_per_chunk)
+            self.size = max(RAG_INGEST_EMBED_BATCH_MIN, min(RAG_INGEST_EMBED_BATCH_MAX, ideal))
+
+_INGEST_EMBED_TUNER = _EmbedBatchTuner()
+_INGEST_EMBED_EXECUTOR = ThreadPoolExecutor(
+    max_workers=RAG_INGEST_EMBED_CONCURRENCY * RAG_INGEST_WORKERS,
+    thread_name_prefix="ingest-embed",
+)
 
-    raw = await file.read()
-    if not raw:
-        raise HTTPException(status_code=400, detail="File vuoto.")
+def _timed_embed_batch(texts: List[str]) -> Tuple[List[ChromaEmbedding], float]:
+    t0 = time.perf_counter()
+    embs = cast(List[ChromaEmbedding], ollama_embed_many(texts, direct=True))
+    if len(embs) != len(texts):
+        raise HTTPException(status_code=500, detail="Errore embeddings: conteggio non combacia.")
+    return embs, (time.perf_counter() - t0) * 1000.0
+
+def _embed_and_insert_pipelined(
+    job: _IngestJob,
+    col: Any,
+    ids: List[str],
+    docs: List[str],
+    metas: List[ChromaMetadata],
+) -> None:
+    """
+    Embedding a batch con al massimo RAG_INGEST_EMBED_CONCURRENCY richieste in volo (backpressure:
+    non si sottomette altro finche' il batch piu' vecchio non e' stato inserito). I batch vengono
+    inseriti in ordine appena pronti, in parallelo agli embedding successivi.
+    Annullamento o errore a meta': i chunk gia' inseriti vengono rimossi (niente file a meta').
+    """
+    total = len(docs)
+    pending: deque = deque()
+    inserted: List[str] = []
+    embedded = 0
+    pos = 0
+    try:
+        while pos < total or pending:
+            while pos < total and len(pending) < RAG_INGEST_EMBED_CONCURRENCY:
+                size = _INGEST_EMBED_TUNER.next_size()
+                end = min(total, pos + size)
+                pending.append((pos, end, _INGEST_EMBED_EXECUTOR.submit(_timed_embed_batch, docs[pos:end])))
+                pos = end
+            start, end, fut = pending.popleft()
+            embs, elapsed_ms = fut.result()
+            _INGEST_EMBED_TUNER.record(end - start, elapsed_ms)
+            embedded += end - start
+            job.update(stage="embedding", chunks_embedded=embedded, embed_batch_size=_INGEST_EMBED_TUNER.next_size())
+            for i in range(start, end, max(1, MAX_CHROMA_ADD_BATCH)):
+                j = min(end, i + max(1, MAX_CHROMA_ADD_BATCH))
+                _memory_add(col, ids=ids[i:j], embeddings=embs[i - start : j - start], documents=docs[i:j], metadatas=metas[i:j])
+                inserted.extend(ids[i:j])
+            with job.lock:
+                job.chunks_added = len(inserted)
+    except BaseException:
+        for _, _, fut in pending:
+            fut.cancel()
+        if inserted:
+            try:
+                _memory_delete(col, inserted)
+            except Exception as e:
+                print(f"[WARN] Rollback ingest {job.job_id} incompleto: {e}", flush=True)
+            with job.lock:
+                job.chunks_added = 0
+        raise
+
+def _submit_ingest_job(
+    avatar_id: str,
+    filename: str,
+    spool_path: str,
+    size_bytes: int,
+    file_sha256: str,
+    empirical_test_mode: bool,
+) -> _IngestJob:
+    """
+    Registra e accoda un job sul file gia' copiato nello spool (rimosso a fine job).
+    Se lo stesso contenuto e' gia' in memoria il job nasce concluso con dedup=True; se e' ancora
+    in ingest (retry del client a upload in corso) si restituisce il job esistente.
+    Bloccante (SQLite/Chroma): dagli endpoint async va chiamata in un threadpool.
+    """
+    job = _IngestJob(avatar_id, filename, spool_path, empirical_test_mode)
+    job.size_bytes = size_bytes
+    job.file_sha256 = file_sha256
+    with _INGEST_JOBS_LOCK:
+        if RAG_INGEST_FILE_DEDUPE and file_sha256:
+            # Controllo e registrazione sotto lo stesso lock: due retry concorrenti non partono entrambi.
+            in_flight = next(
+                (
+                    other for other in _INGEST_JOBS.values()
+                    if other.file_sha256 == file_sha256
+                    and other.avatar_id == avatar_id
+                    and other.empirical_test_mode == empirical_test_mode
+                    and other.status in {"queued", "running"}
+                    and not other.cancel_requested
+                ),
+                None,
+            )
+            if in_flight is not None:
+                _remove_quietly(spool_path)
+                print(f"[INFO] Ingest {in_flight.job_id}: {filename} gia' in corso, upload duplicato agganciato", flush=True)
+                return in_flight
+        _INGEST_JOBS[job.job_id] = job
+        # Tiene solo gli ultimi job conclusi; quelli attivi non vengono mai scartati.
+        for old_id in list(_INGEST_JOBS):
+            if len(_INGEST_JOBS) <= RAG_INGEST_JOBS_KEEP:
+                break
+            if _INGEST_JOBS[old_id].status in {"done", "error", "cancelled"}:
+                _INGEST_JOBS.pop(old_id, None)
+    existing: list[str] = []
+    if RAG_INGEST_FILE_DEDUPE and file_sha256:
+        try:
+            existing = _ingested_file_ids(get_collection(avatar_id, empirical_test_mode), file_sha256)
+        except Exception as e:
+            job.finish("error", error=f"Errore ingest: {e}")
+            _remove_quietly(spool_path)
+            raise
+    if existing:
+        _remove_quietly(spool_path)
+        job.dedup = True
+        job.chunks_total = len(existing)
+        job.finish("done", result={
+            "ok": True,
+            "filename": filename,
+            "dedup": True,
+            "chunks_added": 0,
+            "existing_chunks": len(existing),
+        })
+        print(f"[INFO] Ingest {job.job_id}: {filename} gia' presente ({len(existing)} chunk), saltato", flush=True)
+        return job
+    _INGEST_EXECUTOR.submit(_run_ingest_job, job)
+    return job
+
+def _run_ingest_job(job: _IngestJob) -> None:
+    try:
+        with job.lock:
+            if job.cancel_requested:
+                job.status = job.stage = "cancelled"
+                job.finished_at = time.time()
+                return
+            job.status = job.stage = "running"
+            job.started_at = time.time()
+        result = _ingest_file_job_body(job)
+        job.finish("done", result=result)
+        print(f"[INFO] Ingest {job.job_id} completato: {job.filename} ({job.chunks_added} chunk)", flush=True)
+    except _IngestCancelled:
+        job.finish("cancelled")
+        print(f"[INFO] Ingest {job.job_id} annullato: {job.filename}", flush=True)
+    except HTTPException as e:
+        job.finish("error", error=str(e.detail))
+    except Exception as e:
+        traceback.print_exc()
+        job.finish("error", error=f"Errore ingest: {e}")
+    finally:
+        _remove_quietly(job.spool_path)
+
+def _ingest_file_job_body(job: _IngestJob) -> dict:
+    """Estrazione, chunking, dedupe, embedding e insert di un file; gira su un worker di ingest."""
+    avatar_id = job.avatar_id
+    filename = job.filename
+    empirical_test_mode = job.empirical_test_mode
+    ext = os.path.splitext(filename)[1].lower()
 
     sections: List[Tuple[str, dict]] = []
 
+    job.update(stage="extracting")
     if ext == ".pdf":
-        sections = extract_text_from_pdf(raw)
+        sections = extract_text_from_pdf(
+            None,
+            progress=lambda done, total: job.update(pages_done=done, pages_total=total),
+            pdf_path=job.spool_path,
+        )
         if not sections:
             raise HTTPException(status_code=400, detail="Nessun testo estratto dal PDF (OCR fallito o testo illeggibile).")
 
     elif ext in (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"):
-        txt = ocr_image_bytes(raw)
+        txt, ocr_info = ocr_image_timed(job.spool_path)
         if not txt or looks_like_garbage(txt):
             raise HTTPException(status_code=400, detail="OCR non ha prodotto testo utile dall'immagine.")
-        sections = [(txt, {"page": 1, "ocr": True})]
+        sections = [(txt, {"page": 1, "ocr": True, **ocr_info})]
 
     else:
-        txt = extract_text_from_plain(raw)
+        with open(job.spool_path, "rb") as handle:
+            txt = extract_text_from_plain(handle.read())
         if not txt or looks_like_garbage(txt):
             raise HTTPException(status_code=400, detail="File non testuale o contenuto non leggibile.")
         sections = [(txt, {"page": 1})]
+    if ext != ".pdf":
+        job.update(pages_done=1, pages_total=1)
 
     col = get_collection(avatar_id, empirical_test_mode)
 
@@ -4683,6 +7765,8 @@ async def ingest_file(
                     "memory_subject": _MEMORY_SUBJECT_EXTERNAL,
                     "source_filename": filename,
                     "chunk": idx,
+                    "chunk_sha": _chunk_sha(ch),
+                    "file_sha256": job.file_sha256,
                     "ts": int(time.time()),
                 }
             )
@@ -4692,33 +7776,256 @@ async def ingest_file(
     if not docs:
         raise HTTPException(status_code=400, detail="Nessun chunk valido generato dal file.")
 
-    embeddings: List[ChromaEmbedding] = []
-    batch = 16
-    for i in range(0, len(docs), batch):
-        embeddings.extend(cast(List[ChromaEmbedding], ollama_embed_many(docs[i : i + batch])))
-
-    if len(embeddings) != len(docs):
-        raise HTTPException(status_code=500, detail="Errore embeddings: conteggio non combacia.")
-
-    batch_size = max(1, min(MAX_CHROMA_ADD_BATCH, len(docs)))
-    for i in range(0, len(docs), batch_size):
-        col.add(
-            ids=ids[i : i + batch_size],
-            embeddings=embeddings[i : i + batch_size],
-            documents=docs[i : i + batch_size],
-            metadatas=metas[i : i + batch_size],
+    # Nuova versione di un file gia' caricato: i chunk con lo stesso hash restano (niente embedding),
+    # quelli spariti vengono rimossi dopo l'insert dei nuovi.
+    reused_ids: List[str] = []
+    reused_docs: List[str] = []
+    reused_metas: List[ChromaMetadata] = []
+    stale_ids: List[str] = []
+    if RAG_INGEST_FILE_DEDUPE:
+        previous: dict[str, str] = {}
+        for old_id, old_sha in _previous_file_chunks(col, filename):
+            if old_sha and old_sha not in previous:
+                previous[old_sha] = old_id
+            else:
+                stale_ids.append(old_id)
+        if previous:
+            keep = []
+            for i, m in enumerate(metas):
+                old_id = previous.pop(str(m.get("chunk_sha") or ""), None)
+                if old_id is None:
+                    keep.append(i)
+                    continue
+                reused_ids.append(old_id)
+                reused_docs.append(docs[i])
+                reused_metas.append(m)
+            stale_ids.extend(previous.values())
+            ids = [ids[i] for i in keep]
+            docs = [docs[i] for i in keep]
+            metas = [metas[i] for i in keep]
+
+    skipped_duplicates = 0
+    job.update(stage="deduplicating", chunks_total=len(docs))
+    if RAG_INGEST_DEDUPE and docs:
+        duplicate_of = _find_near_duplicates(col, ids, docs, ignore_ids=set(stale_ids))
+        keep = [i for i, dup in enumerate(duplicate_of) if dup is None]
+        skipped_duplicates = len(docs) - len(keep)
+        ids = [ids[i] for i in keep]
+        docs = [docs[i] for i in keep]
+        metas = [metas[i] for i in keep]
+
+    job.update(stage="embedding", chunks_total=len(docs))
+    _embed_and_insert_pipelined(job, col, ids, docs, metas)
+
+    # Da qui in poi niente punti di cancellazione: chunk riusati e rimossi vanno aggiornati insieme.
+    with job.lock:
+        job.stage = "inserting"
+    if reused_ids:
+        existing = col.get(ids=reused_ids, include=["metadatas"])
+        old_metas = dict(zip(existing.get("ids") or [], existing.get("metadatas") or []))
+        _memory_update_metadata(
+            col,
+            ids=reused_ids,
+            documents=reused_docs,
+            metadatas=[{**(old_metas.get(rid) or {}), **m} for rid, m in zip(reused_ids, reused_metas)],
         )
+    _memory_delete(col, stale_ids)
 
     return {
         "ok": True,
         "filename": filename,
         "sections": len(sections),
         "chunks_added": len(docs),
+        "chunks_reused": len(reused_ids),
+        "chunks_removed": len(stale_ids),
+        "chunks_skipped_duplicates": skipped_duplicates,
+        "dedup": False,
     }
 
+@app.post("/ingest_file")
+
+async def ingest_file(
+    avatar_id: str = Form(...),
+    file: UploadFile = File(...),
+    empirical_test_mode: bool = Form(False),
+):
+    """Accoda l'ingest di PDF / immagini / testo e restituisce subito il job_id.
+
+    Args:
+        avatar_id: ID dell'avatar
+        file: File da processare (PDF, immagini, testo)
+
+    Avanzamento ed esito su GET /ingest_jobs/{job_id}; annullamento con POST /ingest_jobs/{job_id}/cancel.
+    """
+
+    filename = file.filename or "upload"
+
+    spool_path = _new_spool_path(filename)
+    size_bytes, file_sha256 = await _spool_upload(file, spool_path)
+
+    job = await run_in_threadpool(
+        _submit_ingest_job, avatar_id, filename, spool_path, size_bytes, file_sha256, empirical_test_mode,
+    )
+    return job.to_dict()
+
+def _get_ingest_job_or_404(job_id: str) -> _IngestJob:
+    with _INGEST_JOBS_LOCK:
+        job = _INGEST_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job di ingest non trovato.")
+    return job
+
+@app.get("/ingest_jobs/{job_id}")
+
+def ingest_job_status(job_id: str):
+    return _get_ingest_job_or_404(job_id).to_dict()
+
+@app.post("/ingest_jobs/{job_id}/cancel")
+
+def cancel_ingest_job(job_id: str):
+    job = _get_ingest_job_or_404(job_id)
+    with job.lock:
+        if job.status in {"queued", "running"}:
+            job.cancel_requested = True
+    return job.to_dict()
+
+def _intent_eval_main(argv: List[str]) -> int:
+    """python rag_server.py eval_intent [--log FILE ...] [--queries FILE ...]"""
+    queries: list[str] = []
+    mode = ""
+    for arg in argv:
+        if arg in {"--log", "--queries"}:
+            mode = arg
+            continue
+        if mode == "--log":
+            for texts in _load_intent_log_samples([arg]).values():
+                queries.extend(texts)
+        elif mode == "--queries":
+            with open(arg, "r", encoding="utf-8") as f:
+                queries.extend(line.strip() for line in f if line.strip())
+    if not queries:
+        # Gli esempi di training non sono un set di valutazione: servono query reali tenute da parte.
+        print("Uso: python rag_server.py eval_intent [--log FILE ...] [--queries FILE ...]", file=sys.stderr)
+        return 2
+    print(json.dumps(_evaluate_intent_router(queries), ensure_ascii=False, indent=2))
+    return 0
+
+def _backfill_lexical_features(col: Any, page_size: int = 256) -> dict:
+    """Aggiunge/aggiorna le feature lessicali sui chunk che non hanno la versione corrente."""
+    stats = {"chunks": 0, "updated": 0}
+    offset = 0
+    while True:
+        res = col.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        ids = res.get("ids") or []
+        if not ids:
+            break
+        docs = res.get("documents") or []
+        metas = res.get("metadatas") or []
+        upd_ids: list[str] = []
+        upd_docs: list[str] = []
+        upd_metas: list[dict] = []
+        for doc_id, doc, meta in zip(ids, docs, metas):
+            text = doc if isinstance(doc, str) else ""
+            if _has_lexical_features(text, meta):
+                continue
+            upd_ids.append(doc_id)
+            upd_docs.append(text)
+            upd_metas.append({**(meta or {}), **_lexical_features(text, meta)})
+        _memory_update_metadata(col, upd_ids, upd_docs, upd_metas)
+        stats["chunks"] += len(ids)
+        stats["updated"] += len(upd_ids)
+        offset += len(ids)
+    return stats
+
+def _backfill_lexical_main(argv: List[str]) -> int:
+    """python rag_server.py backfill_lexical [--avatar ID ...] [--empirical]"""
+    empirical = "--empirical" in argv
+    avatars = [argv[i + 1] for i, arg in enumerate(argv[:-1]) if arg == "--avatar"]
+    persist_root, _ = _storage_roots(empirical)
+    if not avatars and os.path.isdir(persist_root):
+        avatars = sorted(
+            name for name in os.listdir(persist_root)
+            if not name.startswith("_") and os.path.isdir(os.path.join(persist_root, name))
+        )
+    report: dict[str, Any] = {}
+    for avatar_id in avatars:
+        try:
+            report[avatar_id] = _backfill_lexical_features(get_collection(avatar_id, empirical))
+        except Exception as e:
+            report[avatar_id] = {"error": str(e)}
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 1 if any("error" in r for r in report.values()) else 0
+
+def _bench_dedupe_main(argv: List[str]) -> int:
+    """
+    python rag_server.py bench_dedupe [--avatar ID] [--empirical] [--rounds N]
+    Confronta _dedupe_chunks con la vecchia versione difflib (stessa soglia 0.92) su gruppi di chunk
+    reali dell'avatar piu' copie esatte/quasi identiche iniettate.
+    """
+    import random
+
+    empirical = "--empirical" in argv
+    avatar_id = next((argv[i + 1] for i, arg in enumerate(argv[:-1]) if arg == "--avatar"), "")
+    rounds = int(next((argv[i + 1] for i, arg in enumerate(argv[:-1]) if arg == "--rounds"), "30"))
+    if not avatar_id:
+        persist_root, _ = _storage_roots(empirical)
+        names = sorted(n for n in os.listdir(persist_root) if not n.startswith("_")) if os.path.isdir(persist_root) else []
+        avatar_id = names[0] if names else ""
+    corpus = [d for d in (get_collection(avatar_id, empirical).get(include=["documents"], limit=400).get("documents") or []) if d] if avatar_id else []
+    if len(corpus) < 2:
+        print(json.dumps({"error": "servono almeno 2 chunk in memoria", "avatar_id": avatar_id}))
+        return 1
+
+    rng = random.Random(7)
+
+    def _mutate(text: str, rate: float) -> str:
+        chars = list(text)
+        for i in range(len(chars)):
+            if rng.random() < rate:
+                chars[i] = rng.choice("abcdefghilmnoprstuvz ")
+        return "".join(chars)
+
+    timings = {"minhash_ms": 0.0, "difflib_ms": 0.0}
+    agree = 0
+    removed = {"minhash": 0, "difflib": 0}
+    for _ in range(rounds):
+        docs = rng.sample(corpus, min(12, len(corpus)))
+        base = docs[0]
+        docs += [base, base.replace(" ", "  ", 3), _mutate(base, 0.005), _mutate(base, 0.02)]
+        rng.shuffle(docs)
+        metas = [{} for _ in docs]
+        t0 = time.perf_counter()
+        new_docs, _ = _dedupe_chunks(docs, metas)
+        t1 = time.perf_counter()
+        old_docs, _ = _dedupe_chunks_difflib(docs, metas)
+        t2 = time.perf_counter()
+        timings["minhash_ms"] += (t1 - t0) * 1000.0
+        timings["difflib_ms"] += (t2 - t1) * 1000.0
+        removed["minhash"] += len(docs) - len(new_docs)
+        removed["difflib"] += len(docs) - len(old_docs)
+        agree += int(new_docs == old_docs)
+    print(json.dumps({
+        "avatar_id": avatar_id,
+        "rounds": rounds,
+        "similarity": _DEDUPE_SIMILARITY,
+        "shingle_jaccard_threshold": round(_shingle_jaccard_threshold(_DEDUPE_SIMILARITY), 4),
+        "avg_minhash_ms": round(timings["minhash_ms"] / rounds, 3),
+        "avg_difflib_ms": round(timings["difflib_ms"] / rounds, 3),
+        "removed_minhash": removed["minhash"],
+        "removed_difflib": removed["difflib"],
+        "identical_output_rounds": agree,
+    }, ensure_ascii=False, indent=2))
+    return 0
+
 if __name__ == "__main__":
     import uvicorn
     import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "eval_intent":
+        sys.exit(_intent_eval_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "bench_dedupe":
+        sys.exit(_bench_dedupe_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill_lexical":
+        sys.exit(_backfill_lexical_main(sys.argv[2:]))
     try:
         print("[INFO] Avvio server su 127.0.0.1:8002", file=sys.stderr, flush=True)
         uvicorn.run(app, host="127.0.0.1", port=8002, reload=False)
@@ -0,0 +1,332 @@
+"""SOULFRAME - Voice Gateway (FastAPI)
+
+Un turno vocale completo su una sola connessione: audio -> Whisper -> RAG chat -> Coqui TTS.
+
+Il client Unity oggi fa tre round trip in sequenza (/transcribe, /chat, /tts_stream).
+Qui il gateway li esegue lato server e risponde con uno stream unico:
+- trascrizione appena Whisper ha finito
+- metadata RAG (intent, rag_used) e token della risposta mentre Ollama genera (/chat_stream)
+- PCM progressivo: la prima frase della risposta va in sintesi appena e' completa,
+  mentre il modello sta ancora generando le successive
+
+Formato risposta (application/octet-stream, chunked): sequenza di frame
+    1 byte tipo | 4 byte lunghezza big-endian | payload
+- tipo "J": evento JSON UTF-8 con campo "event"
+  (transcript, metadata, token, final, audio_format, audio_reset, error, done)
+- tipo "A": PCM int16 little-endian, formato annunciato dall'evento audio_format
+
+Se la risposta finale RAG sostituisce la bozza in streaming (final.replaced=true) arriva
+audio_reset: il client scarta l'audio della bozza non ancora riprodotto e riceve il PCM
+della risposta definitiva.
+
+Env utili:
+- VOICE_GATEWAY_WHISPER_URL      (default: http://127.0.0.1:8001)
+- VOICE_GATEWAY_RAG_URL          (default: http://127.0.0.1:8002)
+- VOICE_GATEWAY_TTS_URL          (default: http://127.0.0.1:8004)
+- VOICE_GATEWAY_MIN_SENTENCE_CHARS (default: 12) lunghezza minima di una frase da mandare al TTS
+- VOICE_GATEWAY_SPECULATIVE_TTS  (default: 1) sintetizza la bozza mentre arriva; 0 = solo risposta finale
+- VOICE_GATEWAY_TIMEOUT          (default: 600) read timeout verso i servizi (secondi)
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import queue
+import re
+import struct
+import threading
+import time
+from typing import Any, Iterator, Optional
+
+import requests
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+
+WHISPER_URL = os.getenv("VOICE_GATEWAY_WHISPER_URL", "http://127.0.0.1:8001").rstrip("/")
+RAG_URL = os.getenv("VOICE_GATEWAY_RAG_URL", "http://127.0.0.1:8002").rstrip("/")
+TTS_URL = os.getenv("VOICE_GATEWAY_TTS_URL", "http://127.0.0.1:8004").rstrip("/")
+DEFAULT_LANGUAGE = "it"
+MIN_SENTENCE_CHARS = max(1, int(os.getenv("VOICE_GATEWAY_MIN_SENTENCE_CHARS", "12")))
+SPECULATIVE_TTS = os.getenv("VOICE_GATEWAY_SPECULATIVE_TTS", "1").strip().lower() in {"1", "true", "yes", "on"}
+SERVICE_TIMEOUT = max(5.0, float(os.getenv("VOICE_GATEWAY_TIMEOUT", "600")))
+CONNECT_TIMEOUT = 5.0
+
+FRAME_JSON = b"J"
+FRAME_AUDIO = b"A"
+WAV_HEADER_BYTES = 44
+
+# Fine frase: punteggiatura forte seguita da spazio (eventuali virgolette/parentesi di chiusura incluse).
+_SENTENCE_END_RE = re.compile(r"[.!?…]+[\"')\]»]*\s+")
+
+app = FastAPI(title="SOULFRAME Voice Gateway", version="1.0.0")
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=False,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+_HTTP_SESSION: Optional[requests.Session] = None
+_HTTP_SESSION_LOCK = threading.Lock()
+
+
+def _http_session() -> requests.Session:
+    """Sessione keep-alive condivisa verso Whisper/RAG/TTS."""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None:
+        with _HTTP_SESSION_LOCK:
+            if _HTTP_SESSION is None:
+                _HTTP_SESSION = requests.Session()
+    return _HTTP_SESSION
+
+
+def _frame(kind: bytes, payload: bytes) -> bytes:
+    return kind + struct.pack(">I", len(payload)) + payload
+
+
+def _event_frame(event: str, **payload: Any) -> bytes:
+    return _frame(FRAME_JSON, json.dumps({"event": event, **payload}, ensure_ascii=False).encode("utf-8"))
+
+
+def _elapsed_ms(started: float) -> int:
+    return int(round((time.perf_counter() - started) * 1000.0))
+
+
+def _transcribe(audio: bytes, filename: str, language: str) -> str:
+    try:
+        r = _http_session().post(
+            f"{WHISPER_URL}/transcribe",
+            files={"file": (filename, audio, "application/octet-stream")},
+            data={"language": language},
+            timeout=(CONNECT_TIMEOUT, SERVICE_TIMEOUT),
+        )
+        r.raise_for_status()
+        return str((r.json() or {}).get("text") or "").strip()
+    except requests.exceptions.RequestException as e:
+        raise HTTPException(status_code=502, detail=f"Whisper non raggiungibile o errore HTTP: {e}")
+
+
+def _pop_complete_sentences(buffer: str) -> tuple[list[str], str]:
+    """Separa dal buffer le frasi gia' chiuse; il resto resta in attesa di altri token."""
+    sentences: list[str] = []
+    start = 0
+    for match in _SENTENCE_END_RE.finditer(buffer):
+        candidate = buffer[start:match.end()].strip()
+        if len(candidate) < MIN_SENTENCE_CHARS:
+            continue
+        sentences.append(candidate)
+        start = match.end()
+    return sentences, buffer[start:]
+
+
+class _VoiceTurn:
+    """Stato condiviso tra il thread chat, il thread TTS e il generatore della risposta."""
+
+    def __init__(self, tts_form: dict[str, Any]):
+        self.tts_form = tts_form
+        self.out: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        self.tts_jobs: "queue.Queue[Optional[tuple[int, str]]]" = queue.Queue()
+        self.stop = threading.Event()
+        self.generation = 0
+        self.audio_format_sent = False
+        self.started = time.perf_counter()
+        self.timings: dict[str, int] = {}
+
+    def mark(self, name: str) -> None:
+        self.timings.setdefault(name, _elapsed_ms(self.started))
+
+    def run_chat(self, chat_payload: dict[str, Any]) -> None:
+        buffer = ""
+        draft_spoken = False
+        try:
+            with _http_session().post(
+                f"{RAG_URL}/chat_stream",
+                json=chat_payload,
+                timeout=(CONNECT_TIMEOUT, SERVICE_TIMEOUT),
+                stream=True,
+            ) as r:
+                r.raise_for_status()
+                for line in r.iter_lines():
+                    if self.stop.is_set():
+                        return
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    kind = event.get("event")
+                    if kind == "metadata":
+                        self.out.put(_event_frame(
+                            "metadata",
+                            intent=event.get("intent"),
+                            rag_used=event.get("rag_used", []),
+                            auto_remembered=bool(event.get("auto_remembered", False)),
+                        ))
+                    elif kind == "token":
+                        piece = str(event.get("text") or "")
+                        self.mark("first_token_ms")
+                        self.out.put(_event_frame("token", text=piece))
+                        if SPECULATIVE_TTS:
+                            buffer += piece
+                            sentences, buffer = _pop_complete_sentences(buffer)
+                            for sentence in sentences:
+                                self.tts_jobs.put((0, sentence))
+                                draft_spoken = True
+                    elif kind == "final":
+                        final_text = str(event.get("text") or "").strip()
+                        replaced = bool(event.get("replaced", False))
+                        if SPECULATIVE_TTS and not replaced:
+                            if buffer.strip():
+                                self.tts_jobs.put((0, buffer.strip()))
+                        else:
+                            if SPECULATIVE_TTS and draft_spoken:
+                                # La bozza gia' in coda/sintesi viene scartata dal thread TTS.
+                                self.generation = 1
+                                self.out.put(_event_frame("audio_reset"))
+                            if final_text:
+                                self.tts_jobs.put((1 if SPECULATIVE_TTS else 0, final_text))
+                        buffer = ""
+                        self.out.put(_frame(FRAME_JSON, json.dumps(event, ensure_ascii=False).encode("utf-8")))
+                    elif kind == "error":
+                        self.out.put(_event_frame("error", stage="chat", detail=event.get("detail")))
+        except Exception as e:
+            self.out.put(_event_frame("error", stage="chat", detail=str(e)))
+        finally:
+            self.tts_jobs.put(None)
+
+    def run_tts(self) -> None:
+        try:
+            while not self.stop.is_set():
+                job = self.tts_jobs.get()
+                if job is None:
+                    break
+                generation, text = job
+                if generation < self.generation:
+                    continue
+                try:
+                    self._synthesize(generation, text)
+                except Exception as e:
+                    self.out.put(_event_frame("error", stage="tts", detail=str(e)))
+                    break
+        finally:
+            self.out.put(None)
+
+    def _synthesize(self, generation: int, text: str) -> None:
+        with _http_session().post(
+            f"{TTS_URL}/tts_stream",
+            data={**self.tts_form, "text": text},
+            timeout=(CONNECT_TIMEOUT, SERVICE_TIMEOUT),
+            stream=True,
+        ) as r:
+            r.raise_for_status()
+            header = b""
+            for chunk in r.iter_content(chunk_size=None):
+                if self.stop.is_set() or generation < self.generation:
+                    return
+                if len(header) < WAV_HEADER_BYTES:
+                    missing = WAV_HEADER_BYTES - len(header)
+                    header += chunk[:missing]
+                    chunk = chunk[missing:]
+                    if len(header) < WAV_HEADER_BYTES:
+                        continue
+                    if not self.audio_format_sent:
+                        channels, sample_rate = struct.unpack("<HI", header[22:28])
+                        bits_per_sample = struct.unpack("<H", header[34:36])[0]
+                        self.out.put(_event_frame(
+                            "audio_format",
+                            sample_rate=sample_rate,
+                            channels=channels,
+                            bits_per_sample=bits_per_sample,
+                        ))
+                        self.audio_format_sent = True
+                if chunk:
+                    self.mark("first_audio_ms")
+                    self.out.put(_frame(FRAME_AUDIO, chunk))
+
+
+@app.get("/health")
+def health():
+    return {
+        "ok": True,
+        "whisper_url": WHISPER_URL,
+        "rag_url": RAG_URL,
+        "tts_url": TTS_URL,
+        "speculative_tts": SPECULATIVE_TTS,
+        "min_sentence_chars": MIN_SENTENCE_CHARS,
+    }
+
+
+@app.post("/voice_turn", responses={200: {"content": {"application/octet-stream": {}}}})
+async def voice_turn(
+    file: UploadFile = File(...),
+    avatar_id: str = Form(...),
+    language: str = Form(DEFAULT_LANGUAGE),
+    session_id: Optional[str] = Form(None),
+    input_mode: str = Form("voice"),
+    log_conversation: bool = Form(False),
+    top_k: int = Form(20),
+    system: Optional[str] = Form(None),
+    reply_segment_max_chars: Optional[int] = Form(None),
+    client_platform: Optional[str] = Form(None),
+    empirical_test_mode: bool = Form(False),
+):
+    audio = await file.read()
+    if not audio:
+        raise HTTPException(status_code=400, detail="Audio vuoto.")
+
+    lang = (language or DEFAULT_LANGUAGE).strip().lower() or DEFAULT_LANGUAGE
+    started = time.perf_counter()
+    transcript = await run_in_threadpool(_transcribe, audio, file.filename or "audio.wav", lang)
+    stt_ms = _elapsed_ms(started)
+
+    chat_payload: dict[str, Any] = {
+        "avatar_id": avatar_id,
+        "user_text": transcript,
+        "top_k": top_k,
+        "system": system,
+        "session_id": session_id,
+        "input_mode": input_mode,
+        "log_conversation": log_conversation,
+        "empirical_test_mode": empirical_test_mode,
+    }
+    tts_form: dict[str, Any] = {
+        "avatar_id": avatar_id,
+        "language": lang,
+        "empirical_test_mode": "true" if empirical_test_mode else "false",
+    }
+    if client_platform:
+        tts_form["client_platform"] = client_platform
+    if reply_segment_max_chars is not None:
+        tts_form["reply_segment_max_chars"] = str(reply_segment_max_chars)
+
+    def _stream() -> Iterator[bytes]:
+        yield _event_frame("transcript", text=transcript, stt_ms=stt_ms)
+        if not transcript:
+            yield _event_frame("done", timings={"stt_ms": stt_ms, "total_ms": _elapsed_ms(started)})
+            return
+
+        turn = _VoiceTurn(tts_form)
+        turn.started = started
+        turn.timings["stt_ms"] = stt_ms
+        threading.Thread(target=turn.run_tts, daemon=True).start()
+        threading.Thread(target=turn.run_chat, args=(chat_payload,), daemon=True).start()
+        try:
+            while True:
+                item = turn.out.get()
+                if item is None:
+                    break
+                yield item
+            turn.timings["total_ms"] = _elapsed_ms(started)
+            yield _event_frame("done", timings=turn.timings)
+        finally:
+            turn.stop.set()
+
+    headers = {
+        "Cache-Control": "no-cache, no-transform",
+        "X-Accel-Buffering": "no",
+        "X-Voice-Frame-Format": "type:1|length:4be|payload",
+    }
+    return StreamingResponse(_stream(), media_type="application/octet-stream", headers=headers)
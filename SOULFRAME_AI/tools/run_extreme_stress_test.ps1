@@ -132,14 +132,28 @@ function Describe-Image {
 function Ingest-File {
     param(
         [string]$AvatarId,
-        [string]$Path
+        [string]$Path,
+        [int]$TimeoutSec = 1800
     )
 
-    return Invoke-MultipartPost -Url "$BaseUrl/ingest_file" -Fields @{
+    # /ingest_file accoda un job: si attende la fine per non interrogare l'avatar a ingest in corso.
+    $job = Invoke-MultipartPost -Url "$BaseUrl/ingest_file" -Fields @{
         avatar_id = $AvatarId
     } -Files @(
         @{ fieldName = 'file'; path = $Path }
     )
+    $deadline = (Get-Date).AddSeconds($TimeoutSec)
+    while ($job.status -in @('queued', 'running')) {
+        if ((Get-Date) -gt $deadline) {
+            throw "Timeout ingest job $($job.job_id) (stage=$($job.stage))"
+        }
+        Start-Sleep -Milliseconds 500
+        $job = Invoke-RestMethod -Uri "$BaseUrl/ingest_jobs/$($job.job_id)"
+    }
+    if ($job.status -ne 'done') {
+        throw "Ingest job $($job.job_id) $($job.status): $($job.error)"
+    }
+    return $job.result
 }
 
 function Get-AvatarStats {
@@ -22,6 +22,7 @@ SUPPORTED_UPDATE_FILES=(
   coqui_tts_server.py
   rag_server.py
   whisper_server.py
+  voice_gateway_server.py
   requirements.txt
   setup_soulframe_ubuntu.sh
   sf_admin_ubuntu.sh
@@ -608,6 +609,7 @@ resolve_update_target() {
     coqui_tts_server.py) UPDATE_TARGET_FILE="$BACKEND_DIR/coqui_tts_server.py" ;;
     rag_server.py) UPDATE_TARGET_FILE="$BACKEND_DIR/rag_server.py" ;;
     whisper_server.py) UPDATE_TARGET_FILE="$BACKEND_DIR/whisper_server.py" ;;
+    voice_gateway_server.py) UPDATE_TARGET_FILE="$BACKEND_DIR/voice_gateway_server.py" ;;
     requirements.txt) UPDATE_TARGET_FILE="$BACKEND_DIR/requirements.txt" ;;
     setup_soulframe_ubuntu.sh)
       UPDATE_TARGET_FILE="$SETUP_DIR/setup_soulframe_ubuntu.sh"
@@ -535,6 +535,7 @@ call :CopyRequired "SOULFRAME_AI\backend\avatar_asset_server.py" "%PERCORSO_DEST
 call :CopyRequired "SOULFRAME_AI\backend\coqui_tts_server.py" "%PERCORSO_DEST%\" || exit /b 1
 call :CopyRequired "SOULFRAME_AI\backend\rag_server.py" "%PERCORSO_DEST%\" || exit /b 1
 call :CopyRequired "SOULFRAME_AI\backend\whisper_server.py" "%PERCORSO_DEST%\" || exit /b 1
+call :CopyRequired "SOULFRAME_AI\backend\voice_gateway_server.py" "%PERCORSO_DEST%\" || exit /b 1
 
 echo [OK] Backup completato.
 echo      Cartella pronta: "%PERCORSO_DEST%"